@@ -0,0 +1,950 @@
+'''Performance benchmarks for the Tau compiler.  Run "python bench_tau.py"
+   to run every benchmark, or name the ones to run on the command line.'''
+from __future__ import division
+import argparse
+import array
+import ctypes
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import llvmlite.ir as ir
+import llvmlite.binding as llvm
+import tau
+from tau.inputBuffer import InputBuffer
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def generateExpression(terms):
+    '''Builds a long but valid Tau expression with the given number of terms.'''
+    parts = ["x{}".format(i % 7) for i in range(terms)]
+    ops = [" + ", "*", " - ", "/", " ** "]
+    line = parts[0]
+    for i, p in enumerate(parts[1:]):
+        if i % 5 == 4:
+            p = "sin({}, 2.5)".format(p)
+        elif i % 5 == 2:
+            p = "({} - 3)".format(p)
+        line += ops[i % len(ops)] + p
+    return "result = " + line + "  # trailing comment"
+
+
+def generateNested(depth):
+    '''Builds an expression with brackets nested to the given depth.'''
+    line = "x"
+    for i in range(depth):
+        line = ["({} + 1)", "sin({})", "a[{}]", "[{}, 2]"][i % 4].format(line)
+    return "y = " + line
+
+
+def generatePolynomial(terms):
+    '''Builds an unrolled polynomial in the variable y with the given number of terms.'''
+    return " + ".join("{}.5*y**{}".format(i % 10, i) for i in range(terms))
+
+
+def objectSize(obj):
+    '''Returns the size of an object in bytes, including its instance dict.'''
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def timeCall(function, minTime=0.2):
+    '''Calls function repeatedly for at least minTime seconds and returns the
+       average time per call in seconds.'''
+    calls = 0
+    start = time.time()
+    while True:
+        function()
+        calls += 1
+        elapsed = time.time() - start
+        if elapsed >= minTime:
+            return elapsed / calls
+
+
+def timeOption(option, source, calls):
+    '''Compiles source in JIT sessions without and with the given TauJIT option
+       (with {0} in source standing for a prefix of the function names), and
+       times each call, given as a name after the prefix and the arguments.
+       Returns a pair of times per call, without and with the option, for each.'''
+    # The sessions must outlive the functions compiled in them
+    sessions = [tau.TauJIT(optLevel=2, **{option: enabled}) for enabled in [False, True]]
+    # Function names are shared between sessions, so each needs its own
+    prefixes = ["plain", option]
+    for prefix, jit in zip(prefixes, sessions):
+        jit.runCommand(source.format(prefix))
+    times = []
+    for name, arguments in calls:
+        functions = [jit.getFunction(prefix + name) for prefix, jit in zip(prefixes, sessions)]
+        times.append([timeCall(lambda: function(*arguments)) for function in functions])
+    return times
+
+
+def benchLexer():
+    '''Measures lexer throughput in tokens per second for lines of increasing length.'''
+    print "{:>8} {:>10} {:>14}".format("terms", "tokens", "tokens/sec")
+    for terms in [10, 100, 1000, 5000]:
+        line = generateExpression(terms)
+        nTokens = tau.lexer.countTokens(tau.lexer.lex(line))
+        perCall = timeCall(lambda: tau.lexer.lex(line))
+        print "{:>8} {:>10} {:>14.0f}".format(terms, nTokens, nTokens / perCall)
+
+
+def benchNesting():
+    '''Measures lexer throughput for deeply nested brackets.'''
+    print "{:>8} {:>10} {:>14}".format("depth", "tokens", "tokens/sec")
+    for depth in [10, 100, 400, 2000]:
+        line = generateNested(depth)
+        try:
+            nTokens = tau.lexer.countTokens(tau.lexer.lex(line))
+        except RuntimeError:
+            print "{:>8} {:>10} {:>14}".format(depth, "-", "recursion limit")
+            continue
+        perCall = timeCall(lambda: tau.lexer.lex(line))
+        print "{:>8} {:>10} {:>14.0f}".format(depth, nTokens, nTokens / perCall)
+
+
+def benchFrontendMemory():
+    '''Reports the average memory used per token and per AST node.'''
+    line = " + ".join("{}*{}.".format(i, i % 9) for i in range(200))
+    tokens = tau.lexer.lex(line)
+    tokenBytes = [objectSize(t) + (sys.getsizeof(t.data) if t.name == "literal" else 0)
+                  for t in tokens]
+    print "{:>20} {:>10.1f}".format("bytes/token", sum(tokenBytes) / len(tokenBytes))
+    nodes = []
+    pending = [tau.ast.ASTNode(tokens, tau.module.TauModule())]
+    while pending:
+        nodes.append(pending.pop())
+        pending += nodes[-1].children
+    nodeBytes = [objectSize(n) + sys.getsizeof(n.children) for n in nodes]
+    print "{:>20} {:>10.1f}".format("bytes/AST node", sum(nodeBytes) / len(nodeBytes))
+
+
+def benchParser():
+    '''Measures AST construction time for unrolled polynomials of increasing length.'''
+    print "{:>8} {:>12} {:>14}".format("terms", "seconds", "tokens/sec")
+    mod = tau.module.TauModule()
+    mod.localVars['y'] = (tau.dtypes.Real, None)
+    for terms in [10, 100, 1000, 10000, 100000]:
+        tokens = tau.lexer.lex(generatePolynomial(terms))
+        try:
+            perCall = timeCall(lambda: tau.ast.ASTNode(tokens, mod), 0.5)
+        except RuntimeError:
+            print "{:>8} {:>12} {:>14}".format(terms, "-", "recursion limit")
+            continue
+        print "{:>8} {:>12.5f} {:>14.0f}".format(terms, perCall, len(tokens) / perCall)
+
+
+def benchEmission():
+    '''Measures IR emission time (ASTNode.evaluate) for unrolled polynomials.'''
+    print "{:>8} {:>12} {:>14}".format("terms", "seconds", "IR lines/sec")
+    mod = tau.module.TauModule()
+    mod.localVars['y'] = (tau.dtypes.Real, None)
+
+    def emit(node):
+        del mod.body[:]
+        mod.numRegisters = 0
+        node.evaluate()
+    for terms in [10, 100, 1000, 10000, 100000]:
+        node = tau.ast.ASTNode(tau.lexer.lex(generatePolynomial(terms)), mod)
+        try:
+            perCall = timeCall(lambda: emit(node), 0.5)
+        except RuntimeError:
+            print "{:>8} {:>12} {:>14}".format(terms, "-", "recursion limit")
+            continue
+        print "{:>8} {:>12.5f} {:>14.0f}".format(terms, perCall, len(mod.body) / perCall)
+
+
+def benchOptimizer():
+    '''Compares compile time, optimizer time and run time of a JIT-compiled
+       loop at each optimization level.'''
+    print "{:>6} {:>12} {:>12} {:>12}".format("level", "compile (s)", "optimize (s)", "run (s)")
+    for level in range(4):
+        jit = tau.TauJIT(optLevel=level)
+        start = time.time()
+        jit.runCommand(
+            "def Real optPi{}(Int n):\n"
+            "    optSum = 0.\n"
+            "    optX = 0.\n"
+            "    for optIndex in range(n):\n"
+            "        optX = (optIndex + .5) / n\n"
+            "        optSum += 4. / (1. + optX*optX)\n"
+            "    optSum / n".format(level))
+        compileTime = time.time() - start
+        optimizeTime = jit.optimizerTime
+        runTime = timeCall(lambda: jit.runCommand("optPi{}(10000000)".format(level)), 1.)
+        print "{:>6} {:>12.5f} {:>12.5f} {:>12.5f}".format(level, compileTime, optimizeTime,
+                                                           runTime)
+
+
+def buildWithIRBuilder(node):
+    '''Emits the IR for an AST of Real arithmetic on the variable y with
+       llvmlite's structured IR builder, as a function returning the result.'''
+    irModule = ir.Module()
+    double = ir.DoubleType()
+    function = ir.Function(irModule, ir.FunctionType(double, [double]), "statement")
+    builder = ir.IRBuilder(function.append_basic_block("entry"))
+    pow = ir.Function(irModule, ir.FunctionType(double, [double, double]), "llvm.pow.f64")
+    y = builder.alloca(double, name="usr_y")
+    builder.store(function.args[0], y)
+    arithmetic = {'+': builder.fadd, '-': builder.fsub, '*': builder.fmul, '/': builder.fdiv}
+    stack = [(node, [])]
+    while True:
+        node, inputs = stack[-1]
+        if len(inputs) < len(node.children):
+            stack.append((node.children[len(inputs)], []))
+            continue
+        stack.pop()
+        if node.evaluator is tau.builtins.literal:
+            result = ir.Constant(double, float(node.token.data[1]))
+        elif node.evaluator is tau.builtins.name:
+            result = builder.load(y)
+        elif node.evaluator is tau.builtins.power:
+            result = builder.call(pow, inputs)
+        elif node.evaluator is tau.builtins.convert:
+            result = builder.sitofp(inputs[0], double)
+        else:
+            result = arithmetic[node.token.name](*inputs)
+        if not stack:
+            builder.ret(result)
+            return irModule
+        stack[-1][1].append(result)
+
+
+def benchBackends():
+    '''Compares emitting IR as formatted text with llvmlite's IR builder for
+       the same ASTs, including serializing and parsing the IR.'''
+    print "{:>8} {:>10} {:>12} {:>12} {:>12}".format(
+        "terms", "backend", "emit (s)", "str (s)", "parse (s)")
+    llvm.initialize()
+    mod = tau.module.TauModule()
+    mod.localVars['y'] = (tau.dtypes.Real, None)
+    for terms in [10, 100, 1000, 10000]:
+        node = tau.ast.ASTNode(tau.lexer.lex(generatePolynomial(terms)), mod)
+
+        def emitText():
+            del mod.body[:]
+            mod.numRegisters = 0
+            return node.evaluate()
+        emitTime = timeCall(emitText)
+        result = emitText()
+        irCode = "\n".join(["declare double @llvm.pow.f64(double, double)",
+                            "define double @statement(double %arg_y) {",
+                            "entry:", "%usr_y = alloca double",
+                            "store double %arg_y, double* %usr_y"] +
+                           mod.body + ["ret double " + result.addr, "}"])
+        print "{:>8} {:>10} {:>12.5f} {:>12.5f} {:>12.5f}".format(
+            terms, "text", emitTime, timeCall(lambda: str(mod)),
+            timeCall(lambda: llvm.parse_assembly(irCode)))
+        irModule = buildWithIRBuilder(node)
+        irCode = str(irModule)
+        print "{:>8} {:>10} {:>12.5f} {:>12.5f} {:>12.5f}".format(
+            terms, "irbuilder", timeCall(lambda: buildWithIRBuilder(node)),
+            timeCall(lambda: str(irModule)), timeCall(lambda: llvm.parse_assembly(irCode)))
+
+
+def benchStatements():
+    '''Measures the latency of compiling and running single statements in
+       the JIT, split into frontend and emission, conversion to text,
+       LLVM parsing and code generation plus the call.'''
+    jit = tau.TauJIT()
+    jit.runCommand("benchVar = 3.")
+    statements = ["benchVar{} = benchVar*2. + sin(benchVar) - {}.5*benchVar**2".format(i, i)
+                  for i in range(200)]
+    phases = [0., 0., 0., 0.]
+    for statement in statements:
+        times = [time.time()]
+        m = tau.module.TauModule(True)
+        tau.parser.parseTopLevel(m, InputBuffer(statement, True), True)
+        times.append(time.time())
+        irCode = str(m)
+        times.append(time.time())
+        irModule = llvm.parse_assembly(irCode)
+        times.append(time.time())
+        jit.jit.add_module(irModule)
+        m.endScope()
+        m.callIfNeeded(jit.jit)
+        times.append(time.time())
+        for i in range(4):
+            phases[i] += times[i+1] - times[i]
+    print "{:>22} {:>12}".format("phase", "us/statement")
+    for name, total in zip(["frontend and emission", "IR to text", "LLVM parse",
+                            "codegen and call"], phases):
+        print "{:>22} {:>12.1f}".format(name, 1e6 * total / len(statements))
+    print "{:>22} {:>12.1f}".format("total", 1e6 * sum(phases) / len(statements))
+
+
+def benchObjectCache():
+    '''Measures the time to load a library of functions in a new process with
+       a cold and then a warm object cache.'''
+    library = "\n".join(
+        "def Real libFunc{0}(Real x, Int n):\n"
+        "    total = 0.\n"
+        "    for i in range(n):\n"
+        "        total += sin(x*i + {0}.) / (1. + i)\n"
+        "    total".format(i) for i in range(40))
+    script = ("import sys, time, tau\n"
+              "jit = tau.TauJIT(optLevel=2, cacheDir=sys.argv[1])\n"
+              "start = time.time()\n"
+              "jit.runCommand(sys.argv[2])\n"
+              "jit.runCommand('libFunc3(2., 10)')\n"
+              "print time.time() - start, jit.cacheHits, jit.cacheMisses\n")
+    cacheDir = tempfile.mkdtemp()
+    print "{:>8} {:>12} {:>8} {:>8}".format("start", "seconds", "hits", "misses")
+    try:
+        for start in ["cold", "warm"]:
+            output = subprocess.check_output([sys.executable, "-c", script, cacheDir, library])
+            seconds, hits, misses = output.split()
+            print "{:>8} {:>12.4f} {:>8} {:>8}".format(start, float(seconds), hits, misses)
+    finally:
+        shutil.rmtree(cacheDir)
+
+
+def benchBuild():
+    '''Measures the wall time to compile a batch of source files to executables.'''
+    buildDir = tempfile.mkdtemp()
+    nFiles = 20
+    try:
+        filenames = []
+        for i in range(nFiles):
+            filenames.append(os.path.join(buildDir, "build{}.tau".format(i)))
+            with open(filenames[-1], 'w') as f:
+                f.write("def Real buildFunc{0}(Real x, Int n):\n"
+                        "    total = 0.\n"
+                        "    for i in range(n):\n"
+                        "        total += sin(x*i + {0}.) / (1. + i)\n"
+                        "    total\n"
+                        "y = buildFunc{0}(2., 100)\n".format(i))
+        start = time.time()
+        for filename in filenames:
+            tau.compileFile(filename, filename[:-4], quiet=True)
+        elapsed = time.time() - start
+        print "{:>8} {:>12} {:>12}".format("files", "seconds", "s/file")
+        print "{:>8} {:>12.4f} {:>12.4f}".format(nFiles, elapsed, elapsed / nFiles)
+    finally:
+        shutil.rmtree(buildDir)
+
+
+def benchParallel():
+    '''Measures the scaling of parallel for loops (static with a sum, and
+       chunked) in a compiled library over increasing numbers of threads.'''
+    buildDir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(buildDir, "parallel.tau"), 'w') as f:
+            f.write("def Real computePi(Int n):\n"
+                    "    piApprox = 0.\n"
+                    "    parallel for i in range(n) sum(piApprox):\n"
+                    "        piApprox += 4*(-1)**i / (2*i+1)\n"
+                    "    piApprox\n"
+                    "def Real update(Array:Real a, Int n, Int steps):\n"
+                    "    parallel for i in range(n) chunk(1024):\n"
+                    "        x = a[i]\n"
+                    "        for step in range(steps):\n"
+                    "            x = sin(x) + 1.\n"
+                    "        a[i] = x\n"
+                    "    a[0]\n")
+        library = os.path.join(buildDir, "parallel.so")
+        tau.compileFile(os.path.join(buildDir, "parallel.tau"), library, quiet=True)
+        # The thread pool is sized when first used, so each count needs a new process
+        timer = ("import ctypes, time\n"
+                 "lib = ctypes.CDLL({!r})\n"
+                 "lib.computePi.restype = lib.update.restype = ctypes.c_double\n"
+                 "a = (ctypes.c_double*100000)()\n"
+                 "start = time.time()\n"
+                 "lib.computePi(100000000)\n"
+                 "middle = time.time()\n"
+                 "lib.update(a, 100000, 200)\n"
+                 "print middle - start, time.time() - middle\n".format(library))
+        cpus = multiprocessing.cpu_count()
+        counts = sorted(set([2**k for k in range(8) if 2**k <= max(2*cpus, 4)] + [cpus]))
+        print "CPUs: {}".format(cpus)
+        print "{:>8} {:>12} {:>10} {:>12} {:>10}".format("threads", "pi seconds", "speedup",
+                                                         "update s", "speedup")
+        for threads in counts:
+            env = dict(os.environ, TAU_NUM_THREADS=str(threads))
+            output = subprocess.check_output([sys.executable, "-c", timer], env=env)
+            piTime, updateTime = map(float, output.split())
+            if threads == 1:
+                serial = piTime, updateTime
+            print "{:>8} {:>12.4f} {:>10.2f} {:>12.4f} {:>10.2f}".format(
+                threads, piTime, serial[0]/piTime, updateTime, serial[1]/updateTime)
+    finally:
+        shutil.rmtree(buildDir)
+
+
+def benchIncremental():
+    '''Measures rebuilding a large source file after changing one function,
+       with and without the per-function build cache.'''
+    buildDir = tempfile.mkdtemp()
+    sourceFile = os.path.join(buildDir, "kernels.tau")
+    cacheDir = os.path.join(buildDir, "cache")
+
+    def build(scale, cached):
+        with open(sourceFile, 'w') as f:
+            for i in range(100):
+                f.write("def Real kernel{0}(Real x, Int n):\n"
+                        "    total = 0.\n"
+                        "    for i in range(n):\n"
+                        "        total += sin(x*i + {1}.) / (1. + i)\n"
+                        "    total\n".format(i, scale if i == 50 else i))
+            f.write("y = kernel50(2., 100)\n")
+        start = time.time()
+        tau.compileFile(sourceFile, sourceFile[:-4], quiet=True,
+                        cacheDir=cacheDir if cached else None)
+        return time.time() - start
+    try:
+        print "{:>24} {:>12}".format("build", "seconds")
+        print "{:>24} {:>12.4f}".format("whole file", build(1, False))
+        print "{:>24} {:>12.4f}".format("cold cache", build(1, True))
+        print "{:>24} {:>12.4f}".format("one function changed", build(2, True))
+    finally:
+        shutil.rmtree(buildDir)
+
+
+def benchBatch():
+    '''Compares running expressions one at a time with runCommand against
+       compiling them all at once with runBatch.'''
+    expressions = ["24.-23/(5.3/2)*3.", "31. < 8*5.-6.#24234", "453%33. #**2",
+                   "23.**.243", "(23/34*2.3%4.)-3/(3.42-12.)*(True < 3.2)",
+                   "sin(43.**(5.%2.2)) - tan(.2**3)", "5 < 4 and 27 >= 28-1."]
+    print "{:>10} {:>12} {:>14} {:>14}".format("commands", "method", "seconds", "us/command")
+    for n in [10, 100, 1000]:
+        commands = [expressions[i % len(expressions)] for i in range(n)]
+        jit = tau.TauJIT()
+        for method, run in [("runCommand", lambda: [jit.runCommand(c) for c in commands]),
+                            ("runBatch", lambda: jit.runBatch(commands))]:
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            print "{:>10} {:>12} {:>14.4f} {:>14.1f}".format(n, method, elapsed, 1e6*elapsed/n)
+
+
+def benchCalls():
+    '''Compares calling a compiled function through runCommand and through
+       the callable from getFunction, with scalar and array arguments.'''
+    jit = tau.TauJIT()
+    jit.runCommand("def Real callPoly(Real x):\n    1. + x*(2. + x*3.)")
+    jit.runCommand("def Real callSum(Array:Real a, Int n):\n"
+                   "    total = 0.\n"
+                   "    for i in range(n):\n"
+                   "        total += a[i]\n"
+                   "    total")
+    poly = jit.getFunction("callPoly")
+    arraySum = jit.getFunction("callSum")
+    values = array.array('d', range(10))
+    print "{:>36} {:>12}".format("call", "us/call")
+    for label, call in [("runCommand('callPoly(1.5)')", lambda: jit.runCommand("callPoly(1.5)")),
+                        ("getFunction('callPoly')(1.5)", lambda: poly(1.5)),
+                        ("getFunction('callSum')(array, 10)", lambda: arraySum(values, 10))]:
+        print "{:>36} {:>12.2f}".format(label, 1e6*timeCall(call))
+
+
+def benchVectorize():
+    '''Compares mapping a scalar function over an array with the kernel from
+       TauJIT.vectorize, with a per-element Python loop, and with NumPy.'''
+    jit = tau.TauJIT(optLevel=2)
+    jit.runCommand("def Real mapPoly(Real x, Real c):\n    x*x*.5 + 3.*x - c")
+    poly = jit.getFunction("mapPoly")
+    kernel = jit.vectorize("mapPoly")
+    print "{:>10} {:>14} {:>14} {:>14} {:>14}".format("elements", "python ns/el", "loop ns/el",
+                                                     "kernel ns/el", "numpy ns/el")
+    for n in [1000, 100000, 1000000]:
+        values = array.array('d', [i/7. for i in range(n)])
+        out = array.array('d', values)
+        times = [timeCall(lambda: [x*x*.5 + 3.*x - 1. for x in values]),
+                 timeCall(lambda: [poly(x, 1.) for x in values]),
+                 timeCall(lambda: kernel(values, 1., out=out))]
+        if numpy is not None:
+            npValues = numpy.array(values)
+            times.append(timeCall(lambda: npValues*npValues*.5 + 3.*npValues - 1.))
+        row = ["{:>14.2f}".format(1e9*t/n) for t in times]
+        print "{:>10}".format(n), ' '.join(row + ["{:>14}".format("n/a")]*(4 - len(row)))
+    if numpy is None:
+        print "NumPy is not installed, so it was not measured."
+
+
+def benchSIMD():
+    '''Compares a dot product written with scalars against one written with
+       Real4 vectors, with and without optimization.'''
+    n = 2**16
+    values = array.array('d', [i/7. for i in range(n)])
+    print "{:>10} {:>14} {:>14}".format("opt level", "scalar ns/el", "Real4 ns/el")
+    for optLevel in [0, 2]:
+        jit = tau.TauJIT(optLevel=optLevel)
+        jit.runCommand("def Real scalarDot{0}(Array:Real a, Array:Real b, Int n):\n"
+                       "    acc = 0.\n"
+                       "    for i in range(n):\n"
+                       "        acc += a[i]*b[i]\n"
+                       "    acc".format(optLevel))
+        jit.runCommand("def Real vectorDot{0}(Array:Real a, Array:Real b, Int n):\n"
+                       "    acc = Real4(0.)\n"
+                       "    for i in range(n//4):\n"
+                       "        acc += loadUnaligned4(a, 4*i) * loadUnaligned4(b, 4*i)\n"
+                       "    sum(acc)".format(optLevel))
+        # Function names are shared between sessions, so each needs its own
+        times = [timeCall(lambda: jit.getFunction(name + str(optLevel))(values, values, n))
+                 for name in ["scalarDot", "vectorDot"]]
+        print "{:>10} {:>14.3f} {:>14.3f}".format(optLevel, *[1e9*t/n for t in times])
+
+
+def benchBounds():
+    '''Compares summing an array without bounds checks, with them in a loop
+       over range(len(a)) (where they are removed), and with them in a loop
+       over range(n) (where they are not), with and without optimization.'''
+    n = 2**16
+    values = array.array('d', [i/7. for i in range(n)])
+    loops = {"unchecked": "len(a)", "checked": "len(a)", "kept": "n"}
+    print "{:>10} {:>16} {:>16} {:>16}".format("opt level", "unchecked ns/el",
+                                                "checked ns/el", "kept ns/el")
+    for optLevel in [0, 2]:
+        times = []
+        for variant in ["unchecked", "checked", "kept"]:
+            jit = tau.TauJIT(optLevel=optLevel, checkBounds=variant != "unchecked")
+            # Function names are shared between sessions, so each needs its own
+            name = "{}Sum{}".format(variant, optLevel)
+            jit.runCommand("def Real {}(Array:Real a, Int n):\n"
+                           "    acc = 0.\n"
+                           "    for i in range({}):\n"
+                           "        acc += a[i]\n"
+                           "    acc".format(name, loops[variant]))
+            function = jit.getFunction(name)
+            times.append(timeCall(lambda: function(values, n)))
+        print "{:>10} {:>16.3f} {:>16.3f} {:>16.3f}".format(optLevel, *[1e9*t/n for t in times])
+
+
+def benchAliasing():
+    '''Measures elementwise kernels on separate arrays, which LLVM can only
+       vectorize knowing that the array parameters do not alias.'''
+    jit = tau.TauJIT(optLevel=2)
+    jit.runCommand("def Real aliasProduct(Array:Real a, Array:Real b, Array:Real c, Int n):\n"
+                   "    for i in range(n):\n"
+                   "        c[i] = a[i]*b[i]\n"
+                   "    0.")
+    jit.runCommand("def Real aliasSaxpy(Array:Real x, Array:Real y, Real k, Int n):\n"
+                   "    for i in range(n):\n"
+                   "        y[i] = y[i] + k*x[i]\n"
+                   "    0.")
+    product, saxpy = jit.getFunction("aliasProduct"), jit.getFunction("aliasSaxpy")
+    print "{:>10} {:>16} {:>16}".format("elements", "product ns/el", "saxpy ns/el")
+    for n in [1000, 2**16]:
+        a, b, c = [array.array('d', [i/7. for i in range(n)]) for j in range(3)]
+        times = [timeCall(lambda: product(a, b, c, n)), timeCall(lambda: saxpy(a, b, 1.5, n))]
+        print "{:>10} {:>16.3f} {:>16.3f}".format(n, *[1e9*t/n for t in times])
+
+
+def benchArena():
+    '''Measures loops which build a temporary array in every iteration, either
+       from a literal or by size, and pass it to a function.'''
+    jit = tau.TauJIT(optLevel=2)
+    jit.runCommand("def Real arenaNorm(Array:Real v):\n"
+                   "    v[0]*v[0] + v[1]*v[1] + v[2]*v[2]\n"
+                   "def Real arenaLiterals(Int n):\n"
+                   "    acc = 0.\n"
+                   "    for i in range(n):\n"
+                   "        acc += arenaNorm([i*1., 2., 3.])\n"
+                   "    acc")
+    jit.runCommand("def Real arenaFill(Array:Real v):\n"
+                   "    for i in range(len(v)):\n"
+                   "        v[i] = i*1.\n"
+                   "    v[len(v)-1]\n"
+                   "def Real arenaBlocks(Int n, Int size):\n"
+                   "    acc = 0.\n"
+                   "    for i in range(n):\n"
+                   "        acc += arenaFill(Real[size])\n"
+                   "    acc")
+    literals, blocks = jit.getFunction("arenaLiterals"), jit.getFunction("arenaBlocks")
+    n = 10000
+    print "{:>12} {:>10}".format("temporary", "ns/iter")
+    print "{:>12} {:>10.1f}".format("literal", 1e9*timeCall(lambda: literals(n))/n)
+    for size in [16, 256, 4096]:
+        print "{:>12} {:>10.1f}".format("Real[{}]".format(size),
+                                        1e9*timeCall(lambda: blocks(n, size))/n)
+
+
+def benchStack():
+    '''Measures loops which keep a small array in a local variable, or pass
+       one to a function, in every iteration.'''
+    jit = tau.TauJIT(optLevel=2)
+    jit.runCommand("def Real stackLocal(Int n):\n"
+                   "    acc = 0.\n"
+                   "    for i in range(n):\n"
+                   "        v = [i*1., 2., 3.]\n"
+                   "        acc += v[0]*v[1] + v[2]\n"
+                   "    acc")
+    jit.runCommand("def Real stackDot(Array:Real a, Array:Real b):\n"
+                   "    a[0]*b[0] + a[1]*b[1] + a[2]*b[2]\n"
+                   "def Real stackArgument(Int n):\n"
+                   "    acc = 0.\n"
+                   "    for i in range(n):\n"
+                   "        acc += stackDot([i*1., 2., 3.], [1., i*1., 0.5])\n"
+                   "    acc")
+    n = 10000
+    print "{:>10} {:>10}".format("array", "ns/iter")
+    for kind in ["Local", "Argument"]:
+        function = jit.getFunction("stack" + kind)
+        print "{:>10} {:>10.1f}".format(kind.lower(), 1e9*timeCall(lambda: function(n))/n)
+
+
+def benchMemoryTracking():
+    '''Compares a loop which allocates and frees an array in every iteration
+       with and without memory tracking.'''
+    print "{:>10} {:>16} {:>16}".format("elements", "untracked ns/it", "tracked ns/it")
+    n = 10000
+    sizes = [16, 4096]
+    times = timeOption('trackMemory',
+                       "def Real {0}Loop(Int n, Int size):\n"
+                       "    acc = 0.\n"
+                       "    for i in range(n):\n"
+                       "        v = Real[size]\n"
+                       "        v[0] = i*1.\n"
+                       "        acc += v[0]\n"
+                       "        free(v)\n"
+                       "    acc", [("Loop", (n, size)) for size in sizes])
+    for size, pair in zip(sizes, times):
+        print "{:>10} {:>16.1f} {:>16.1f}".format(size, *[1e9*t/n for t in pair])
+
+
+def benchProfiling():
+    '''Compares a loop calling a small function with and without profiling,
+       which gives the cost of counting each call.'''
+    print "{:>10} {:>16} {:>16}".format("body", "plain ns/call", "profiled ns/call")
+    n = 100000
+    bodies = ["Square", "Poly"]
+    times = timeOption('profile',
+                       "def Real {0}Square(Real x):\n"
+                       "    x*x\n"
+                       "def Real {0}Poly(Real x):\n"
+                       "    y = 0.\n"
+                       "    for j in range(50):\n"
+                       "        y = y*x + j\n"
+                       "    y\n" +
+                       "".join("def Real {{0}}Calls{0}(Int n):\n"
+                               "    acc = 0.\n"
+                               "    for i in range(n):\n"
+                               "        acc += {{0}}{0}(i*0.5)\n"
+                               "    acc\n".format(body) for body in bodies),
+                       [("Calls" + body, (n,)) for body in bodies])
+    for body, pair in zip(bodies, times):
+        print "{:>10} {:>16.1f} {:>16.1f}".format(body, *[1e9*t/n for t in pair])
+
+
+# The numerical kernels timed by benchKernels, in Tau, where {0} makes the names unique to
+# each session, and the same kernels in Python and (where it applies) NumPy
+kernelSource = """
+def Int kernelFibb{0}(Int lim):
+    a = 0
+    b = 1
+    temp = 0
+    while a < lim:
+        temp = a + b
+        b = a
+        a = temp
+    a
+def Real kernelComputePi{0}(Int n):
+    piApprox = 0.
+    for i in range(n):
+        piApprox += 4*(-1)**i / (2*i+1)
+    piApprox
+def Real kernelSum{0}(Array:Real a):
+    acc = 0.
+    for i in range(len(a)):
+        acc += a[i]
+    acc
+def Real kernelDot{0}(Array:Real a, Array:Real b):
+    acc = 0.
+    for i in range(len(a)):
+        acc += a[i]*b[i]
+    acc
+def Int kernelSaxpy{0}(Real alpha, Array:Real x, Array:Real y):
+    for i in range(len(y)):
+        y[i] = alpha*x[i] + y[i]
+    len(y)
+def Int kernelStencil{0}(Array:Real u, Array:Real v):
+    for i in range(len(u) - 2):
+        v[i+1] = (u[i] + u[i+1] + u[i+2]) / 3.
+    len(v)
+def Int kernelMatmul{0}(Array:Real a, Array:Real b, Array:Real c, Int n):
+    for i in range(n):
+        for j in range(n):
+            acc = 0.
+            for k in range(n):
+                acc += a[i*n + k]*b[k*n + j]
+            c[i*n + j] = acc
+    n
+"""
+
+
+def pythonFibb(lim):
+    a, b = 0, 1
+    while a < lim:
+        a, b = a + b, a
+    return a
+
+
+def pythonComputePi(n):
+    piApprox = 0.
+    for i in range(n):
+        piApprox += 4*(-1)**i / (2*i+1)
+    return piApprox
+
+
+def pythonSum(a):
+    acc = 0.
+    for x in a:
+        acc += x
+    return acc
+
+
+def pythonDot(a, b):
+    acc = 0.
+    for i in range(len(a)):
+        acc += a[i]*b[i]
+    return acc
+
+
+def pythonSaxpy(alpha, x, y):
+    for i in range(len(y)):
+        y[i] = alpha*x[i] + y[i]
+    return len(y)
+
+
+def pythonStencil(u, v):
+    for i in range(len(u) - 2):
+        v[i+1] = (u[i] + u[i+1] + u[i+2]) / 3.
+    return len(v)
+
+
+def pythonMatmul(a, b, c, n):
+    for i in range(n):
+        for j in range(n):
+            acc = 0.
+            for k in range(n):
+                acc += a[i*n + k]*b[k*n + j]
+            c[i*n + j] = acc
+    return n
+
+
+def numpyComputePi(n):
+    i = numpy.arange(n)
+    return (4.*(1 - 2*(i % 2)) / (2*i + 1)).sum()
+
+
+def numpySaxpy(alpha, x, y):
+    y += alpha*x
+    return len(y)
+
+
+def numpyStencil(u, v):
+    v[1:-1] = (u[:-2] + u[1:-1] + u[2:]) / 3.
+    return len(v)
+
+
+def numpyMatmul(a, b, c, n):
+    c[:] = numpy.dot(a.reshape(n, n), b.reshape(n, n)).ravel()
+    return n
+
+
+def kernelArguments(newArray):
+    '''Returns the arguments of each kernel, with arrays made from lists by
+       newArray, and the indices of those it writes.'''
+    n, size = 100000, 48
+    values = [i/7. for i in range(n)]
+    square = [(i % 13)/5. for i in range(size*size)]
+    return {'fibb': ([10**9], []),
+            'computePi': ([n], []),
+            'sum': ([newArray(values)], []),
+            'dot': ([newArray(values), newArray(values[::-1])], []),
+            'saxpy': ([.5, newArray(values), newArray([1.]*n)], [2]),
+            'stencil': ([newArray(values), newArray([0.]*n)], [1]),
+            'matmul': ([newArray(square), newArray(square[::-1]), newArray([0.]*size**2),
+                        size], [2])}
+
+
+def loadLibrary(source, library, suffix):
+    '''Compiles Tau source to a shared library with compileFile and returns
+       callables for its functions, by name less the suffix.'''
+    sourceFile = library[:-3] + ".tau"
+    with open(sourceFile, 'w') as f:
+        f.write(source)
+    tau.compileFile(sourceFile, library, quiet=True)
+    handle = ctypes.CDLL(library)
+    functions = {}
+    for line in source.splitlines():
+        if line.startswith("def "):
+            name, dtype, args = tau.parser.functionSignature(tau.lexer.lex(line))
+            address = ctypes.cast(getattr(handle, name), ctypes.c_void_p).value
+            # Every array may be written, which only adds checks that they do not overlap
+            functions[name[:-len(suffix)]] = tau.functionHandle.getCallable(
+                address, name, dtype, args, [True]*len(args))
+    return functions
+
+
+def benchKernels():
+    '''Times numerical kernels (the fibb and computePi examples of the readme,
+       an array sum, dot product, saxpy, three-point stencil and matrix
+       multiply) in the JIT without optimization and at -O3, compiled ahead of
+       time by compileFile at -O3, and in Python and NumPy.  Checks that the
+       results agree, and returns the seconds per call of each kernel in each
+       mode.'''
+    names = ['fibb', 'computePi', 'sum', 'dot', 'saxpy', 'stencil', 'matmul']
+    modes = ['jit-O0', 'jit-O3', 'aot-O3', 'python', 'numpy']
+    # The sessions and libraries must outlive the functions compiled in them
+    sessions = []
+    functions = {}
+    for mode, optLevel in [('jit-O0', 0), ('jit-O3', 3)]:
+        sessions.append(tau.TauJIT(optLevel=optLevel))
+        suffix = mode[-2:]
+        sessions[-1].runCommand(kernelSource.format(suffix))
+        for name in names:
+            kernelName = "kernel{}{}{}".format(name[0].upper(), name[1:], suffix)
+            functions[mode, name] = sessions[-1].getFunction(kernelName)
+    buildDir = tempfile.mkdtemp()
+    try:
+        library = loadLibrary(kernelSource.format("Aot"), os.path.join(buildDir, "kernels.so"),
+                              "Aot")
+    finally:
+        shutil.rmtree(buildDir)
+    for name in names:
+        functions['aot-O3', name] = library["kernel{}{}".format(name[0].upper(), name[1:])]
+        functions['python', name] = globals()["python{}{}".format(name[0].upper(), name[1:])]
+    if numpy is not None:
+        functions.update({('numpy', 'computePi'): numpyComputePi,
+                          ('numpy', 'sum'): numpy.sum,
+                          ('numpy', 'dot'): numpy.dot,
+                          ('numpy', 'saxpy'): numpySaxpy,
+                          ('numpy', 'stencil'): numpyStencil,
+                          ('numpy', 'matmul'): numpyMatmul})
+    newArrays = {'numpy': lambda values: numpy.array(values)}
+    results = dict((name, {}) for name in names)
+    print "{:>10}".format("us/call"), ' '.join("{:>10}".format(mode) for mode in modes)
+
+    def run(mode, name):
+        '''Returns the arguments of a kernel for a mode, and the result of one
+           call along with the sums of the arrays it writes.'''
+        args, written = kernelArguments(newArrays.get(mode, lambda v: array.array('d', v)))[name]
+        return args, [functions[mode, name](*args)] + [sum(args[i]) for i in written]
+    for name in names:
+        row = []
+        expected = run('python', name)[1]
+        for mode in modes:
+            if (mode, name) not in functions:
+                row.append("{:>10}".format("n/a"))
+                continue
+            function = functions[mode, name]
+            args, result = run(mode, name)
+            if any(abs(r - e) > 1e-9*abs(e) for r, e in zip(result, expected)):
+                raise ValueError("ERROR: {} gives {} in {}, but {} in Python."
+                                 .format(name, result, mode, expected))
+            # The best of a few runs, to be less sensitive to noise when comparing runs
+            results[name][mode] = min(timeCall(lambda: function(*args), 0.1) for i in range(3))
+            row.append("{:>10.2f}".format(1e6*results[name][mode]))
+        print "{:>10}".format(name), ' '.join(row)
+    if numpy is None:
+        print "NumPy is not installed, so it was not measured."
+    return results
+
+
+def compareResults(oldFile, newFile, threshold):
+    '''Compares the times in two JSON files written with --json, printing
+       each and flagging those that grew by more than the threshold (as a
+       fraction).  Returns the number of regressions.'''
+    with open(oldFile) as f:
+        old = json.load(f)
+    with open(newFile) as f:
+        new = json.load(f)
+
+    def flatten(results, prefix=""):
+        times = {}
+        for key, value in results.items():
+            if isinstance(value, dict):
+                times.update(flatten(value, prefix + key + "/"))
+            else:
+                times[prefix + key] = value
+        return times
+    old, new = flatten(old), flatten(new)
+    regressions = 0
+    print "{:<32} {:>12} {:>12} {:>8}".format("measurement", "old", "new", "ratio")
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / old[key] if old[key] else float('inf')
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif ratio < 1 / (1 + threshold):
+            flag = "  improved"
+        print "{:<32} {:>12.4g} {:>12.4g} {:>8.3f}{}".format(key, old[key], new[key], ratio,
+                                                            flag)
+    for key in sorted(set(old) ^ set(new)):
+        print "{:<32} only in {}".format(key, oldFile if key in old else newFile)
+    print "{} regression(s) over {:.0%}.".format(regressions, threshold)
+    return regressions
+
+
+benchmarks = {
+    'aliasing': benchAliasing,
+    'arena': benchArena,
+    'backends': benchBackends,
+    'batch': benchBatch,
+    'bounds': benchBounds,
+    'build': benchBuild,
+    'calls': benchCalls,
+    'cache': benchObjectCache,
+    'emission': benchEmission,
+    'incremental': benchIncremental,
+    'kernels': benchKernels,
+    'memory': benchFrontendMemory,
+    'lexer': benchLexer,
+    'nesting': benchNesting,
+    'optimizer': benchOptimizer,
+    'parallel': benchParallel,
+    'parser': benchParser,
+    'profile': benchProfiling,
+    'simd': benchSIMD,
+    'stack': benchStack,
+    'statements': benchStatements,
+    'tracking': benchMemoryTracking,
+    'vectorize': benchVectorize,
+}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Runs performance benchmarks for Tau.")
+    ap.add_argument(
+        "names",
+        nargs='*',
+        help="The benchmarks to run; if absent, run all of them.")
+    ap.add_argument(
+        "--json",
+        help="Write the results of the benchmarks which return them (like kernels) to this "
+             "file as JSON.")
+    ap.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="Instead of running benchmarks, compare two files written with --json, and exit "
+             "with status 1 if any time grew by more than the threshold.")
+    ap.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="The fraction by which a time must grow to count as a regression (default 0.1).")
+    args = ap.parse_args()
+    if args.compare:
+        sys.exit(1 if compareResults(args.compare[0], args.compare[1], args.threshold) else 0)
+    results = {}
+    for benchName in args.names or sorted(benchmarks.keys()):
+        print "===== {} =====".format(benchName)
+        result = benchmarks[benchName]()
+        if result is not None:
+            results[benchName] = result
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, separators=(',', ': '), sort_keys=True)
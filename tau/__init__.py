@@ -1,8 +1,12 @@
 import ast
 import builtins
 import dtypes
+import functionHandle
 import lexer
 import module
+import objectCache
+import phases
+import runtime
 from parser import compileFile, TauJIT
 
 __all__ = [
@@ -11,6 +15,10 @@ __all__ = [
     'ast',
     'builtins',
     'dtypes',
+    'functionHandle',
     'lexer',
-    'module'
+    'module',
+    'objectCache',
+    'phases',
+    'runtime'
 ]
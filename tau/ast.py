@@ -4,32 +4,48 @@ import builtins
 import lexer
 
 
-class ASTNode():
+assignmentOperators = ['=', '+=', '-=', '/=', '//=', '**=', '*=', '%=']
+prefixOperators = ['print', 'unary +', 'unary -'] + assignmentOperators
+binaryOperators = ['and', 'or', 'xor', '-', '+', '%', '*', '//',
+                   '/', '**', '<=', '>=', '<', '>', '!=', '==']
+
+
+class ASTNode(object):
+    __slots__ = ('module', 'children', 'dtype', 'token', 'evaluator', 'line', 'start', 'end')
+
     def __init__(self, tokens, module):
         # Keep reference to parent module
         self.module = module
         self.children = []
         self.dtype = None
+        self.line, self.start, self.end = lexer.span(tokens)
         if tokens is None:
             return
-        # Find the token of lowest precedence
-        index, self.token = min(enumerate(tokens[::-1]), key=lambda t: t[1].precedence)
-        index = len(tokens) - index - 1
-        leftTokens, rightTokens = tokens[:index], tokens[index+1:]
-        if module.debugAST:
+        # Parse the tokens and take on the contents of the resulting root node
+        root = ExpressionParser(tokens, module).parseAll()
+        self.token, self.children, self.dtype = root.token, root.children, root.dtype
+        self.evaluator = root.evaluator
+        self.line, self.start, self.end = root.line, root.start, root.end
+        return
+
+    def build(self, left=None, right=None):
+        '''Constructs the node according to its token, given the nodes for the
+           left and right operands of operators.'''
+        if self.module.debugAST:
             sys.stderr.write("AST: "+self.token.name+', ' + str(self.token.data)+"\n")
-        # Now, construct the node according to the operator found
+        self.line = self.token.line
+        self.start = (left or self.token).start
+        self.end = (right or self.token).end
         if self.token.name == "print":
-            assertEmpty(leftTokens)
-            self.children = [ASTNode(rightTokens, self.module)]
-        elif self.token.name in ['=', '+=', '-=', '/=', '//=', '**=', '*=', '%=']:
+            self.children = [right]
+        elif self.token.name in assignmentOperators:
             # Assignment operator and variants
             if self.token.name != '=':
                 # Handle extra operation
                 if type(self.token.data) is list:
-                    left = self.token.data
+                    target = ASTNode(self.token.data, self.module)
                 else:
-                    left = [lexer.NameToken('name', self.token.data)]
+                    target = newNode(lexer.NameToken('name', self.token.data), self.module)
                 # TODO: replace this ugly hack with a proper builtin function
                 TokenType = {
                     '+=': lexer.BinaryPlusToken,
@@ -39,33 +55,36 @@ class ASTNode():
                     '**=': lexer.ExponentToken,
                     '*=': lexer.MultiplyFamilyToken,
                     '%=': lexer.MultiplyFamilyToken}[self.token.name]
-                rightTokens = left + [TokenType(self.token.name[:-1]),
-                                      lexer.ParensToken('()', rightTokens)]
+                grouped = ASTNode(None, self.module)
+                grouped.token = lexer.ParensToken('()')
+                grouped.children = [right]
+                grouped.dtype = right.dtype
+                grouped.resolveTyping()
+                right = newNode(TokenType(self.token.name[:-1]), self.module, target, grouped)
                 self.token.name = '='
             if type(self.token.data) is list:
                 # Array indexing assignment
                 self.children = [
                     ASTNode(self.token.data[:-1], self.module),
                     ASTNode(self.token.data[-1].data, self.module).castTo(dtypes.Int),
-                    ASTNode(rightTokens, self.module)]
+                    right]
+                if not hasattr(self.children[0].dtype, "subtype"):
+                    raise ValueError("ERROR: Cannot assign to elements of type {}."
+                                     .format(self.children[0].dtype.name))
                 self.children[-1] = self.children[-1].castTo(self.children[0].dtype.subtype)
                 self.token.name = "index="
             else:
                 # Regular old variable assignment
-                self.children = [ASTNode(rightTokens, self.module)]
-        elif self.token.name in ['and', 'or', 'xor', '-', '+', '%', '*', '//',
-                                 '/', '**', '<=', '>=', '<', '>', '!=', '==']:
+                self.children = [right]
+        elif self.token.name in binaryOperators:
             # Binary operators!
-            self.children = [ASTNode(t, self.module) for t in [leftTokens, rightTokens]]
+            self.children = [left, right]
         elif self.token.name in ["unary +", "unary -"]:
-            assertEmpty(leftTokens)
-            self.children = [ASTNode(rightTokens, self.module)]
+            self.children = [right]
             self.dtype = self.children[0].dtype
         elif self.token.name == "literal":
-            assertEmpty(leftTokens, rightTokens)
             self.dtype = self.token.data[0]
         elif self.token.name == "function":
-            assertEmpty(leftTokens, rightTokens)
             caller, data = self.token.data
             if caller in builtins.catalog.keys():
                 # Known builtin disguised as a function
@@ -78,8 +97,8 @@ class ASTNode():
                 self.dtype, args = self.module.userFunctions[caller]
                 self.children = [ASTNode(t, self.module).castTo(a[0])
                                  for t, a in zip(splitArguments(data), args)]
-            elif caller in dtypes.baseTypes:
-                # Explicit type cast
+            elif caller in dtypes.baseTypes or caller in dtypes.vectorTypes.keys():
+                # Explicit type cast (or for vector types, a splat)
                 self.token.name = "()"
                 self.children = [ASTNode(data, self.module).castTo(dtypes.getType(caller), True)]
                 self.dtype = self.children[0].dtype
@@ -89,19 +108,15 @@ class ASTNode():
                 self.dtype = self.children[0].dtype
             self.token.data = [caller, self.dtype]
         elif self.token.name == '()':
-            assertEmpty(leftTokens, rightTokens)
-            self.token.name = "()"
             self.children = [ASTNode(self.token.data, self.module)]
             self.dtype = self.children[0].dtype
         elif self.token.name == "name":
-            assertEmpty(leftTokens, rightTokens)
             self.dtype = type(self.module.getVariable(self.token.data, True))
         elif self.token.name == "indexing":
-            assertEmpty(rightTokens)
-            self.children = [ASTNode(i, self.module) for i in [leftTokens, self.token.data]]
+            self.children = [left, ASTNode(self.token.data, self.module)]
         elif self.token.name == "array":
-            assertEmpty(leftTokens, rightTokens)
             self.children = [ASTNode(self.token.data[1], self.module)]
+            self.dtype = dtypes.Array(dtypes.getType(self.token.data[0]))
         elif self.token.name == "literalArray":
             self.children = [ASTNode(t, self.module) for t in splitArguments(self.token.data)]
             self.dtype = self.children[0].dtype
@@ -120,34 +135,79 @@ class ASTNode():
         if name in catalog.keys() and type(catalog[name]) is not dict:
             self.evaluator = catalog[name]
             return
-        argTypes = [i.dtype for i in self.children]
-        best, bestArgs, cost = None, [], 9999999
-        for candidate in catalog[name]:
-            candidateCost = 0
-            candidateArgs = candidate.split(' ')
-            if len(candidateArgs) != len(argTypes):
-                continue
-            try:
-                for a, ca in zip(argTypes, candidateArgs):
-                    candidateCost += a.casting.index(ca)
-            except ValueError:
-                continue
-            if candidateCost < cost:
-                best, bestArgs, cost = candidate, candidateArgs, candidateCost
-            elif candidateCost == cost:
-                raise ValueError("ERROR: Tie for overload resolution of token '{}' with types {}"
-                                 .format(self.token.name, argTypes))
-        if best is None:
+        argTypes = tuple(i.dtype for i in self.children)
+        resolution = resolveOverload(catalog, name, argTypes)
+        if resolution == "tie":
+            raise ValueError("ERROR: Tie for overload resolution of token '{}' with types {}"
+                             .format(self.token.name, list(argTypes)))
+        elif resolution is None:
             raise ValueError("No valid candidates for token '{}' with types {}"
                              .format(name, [i.name for i in argTypes]))
         # We've found the best candidate, record findings to self
-        self.evaluator, self.dtype = catalog[name][best]
-        self.children = [i.castTo(dtypes.getType(j)) for i, j in zip(self.children, bestArgs)]
+        self.evaluator, self.dtype, bestArgs = resolution
+        self.children = [i.castTo(j) for i, j in zip(self.children, bestArgs)]
         return
 
     def evaluate(self):
-        inputs = [i.evaluate() for i in self.children]
-        return self.evaluator(inputs, self.token, self.module)
+        '''Emits the IR for the tree rooted at this node and returns the result.
+           Nodes are visited in post-order with an explicit stack, calling the
+           evaluators in the same order as evaluating each child in turn.'''
+        # Nodes being evaluated, each with the results of its children so far
+        stack = [(self, [])]
+        while True:
+            node, inputs = stack[-1]
+            if len(inputs) < len(node.children):
+                stack.append((node.children[len(inputs)], []))
+                continue
+            stack.pop()
+            result = node.evaluator(inputs, node.token, node.module)
+            if not stack:
+                return result
+            stack[-1][1].append(result)
+
+    def simplify(self):
+        '''Returns an equivalent tree in which subtrees of constants are folded
+           into single literals and operations that leave their operand
+           unchanged (like x*1) are removed.  Children are simplified before
+           their parents without recursion.'''
+        # List the nodes so that every node comes before its descendants
+        order = [self]
+        i = 0
+        while i < len(order):
+            order += order[i].children
+            i += 1
+        replacements = {}
+        for node in reversed(order):
+            node.children = [replacements.get(id(c), c) for c in node.children]
+            simpler = node.simplifyNode()
+            if simpler is not node:
+                replacements[id(node)] = simpler
+        return replacements.get(id(self), self)
+
+    def simplifyNode(self):
+        '''Returns a literal node if this node can be computed at compile time,
+           the operand it reduces to if it is an identity, or otherwise itself.'''
+        if self.evaluator is builtins.parentheses:
+            return self.children[0]
+        constantEvaluator = builtins.constantEvaluators.get(self.evaluator)
+        if constantEvaluator is None:
+            return self
+        values = [constantValue(c) for c in self.children]
+        if None not in values:
+            try:
+                value = constantEvaluator(values, [c.dtype for c in self.children], self.token)
+            except (ArithmeticError, ValueError):
+                value = None
+            if value is not None:
+                return literalNode(self.module, self.dtype, value, self)
+        # Operations with an identity constant on either side reduce to the other side
+        if len(values) == 2 and self.dtype in identities:
+            leftIdentity, rightIdentity = identities[self.dtype].get(self.token.name, (None, None))
+            if values[0] is not None and values[0] == leftIdentity:
+                return self.children[1]
+            elif values[1] is not None and values[1] == rightIdentity:
+                return self.children[0]
+        return self
 
     def castTo(self, dtype, force=False):
         if self.dtype == dtype:
@@ -160,13 +220,151 @@ class ASTNode():
             raise ValueError("ERROR: Won't automatically convert type {} to type {}."
                              .format(self.dtype, dtype))
         converterNode = ASTNode(None, self.module)
+        self.module.stats.counts['astNodes'] += 1
         converterNode.token = lexer.Token("Convert", dtype)
         converterNode.children = [self]
         converterNode.dtype = dtype
         converterNode.evaluator = builtins.convert
+        converterNode.line, converterNode.start, converterNode.end = self.line, self.start, self.end
         return converterNode
 
 
+class ExpressionParser(object):
+    '''Builds an AST from a list of tokens in one pass by precedence climbing.
+       Binary operators are left-associative and prefix operators take as their
+       operand everything to their right that binds more tightly, so the tree is
+       the same as that from splitting at the rightmost lowest-precedence token.'''
+    def __init__(self, tokens, module):
+        self.tokens = tokens
+        self.module = module
+        self.pos = 0
+
+    def parseAll(self):
+        '''Parses every token, returning the root node.'''
+        root = self.parseExpression(-1)
+        assertEmpty(self.tokens[self.pos:])
+        return root
+
+    def parseExpression(self, limit):
+        '''Parses tokens from the current position onward until reaching an
+           operator with precedence no greater than limit.'''
+        if self.pos == len(self.tokens):
+            raise ValueError("ERROR: Expression ended unexpectedly.")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        if token.name in prefixOperators:
+            # Something to the left would bind more weakly than the prefix operator
+            if token.precedence <= limit:
+                assertEmpty(self.tokens[:self.pos-1])
+            left = newNode(token, self.module, None, self.parseExpression(token.precedence))
+        else:
+            left = newNode(token, self.module)
+        while self.pos < len(self.tokens):
+            token = self.tokens[self.pos]
+            if token.precedence <= limit:
+                break
+            elif token.name == "indexing":
+                self.pos += 1
+                left = newNode(token, self.module, left)
+            elif token.name in binaryOperators:
+                self.pos += 1
+                left = newNode(token, self.module, left, self.parseExpression(token.precedence))
+            else:
+                break
+        return left
+
+
+def overloadIndex(catalog, name):
+    '''Returns the typed overloads of name in catalog as a list of (argument
+       types, evaluator, return type), in the order they are searched.  The
+       list is built once per entry of the builtin catalog.'''
+    if catalog is builtins.catalog and name in _overloadIndices:
+        return _overloadIndices[name]
+    index = [(tuple(dtypes.getType(t) for t in candidate.split(' ')), evaluator, retType)
+             for candidate, (evaluator, retType) in catalog[name].items()]
+    if catalog is builtins.catalog:
+        _overloadIndices[name] = index
+    return index
+
+
+def castingCosts(dtype):
+    '''Returns a dict of the cost of implicitly casting dtype to each type it can be cast to.'''
+    if dtype not in _castingCosts:
+        _castingCosts[dtype] = {name: cost for cost, name in enumerate(dtype.casting)}
+    return _castingCosts[dtype]
+
+
+def resolveOverload(catalog, name, argTypes):
+    '''Finds the cheapest overload of name in catalog for a tuple of argument
+       types.  Returns (evaluator, return type, argument types to cast to), or
+       "tie" or None when there is no unique best candidate.  Results are cached
+       for the builtin catalog.'''
+    # Other catalogs may be freed, and a new one given the same id, so they are not cached
+    cached = catalog is builtins.catalog
+    key = (name, argTypes)
+    if cached and key in _resolutionCache:
+        return _resolutionCache[key]
+    costs = [castingCosts(a) for a in argTypes]
+    best, cost = None, 9999999
+    for candidateArgs, evaluator, retType in overloadIndex(catalog, name):
+        if len(candidateArgs) != len(argTypes):
+            continue
+        try:
+            candidateCost = sum(c[ca.name] for c, ca in zip(costs, candidateArgs))
+        except KeyError:
+            continue
+        if candidateCost < cost:
+            best, cost = (evaluator, retType, candidateArgs), candidateCost
+        elif candidateCost == cost:
+            best = "tie"
+            break
+    if cached:
+        _resolutionCache[key] = best
+    return best
+
+
+_overloadIndices = {}
+_castingCosts = {}
+_resolutionCache = {}
+
+
+def constantValue(node):
+    '''Returns the value of a literal node as a Python constant, or None if
+       the node is not a literal or its value is not a valid constant.'''
+    if node.evaluator is not builtins.literal:
+        return None
+    dtype, value = node.token.data
+    if dtype is dtypes.Bool:
+        return value == 'true'
+    elif dtype is dtypes.Int and not dtypes.intMin <= value <= dtypes.intMax:
+        return None
+    return value
+
+
+def literalNode(module, dtype, value, replacing):
+    '''Creates a literal node holding a Python constant, with the source span
+       of the node it replaces.'''
+    if dtype is dtypes.Bool:
+        value = 'true' if value else 'false'
+    return newNode(lexer.Token("literal", (dtype, value), replacing.line,
+                               replacing.start, replacing.end), module)
+
+
+# Constants which leave the other operand unchanged, as (left identity, right identity)
+identities = {
+    dtypes.Int: {'+': (0, 0), '-': (None, 0), '*': (1, 1), '//': (None, 1)},
+    dtypes.Real: {'*': (1., 1.), '/': (None, 1.), '**': (None, 1.)}}
+
+
+def newNode(token, module, left=None, right=None):
+    '''Creates a node for the given token and operand nodes.'''
+    node = ASTNode(None, module)
+    module.stats.counts['astNodes'] += 1
+    node.token = token
+    node.build(left, right)
+    return node
+
+
 def assertEmpty(left, right=[]):
     if left or right:
         raise ValueError("ERROR: Unexpected tokens {}".format(left+right))
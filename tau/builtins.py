@@ -1,4 +1,5 @@
 import re
+import math
 import dtypes
 
 
@@ -8,8 +9,11 @@ def freeMemory(inputs, token, mod):
         raise ValueError("Free must be given exactly one variable name.")
     allocID = mod.getAllocID(token.data[1][0].data, True)
     var = name(inputs, token.data[1][0], mod)
+    # Arrays on the stack are moved to the heap to be freed
+    mod.escapes(var)
     freeThis = mod.newRegister()
-    mod.out += ["{} = bitcast {} {} to i8*".format(freeThis, var.irname, var.addr)]
+    mod.out += ["{} = bitcast {}* {} to i8*".format(freeThis, var.subtype.irname,
+                                                   _arrayData_(var, mod))]
     mod.freeMemory(allocID, freeThis)
     return None
 
@@ -17,21 +21,53 @@ def freeMemory(inputs, token, mod):
 def callFunction(inputs, token, mod):
     funcName, dtype = token.data
     result = dtype(mod.newRegister())
-    argTypes = ", ".join([i.irname for i in inputs])
-    mod.ensureDeclared(funcName, 'declare {} @{}({})'.format(result.irname, funcName, argTypes))
-    arguments = ", ".join([i.irname+" "+i.addr for i in inputs])
-    mod.out += ["{} = call {} @{}({})".format(result.addr, result.irname, funcName, arguments)]
+    if funcName in mod.userFunctions:
+        pointsTo = mod.callArrays(funcName, mod.userFunctions[funcName][1], inputs)
+    else:
+        # Anything may happen to the arrays given to functions defined elsewhere
+        pointsTo = set()
+        for i in inputs:
+            pointsTo |= mod.pointsTo.get(i.addr, set())
+            mod.escapes(i)
+        mod.arrayWrites |= pointsTo
+        mod.capturesArrays = mod.capturesArrays or any(hasattr(i, 'subtype') for i in inputs)
+    if hasattr(result, 'subtype'):
+        mod.pointsTo[result.addr] = pointsTo
+        mod.capturesArrays = True
+    # Arrays are passed as their data pointer and length
+    argTypes, arguments = [], []
+    for i in inputs:
+        if hasattr(i, 'subtype'):
+            length = mod.newRegister()
+            mod.out += ["{} = extractvalue {} {}, 1".format(length, i.irname, i.addr)]
+            argTypes += [i.subtype.irname+'*', 'i32']
+            arguments += [i.subtype.irname+'* '+_arrayData_(i, mod), 'i32 '+length]
+        else:
+            argTypes.append(i.irname)
+            arguments.append(i.irname+" "+i.addr)
+    mod.ensureDeclared(funcName, 'declare {} @{}({})'.format(result.irname, funcName,
+                                                           ", ".join(argTypes)))
+    mod.out += ["{} = call {} @{}({})".format(result.addr, result.irname, funcName,
+                                             ", ".join(arguments))]
     return result
 
 
 def literal(inputs, token, mod):
-    return token.data[0](str(token.data[1]))
+    dtype, value = token.data
+    if dtype is dtypes.Real:
+        return dtype(dtypes.formatReal(value))
+    return dtype(str(value))
 
 
 def name(inputs, token, mod):
     var = mod.getVariable(token.data, True)
     result = type(var)(mod.newRegister())
     mod.out += ["{} = load {}, {}* {}".format(result.addr, result.irname, result.irname, var.addr)]
+    mod.loadedFrom[result.addr] = token.data
+    if hasattr(var, 'subtype'):
+        mod.pointsTo[result.addr] = set([token.data]) | mod.aliasesOf(token.data)
+        if var.addr.startswith('@'):
+            mod.arrayGlobals.add(token.data)
     return result
 
 
@@ -47,11 +83,11 @@ def convert(inputs, token, mod):
 
 def indexingAssignment(inputs, token, mod):
     arr, index, right = inputs
-    sub = arr.subtype
-    elem = mod.newRegister()
-    mod.out += ["{} = getelementptr {}, {}* {}, i32 {}"
-                .format(elem, sub.irname, sub.irname, arr.addr, index.addr)]
-    mod.out += ["store {} {}, {}* {}".format(right.irname, right.addr, sub.irname, elem)]
+    if mod.checkBounds:
+        mod.checkIndex(arr, index)
+    mod.arrayWrites |= mod.pointsTo.get(arr.addr, set())
+    elem = _elementPointer_(arr, index, mod)
+    mod.out += ["store {} {}, {}* {}".format(right.irname, right.addr, arr.subtype.irname, elem)]
     return
 
 
@@ -61,8 +97,8 @@ def assignment(inputs, token, mod):
         raise ValueError("ERROR: Cannot assign to invalid variable name {}.".format(name))
     allocID = None
     if hasattr(inputs[0], "allocID") and inputs[0].allocID in mod.allocations.keys():
-        mod.markMemory(inputs[0].allocID, "userManaged")
         allocID = inputs[0].allocID
+    mod.assigned(name)
     var = mod.getVariable(name)
     if var is None:
         var = mod.newVariable(name, type(inputs[0]), allocID)
@@ -71,41 +107,87 @@ def assignment(inputs, token, mod):
                          .format(var[1], inputs[0].name))
     mod.out += ["store {} {}, {}* {}"
                 .format(inputs[0].irname, inputs[0].addr, var.irname, var.addr)]
-    if hasattr(inputs[0], "allocID") and inputs[0].allocID in mod.allocations.keys():
-        mod.markMemory(inputs[0].allocID, "userManaged")
+    if hasattr(var, 'subtype'):
+        # Small arrays may stay on the stack while only a local variable of this function has them
+        local = not var.addr.startswith('@') and name not in mod.sharedVars
+        mod.escapes(inputs[0], name if local else None)
+        # The variable now shares memory with whatever the value pointed into
+        pointsTo = mod.pointsTo.get(inputs[0].addr, set()) - set([name])
+        mod.aliasesOf(name).update(pointsTo)
+        for other in pointsTo:
+            mod.aliasesOf(other).add(name)
+        if var.addr.startswith('@'):
+            mod.capturesArrays = True
     return None
 
 
 def literalArray(inputs, token, mod):
     sub = type(inputs[0])
-    addr, allocID = mod.allocate(type(inputs[0]), len(inputs))
+    addr, allocID = mod.allocate(type(inputs[0]), len(inputs), line=token.line)
     for i, val in enumerate(inputs):
         temp = mod.newRegister()
         mod.out += ["{} = getelementptr {}, {}* {}, i32 {}"
                     .format(temp, sub.irname, sub.irname, addr, i)]
         mod.out += ["store {} {}, {}* {}".format(sub.irname, val.addr, sub.irname, temp)]
-    result = dtypes.Array(type(inputs[0]))(addr)
+    result = _newArray_(sub, addr, str(len(inputs)), mod)
     result.allocID = allocID
+    mod.pointsTo[result.addr] = set(['#{}'.format(allocID)])
     return result
 
 
 def createArray(inputs, token, mod):
-    dtype = dtypes.Array(dtypes.getType(token.data[0]))
-    addr, allocID = mod.allocate(dtype.subtype, inputs[0].addr)
-    result = dtype(addr)
+    subtype = dtypes.getType(token.data[0])
+    addr, allocID = mod.allocate(subtype, inputs[0].addr, line=token.line)
+    result = _newArray_(subtype, addr, inputs[0].addr, mod)
     result.allocID = allocID
+    mod.pointsTo[result.addr] = set(['#{}'.format(allocID)])
     return result
 
 
-def indexArray(inputs, token, mod):
-    result = inputs[0].subtype(mod.newRegister())
+def _newArray_(subtype, addr, length, mod):
+    '''Returns an array of the given subtype from a pointer to its data and its length.'''
+    result = dtypes.Array(subtype)(mod.newRegister())
+    partial = mod.newRegister()
+    mod.out += ["{} = insertvalue {} undef, {}* {}, 0"
+                .format(partial, result.irname, subtype.irname, addr)]
+    mod.out += ["{} = insertvalue {} {}, i32 {}, 1"
+                .format(result.addr, result.irname, partial, length)]
+    return result
+
+
+def _arrayData_(array, mod):
+    '''Returns a register holding the pointer to the data of an array.'''
+    data = mod.newRegister()
+    mod.out += ["{} = extractvalue {} {}, 0".format(data, array.irname, array.addr)]
+    return data
+
+
+def _elementPointer_(array, index, mod):
+    '''Returns a register holding the pointer to array[index].'''
     elemPtr = mod.newRegister()
+    sub = array.subtype.irname
     mod.out += ["{} = getelementptr {}, {}* {}, i32 {}"
-                .format(elemPtr, result.irname, result.irname, inputs[0].addr, inputs[1].addr)]
+                .format(elemPtr, sub, sub, _arrayData_(array, mod), index.addr)]
+    return elemPtr
+
+
+def indexArray(inputs, token, mod):
+    array, index = inputs
+    result = array.subtype(mod.newRegister())
+    if mod.checkBounds:
+        mod.checkIndex(array, index)
+    elemPtr = _elementPointer_(array, index, mod)
     mod.out += ["{} = load {}, {}* {}".format(result.addr, result.irname, result.irname, elemPtr)]
     return result
 
 
+def arrayLength(inputs, token, mod):
+    result = dtypes.Int(mod.newRegister())
+    mod.out += ["{} = extractvalue {} {}, 1".format(result.addr, inputs[0].irname,
+                                                    inputs[0].addr)]
+    return result
+
+
 def printStatement(inputs, token, mod):
     mod.ensureDeclared("printf", 'declare i32 @printf(i8* nocapture readonly, ...)')
     if isinstance(inputs[0], dtypes.Real):
@@ -126,10 +208,12 @@ def printStatement(inputs, token, mod):
 def simpleBinary(inputs, token, mod):
     left, right = inputs
     result = type(left)(mod.newRegister())
+    # Vectors are operated on elementwise
+    element = getattr(left, 'element', type(left))
     function = {'+': "add", "*": "mul", "%": "rem", '/': 'div', "//": "div", "-": "sub"}[token.name]
-    if isinstance(left, dtypes.Real):
+    if element is dtypes.Real:
         function = 'f'+function
-    elif token.name in ['%', '//'] and isinstance(left, dtypes.Int):
+    elif token.name in ['%', '//'] and element is dtypes.Int:
         function = 's'+function
     mod.out += ["{} = {} {} {}, {}"
                 .format(result.addr, function, left.irname, left.addr, right.addr)]
@@ -148,12 +232,15 @@ def unaryPlusMinus(inputs, token, mod):
     if token.name == "unary +":
         return inputs[0]
     result = type(inputs[0])(mod.newRegister())
-    if isinstance(inputs[0], dtypes.Real):
+    element = getattr(inputs[0], 'element', type(inputs[0]))
+    if element is dtypes.Real:
         function = 'fmul'
         right = "-1."
     else:
         function = 'mul'
         right = "-1"
+    if hasattr(inputs[0], 'width'):
+        right = "<{}>".format(", ".join([element.irname + " " + right]*inputs[0].width))
     mod.out += ["{} = {} {} {}, {}"
                 .format(result.addr, function, inputs[0].irname, inputs[0].addr, right)]
     return result
@@ -186,6 +273,94 @@ def boolOperators(inputs, token, mod):
     return result
 
 
+def extractLane(inputs, token, mod):
+    vector, index = inputs
+    result = vector.element(mod.newRegister())
+    mod.out += ["{} = extractelement {} {}, i32 {}"
+                .format(result.addr, vector.irname, vector.addr, index.addr)]
+    return result
+
+
+def reduceVector(inputs, token, mod):
+    '''Combines the lanes of a vector with sum, min or max, by repeatedly
+       combining its lower and upper halves.'''
+    vector = inputs[0]
+    element, width = vector.element, vector.width
+    current, currentType = vector.addr, vector.irname
+    while width > 1:
+        width //= 2
+        halfType = "<{} x {}>".format(width, element.irname)
+        halves = []
+        for start in [0, width]:
+            half = mod.newRegister()
+            lanes = ", ".join("i32 {}".format(i) for i in range(start, start + width))
+            mod.out += ["{} = shufflevector {} {}, {} undef, <{} x i32> <{}>"
+                        .format(half, currentType, current, currentType, width, lanes)]
+            halves.append(half)
+        combined = mod.newRegister()
+        if token.data[0] == 'sum':
+            function = 'fadd' if element is dtypes.Real else 'add'
+            mod.out += ["{} = {} {} {}, {}".format(combined, function, halfType, *halves)]
+        else:
+            # Select the lesser (or greater) of each pair of lanes
+            compare = mod.newRegister()
+            if element is dtypes.Real:
+                function = 'fcmp ' + {'min': 'olt', 'max': 'ogt'}[token.data[0]]
+            else:
+                function = 'icmp ' + {'min': 'slt', 'max': 'sgt'}[token.data[0]]
+            mod.out += ["{} = {} {} {}, {}".format(compare, function, halfType, *halves)]
+            mod.out += ["{} = select <{} x i1> {}, {} {}, {} {}"
+                        .format(combined, width, compare, halfType, halves[0], halfType,
+                                halves[1])]
+        current, currentType = combined, halfType
+    result = element(mod.newRegister())
+    mod.out += ["{} = extractelement <1 x {}> {}, i32 0"
+                .format(result.addr, element.irname, current)]
+    return result
+
+
+def _vectorPointer_(array, index, vector, mod):
+    # Returns a pointer to the vector starting at array[index], checking its last lane too
+    if mod.checkBounds:
+        last = dtypes.Int(mod.newRegister())
+        mod.out += ["{} = add i32 {}, {}".format(last.addr, index.addr, vector.width-1)]
+        mod.checkIndex(array, index)
+        mod.checkIndex(array, last)
+    elemPtr = _elementPointer_(array, index, mod)
+    vectorPtr = mod.newRegister()
+    mod.out += ["{} = bitcast {}* {} to {}*".format(vectorPtr, vector.element.irname, elemPtr,
+                                                    vector.irname)]
+    return vectorPtr
+
+
+def vectorLoad(inputs, token, mod):
+    '''Loads a vector from consecutive array elements.  The aligned form
+       (e.g. load4) requires the first element to be aligned to the size of
+       the vector, as it is for indices that are multiples of the width in
+       arrays allocated by Tau.'''
+    array, index = inputs
+    vector = dtypes.Vector(array.subtype, int(re.search(r"\d+$", token.data[0]).group()))
+    result = vector(mod.newRegister())
+    aligned = not token.data[0].startswith("loadUnaligned")
+    mod.out += ["{} = load {}, {}* {}, align {}".format(
+        result.addr, vector.irname, vector.irname, _vectorPointer_(array, index, vector, mod),
+        vector.size if aligned else vector.element.size)]
+    return result
+
+
+def vectorStore(inputs, token, mod):
+    '''Stores a vector to consecutive array elements, with the same alignment
+       requirement as vectorLoad for the aligned form (store).'''
+    array, index, vector = inputs
+    aligned = token.data[0] == "store"
+    mod.arrayWrites |= mod.pointsTo.get(array.addr, set())
+    mod.out += ["store {} {}, {}* {}, align {}".format(
+        vector.irname, vector.addr, vector.irname,
+        _vectorPointer_(array, index, type(vector), mod),
+        vector.size if aligned else vector.element.size)]
+    return None
+
+
 # TODO: Although this system works, it is wildly inelegant.  I really need to fix it.
 # This catalog tells the AST what functions to call for a given token.
 # For type-dependent builtins, it also says the accepted and return types.
@@ -204,6 +379,7 @@ catalog = {
     # Typed name:{"Arg1Type Args2Type":[function,retType]}
     'indexing': {"Array:{} Int".format(i):
                  [indexArray, dtypes.getType(i)] for i in ["Real", "Int"]},
+    'len': {"Array:"+i: [arrayLength, dtypes.Int] for i in ["Real", "Int", "Bool"]},
     'unary -': {i: [unaryPlusMinus, dtypes.getType(i)] for i in ['Real', 'Int']},
     'unary +': {i: [unaryPlusMinus, dtypes.getType(i)] for i in ['Real', 'Int']},
     '**': {"Real Real": [power, dtypes.Real]},
@@ -218,3 +394,90 @@ for t in ['<=', '>=', '<', '>', '!=', '==']:
 for t in ['-', '+', '*', '%']:
     catalog[t] = {ty+' '+ty: [simpleBinary, dtypes.getType(ty)]
                   for ty in ["Real", "Int", "Bool"]}
+# Vector types have elementwise arithmetic, lane extraction (v[i]), reductions to a scalar,
+# and loads and stores of consecutive array elements
+for vectorName, vector in dtypes.vectorTypes.items():
+    elementName = vector.element.name
+    for t in ['-', '+', '*', '%', '/' if elementName == "Real" else '//']:
+        catalog[t][vectorName+' '+vectorName] = [simpleBinary, vector]
+    for t in ['unary -', 'unary +']:
+        catalog[t][vectorName] = [unaryPlusMinus, vector]
+    catalog['indexing'][vectorName+' Int'] = [extractLane, vector.element]
+    for t in ['sum', 'min', 'max']:
+        # Scalars reduce to themselves, rather than being copied to a vector first
+        catalog.setdefault(t, {ty: [parentheses, dtypes.getType(ty)] for ty in ["Real", "Int"]})
+        catalog[t][vectorName] = [reduceVector, vector.element]
+    for t in ['load', 'loadUnaligned']:
+        catalog.setdefault(t+str(vector.width), {})["Array:{} Int".format(elementName)] = \
+            [vectorLoad, vector]
+    for t in ['store', 'storeUnaligned']:
+        catalog.setdefault(t, {})["Array:{} Int {}".format(elementName, vectorName)] = \
+            [vectorStore, None]
+
+
+# The functions below compute the same results as the builtins above, but on constant
+# Python values at compile time.  They are given the argument values and types and the
+# token, and return None if the result is undefined or depends on the run time.
+def constantSimpleBinary(values, argTypes, token):
+    left, right = values
+    if argTypes[0] is dtypes.Real:
+        if token.name == '%':
+            return math.fmod(left, right)
+        return {'+': left + right, '-': left - right, '*': left * right,
+                '/': left / right if right else None}[token.name]
+    elif argTypes[0] is dtypes.Int:
+        if token.name in ['%', '//']:
+            # Signed division truncates toward zero, and the remainder has the dividend's sign
+            if right == 0 or (left == dtypes.intMin and right == -1):
+                return None
+            quotient = abs(left) // abs(right) * (1 if (left < 0) == (right < 0) else -1)
+            return quotient if token.name == '//' else left - right*quotient
+        return dtypes.wrapInt({'+': left + right, '-': left - right,
+                               '*': left * right}[token.name])
+    return None
+
+
+def constantPower(values, argTypes, token):
+    return math.pow(*values)
+
+
+def constantUnaryPlusMinus(values, argTypes, token):
+    if token.name == "unary +":
+        return values[0]
+    elif argTypes[0] is dtypes.Real:
+        return values[0] * -1.
+    return dtypes.wrapInt(-values[0])
+
+
+def constantComparison(values, argTypes, token):
+    left, right = values
+    if argTypes[0] is dtypes.Real and (math.isnan(left) or math.isnan(right)):
+        # Real comparisons are ordered, so all are false for NaN
+        return False
+    return {'<=': left <= right, '>=': left >= right, '<': left < right,
+            '>': left > right, '!=': left != right, '==': left == right}[token.name]
+
+
+def constantBoolOperators(values, argTypes, token):
+    left, right = values
+    return {'and': left and right, 'or': left or right, 'xor': left != right}[token.name]
+
+
+def constantConvert(values, argTypes, token):
+    return argTypes[0].conversions[token.data.name][2](values[0])
+
+
+def constantParentheses(values, argTypes, token):
+    return values[0]
+
+
+# The compile-time counterparts of the builtins that can be applied to constants.
+constantEvaluators = {
+    simpleBinary: constantSimpleBinary,
+    power: constantPower,
+    unaryPlusMinus: constantUnaryPlusMinus,
+    comparison: constantComparison,
+    boolOperators: constantBoolOperators,
+    convert: constantConvert,
+    parentheses: constantParentheses,
+}
@@ -1,6 +1,31 @@
 from ctypes import c_int, c_double, c_bool
+import math
+import struct
 baseTypes = ["Real", "Int", "Bool"]
 __arraysDefined__ = {}
+# The vector types by name, and the widths defined for each element type
+vectorTypes = {}
+vectorWidths = {"Real": [2, 4, 8], "Int": [4, 8, 16]}
+intMin, intMax = -2**31, 2**31-1
+
+
+def wrapInt(value):
+    '''Wraps an integer to the range of an i32, as LLVM integer arithmetic does.'''
+    return (value - intMin) % 2**32 + intMin
+
+
+def formatReal(value):
+    '''Formats a float as an IR double constant without losing precision.  LLVM only
+       parses decimal constants which are exact as doubles (not e.g. 1e-07), so the
+       hexadecimal form of the IEEE-754 bits is always used.'''
+    return "0x{:016X}".format(struct.unpack('<Q', struct.pack('<d', value))[0])
+
+
+def _realToInt(value):
+    # fptosi truncates toward zero; out of range values give an undefined result
+    if math.isnan(value) or not intMin <= value < intMax + 1:
+        return None
+    return int(value)
 
 
 class Real(object):
@@ -10,9 +35,11 @@ class Real(object):
     size = 8
     initStr = '0.0'
     casting = ["Real"]
+    # Each conversion lists whether it must be explicit, the IR code to perform it, and a
+    # function to apply it to constants, which returns None if it cannot be done at compile time.
     conversions = {
-        "Int": [True, "{} = fptosi double {} to i32"],
-        "Bool": [True, "{} = fcmp one double {}, 0.0"]}
+        "Int": [True, "{} = fptosi double {} to i32", _realToInt],
+        "Bool": [True, "{} = fcmp one double {}, 0.0", lambda x: x != 0. and not math.isnan(x)]}
 
     def __init__(self, addr):
         self.addr = addr
@@ -27,8 +54,8 @@ class Int(object):
     initStr = '0'
     casting = ["Int", "Real"]
     conversions = {
-        "Real": [False, "{} = sitofp i32 {} to double"],
-        "Bool": [False, "{} = icmp ne i32 {}, 0"]}
+        "Real": [False, "{} = sitofp i32 {} to double", float],
+        "Bool": [False, "{} = icmp ne i32 {}, 0", lambda x: x != 0]}
 
     def __init__(self, addr):
         self.addr = addr
@@ -43,8 +70,8 @@ class Bool(object):
     initStr = 'false'
     casting = ["Bool", "Int", "Real"]
     conversions = {
-        "Real": [False, "{} = uitofp i1 {} to double"],
-        "Int": [False, "{} = zext i1 {} to i32"]}
+        "Real": [False, "{} = uitofp i1 {} to double", float],
+        "Int": [False, "{} = zext i1 {} to i32", int]}
 
     def __init__(self, addr):
         self.addr = addr
@@ -55,14 +82,15 @@ def Array(newSubtype):
     if newSubtype in __arraysDefined__.keys():
         return __arraysDefined__[newSubtype]
 
+    # Arrays are values holding a pointer to their data and their length
     class Array(object):
         conversions = {}
         ctype = None
-        size = 8
-        initStr = 'null'
+        size = 16
+        initStr = 'zeroinitializer'
         subtype = newSubtype
         name = 'Array:'+subtype.name
-        irname = subtype.irname+'*'
+        irname = '{{{}*, i32}}'.format(subtype.irname)
         casting = [name]
         allocID = None
 
@@ -73,7 +101,59 @@ def Array(newSubtype):
     return Array
 
 
+def Vector(newElement, newWidth):
+    '''Returns the type of fixed-width vectors of the given element type,
+       which are kept in SIMD registers as LLVM vectors.'''
+    newName = newElement.name + str(newWidth)
+    if newName in vectorTypes.keys():
+        return vectorTypes[newName]
+
+    class Vector(object):
+        conversions = {}
+        ctype = None
+        element = newElement
+        width = newWidth
+        size = newWidth*newElement.size
+        initStr = 'zeroinitializer'
+        name = newName
+        irname = '<{} x {}>'.format(newWidth, newElement.irname)
+        casting = [name]
+
+        def __init__(self, addr):
+            self.addr = addr
+            return
+    vectorTypes[newName] = Vector
+    return Vector
+
+
+def _splat_(vector, convert=None):
+    # IR code to broadcast a scalar to every lane, after converting it to the element type
+    code = "{0}_lane = insertelement " + vector.irname + " undef, " + vector.element.irname
+    if convert is not None:
+        code = convert.replace("{}", "{0}_element", 1).replace("{}", "{1}") + "\n" + code
+        code += " {0}_element, i32 0\n"
+    else:
+        code += " {1}, i32 0\n"
+    return code + "{0} = shufflevector " + vector.irname + " {0}_lane, " + vector.irname + \
+        " undef, <" + str(vector.width) + " x i32> zeroinitializer"
+
+
+# Scalars are converted to vectors (implicitly, as in v*2.) by copying them to every lane
+for elementName, widths in sorted(vectorWidths.items()):
+    for width in widths:
+        vector = Vector(globals()[elementName], width)
+        vector.element.conversions[vector.name] = [False, _splat_(vector), lambda x: None]
+        vector.element.casting.append(vector.name)
+for width in vectorWidths["Real"]:
+    vector = Vector(Real, width)
+    Int.conversions[vector.name] = [False, _splat_(vector, Int.conversions["Real"][1]),
+                                    lambda x: None]
+    Int.casting.append(vector.name)
+
+
 def getType(name):
     if name.startswith("Array:"):
         return Array(getType(name[6:]))
+    elif name in vectorTypes.keys():
+        return vectorTypes[name]
     return {"Int": Int, "Real": Real, "Bool": Bool}[name]
@@ -0,0 +1,172 @@
+import array
+import ctypes
+import dtypes
+
+
+class _PyBuffer_(ctypes.Structure):
+    '''The Py_buffer struct filled in by PyObject_GetBuffer.'''
+    _fields_ = [('buf', ctypes.c_void_p),
+                ('obj', ctypes.c_void_p),
+                ('len', ctypes.c_ssize_t),
+                ('itemsize', ctypes.c_ssize_t),
+                ('readonly', ctypes.c_int),
+                ('ndim', ctypes.c_int),
+                ('format', ctypes.c_char_p),
+                ('shape', ctypes.POINTER(ctypes.c_ssize_t)),
+                ('strides', ctypes.POINTER(ctypes.c_ssize_t)),
+                ('suboffsets', ctypes.POINTER(ctypes.c_ssize_t)),
+                ('smalltable', ctypes.c_ssize_t*2),
+                ('internal', ctypes.c_void_p)]
+
+
+_getBuffer = ctypes.pythonapi.PyObject_GetBuffer
+_getBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(_PyBuffer_), ctypes.c_int]
+_releaseBuffer = ctypes.pythonapi.PyBuffer_Release
+_releaseBuffer.argtypes = [ctypes.POINTER(_PyBuffer_)]
+# PyBUF_WRITABLE | PyBUF_FORMAT | PyBUF_C_CONTIGUOUS
+_bufferFlags = 0x0001 | 0x0004 | 0x0038
+# The struct module format characters accepted for each array subtype, by item size
+_formats = {dtypes.Real: {8: 'd'}, dtypes.Int: {4: 'il'}}
+
+
+def _checkFormat_(formatString, itemsize, subtype, obj):
+    formatString = formatString.lstrip('@=<')
+    if formatString not in _formats.get(subtype, {}).get(itemsize, ''):
+        raise TypeError("ERROR: Array:{} arguments cannot be given items of format '{}' "
+                        "and size {} (from {}).".format(subtype.name, formatString, itemsize,
+                                                        type(obj).__name__))
+
+
+def bufferPointer(obj, subtype, views):
+    '''Returns the address of the data in a writable, contiguous buffer
+       object without copying it and the number of items, after checking
+       that its items match the array subtype.  Buffers acquired through the
+       new buffer protocol are appended to views, and must be released with
+       releaseBuffers.'''
+    if isinstance(obj, array.array):
+        # Python 2 arrays only have the old buffer protocol, but give their address directly
+        _checkFormat_(obj.typecode, obj.itemsize, subtype, obj)
+        return obj.buffer_info()
+    view = _PyBuffer_()
+    try:
+        _getBuffer(obj, ctypes.byref(view), _bufferFlags)
+    except (TypeError, ValueError, BufferError):
+        raise TypeError("ERROR: Array:{} arguments must be writable, contiguous buffers, "
+                        "not {}.".format(subtype.name, type(obj).__name__))
+    views.append(view)
+    _checkFormat_(view.format or 'B', view.itemsize, subtype, obj)
+    return view.buf, view.len // view.itemsize
+
+
+def releaseBuffers(views):
+    for view in views:
+        _releaseBuffer(ctypes.byref(view))
+
+
+class FunctionHandle():
+    '''Calls a compiled Tau function which takes arrays as arguments.  Arrays
+       may be given as any buffer object (e.g. array.array, NumPy arrays or
+       memoryviews) of the right type, and are passed without copying, along
+       with their length.  Arrays that the function writes to may not overlap
+       the other arrays given, since it assumes that they do not.'''
+    def __init__(self, function, name, args, written):
+        self.function = function
+        self.name = name
+        # The array subtype of each argument, or None for scalars
+        self.subtypes = [getattr(dtype, 'subtype', None) for dtype, argName in args]
+        self.argNames = [argName for dtype, argName in args]
+        # The pairs of array arguments which must not overlap
+        arrays = [i for i, subtype in enumerate(self.subtypes) if subtype is not None]
+        self.disjoint = [(i, j) for i in arrays for j in arrays
+                         if i < j and (written[i] or written[j])]
+
+    def __call__(self, *arguments):
+        if len(arguments) != len(self.subtypes):
+            raise TypeError("ERROR: {} takes {} arguments ({} given)."
+                            .format(self.name, len(self.subtypes), len(arguments)))
+        views = []
+        try:
+            converted = []
+            # The memory spanned by each array argument
+            spans = {}
+            for i, (a, subtype) in enumerate(zip(arguments, self.subtypes)):
+                if subtype is None:
+                    converted.append(a)
+                else:
+                    address, length = bufferPointer(a, subtype, views)
+                    converted += [address, length]
+                    spans[i] = (address, address + length*subtype.size)
+            for i, j in self.disjoint:
+                if spans[i][0] < spans[j][1] and spans[j][0] < spans[i][1]:
+                    raise ValueError("ERROR: Array arguments {0} and {1} of {2} overlap, and "
+                                     "{2} writes to one of them."
+                                     .format(self.argNames[i], self.argNames[j], self.name))
+            return self.function(*converted)
+        finally:
+            releaseBuffers(views)
+
+
+def getCallable(address, name, dtype, args, written):
+    '''Returns a Python callable for the compiled function at the given
+       address with the given signature: a plain ctypes function if it takes
+       only scalars, or a FunctionHandle if it takes arrays.  written gives
+       whether the function writes to each argument.'''
+    restype = dtype.ctype if dtype.ctype is not None else ctypes.c_void_p
+    # The pointer and length of an array argument are passed as if they were two arguments
+    argtypes = []
+    for t, argName in args:
+        argtypes += [t.ctype] if t.ctype is not None else [ctypes.c_void_p, ctypes.c_int32]
+    function = ctypes.CFUNCTYPE(restype, *argtypes)(address)
+    if all(t.ctype is not None for t, argName in args):
+        return function
+    return FunctionHandle(function, name, args, written)
+
+
+class ArrayKernel():
+    '''Maps a compiled scalar Tau function over arrays in native code, like a
+       NumPy ufunc.  Each argument may be a buffer object, or a scalar which is
+       broadcast to every element.  The results are written to the buffer
+       given as out, or else to a new array.array, which is returned.'''
+    def __init__(self, function, name, dtype, args, compileKernel):
+        self.function = function
+        self.name = name
+        self.dtype = dtype
+        self.argTypes = [t for t, argName in args]
+        # Compiles the loop for the given tuple of which arguments are arrays
+        self.compileKernel = compileKernel
+        self.kernels = {}
+
+    def __call__(self, *arguments, **kwargs):
+        out = kwargs.pop('out', None)
+        if kwargs:
+            raise TypeError("ERROR: Unexpected keyword arguments {}.".format(kwargs.keys()))
+        if len(arguments) != len(self.argTypes):
+            raise TypeError("ERROR: {} takes {} arguments ({} given)."
+                            .format(self.name, len(self.argTypes), len(arguments)))
+        isArray = tuple(not isinstance(a, (int, long, float, bool)) for a in arguments)
+        if not any(isArray) and out is None:
+            return self.function(*arguments)
+        if isArray not in self.kernels:
+            self.kernels[isArray] = self.compileKernel(isArray)
+        views = []
+        try:
+            converted = []
+            lengths = set()
+            for a, dtype, arrayGiven in zip(arguments, self.argTypes, isArray):
+                if arrayGiven:
+                    address, length = bufferPointer(a, dtype, views)
+                    converted.append(address)
+                    lengths.add(length)
+                else:
+                    converted.append(a)
+            if out is None:
+                out = array.array('d' if self.dtype is dtypes.Real else 'i', [0])*max(lengths)
+            address, length = bufferPointer(out, self.dtype, views)
+            lengths.add(length)
+            if len(lengths) > 1:
+                raise ValueError("ERROR: Arrays of different lengths {} given to {}."
+                                 .format(sorted(lengths), self.name))
+            self.kernels[isArray](*(converted + [address, length]))
+        finally:
+            releaseBuffers(views)
+        return out
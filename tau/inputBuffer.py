@@ -18,13 +18,19 @@ def _getTopLevelPrompt_(x):
 
 
 class InputBuffer():
-    def __init__(self, source, quiet=False):
+    def __init__(self, source, quiet=False, firstLine=1):
         self.source = source
         self.quiet = quiet
         self.buffer = []
+        # Source line numbers of the lines in the buffer, and of the last line taken from it
+        self.lineNumbers = []
+        self.lineNumber = None
+        self.linesRead = 0
         self.stringInput = isinstance(source, str)
         if self.stringInput:
-            self.buffer = [line for line in source.splitlines() if line]
+            numbered = [(i+firstLine, line) for i, line in enumerate(source.splitlines()) if line]
+            self.buffer = [line for i, line in numbered]
+            self.lineNumbers = [i for i, line in numbered]
         self.REPLMode = source is sys.stdin
         if self.REPLMode:
             self.promptHistory = ptk.history.FileHistory(os.path.expanduser("~/.tauhistory"))
@@ -46,14 +52,18 @@ class InputBuffer():
                 if output == "":
                     # A blank line returns '\n', so this must be EOF
                     raise EOFError
+            self.linesRead += 1
             if output.strip() != "" or not ((self.REPLMode and level == 0) or not self.REPLMode):
                 break
-        self.buffer += output.splitlines()
+        newLines = output.splitlines()
+        self.buffer += newLines
+        self.lineNumbers += [self.linesRead]*len(newLines)
         return
 
     def getLine(self, level=0):
         if not self.buffer:
             self._fillBuffer_(level)
+        self.lineNumber = self.lineNumbers.pop(0)
         return self.buffer.pop(0)
 
     def peek(self, level=0):
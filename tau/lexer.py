@@ -3,29 +3,51 @@ import sys
 import dtypes
 
 
-def lex(code, debugLexer=False):
+def lex(code, debugLexer=False, lineNumber=None):
     tokens = []
-    unprocessed = code.strip()
-    while unprocessed:
-        # Identify comments
-        if unprocessed[0] == '#':
-            break
+    line = code.strip()
+    # Columns of the stripped line are offset from those in the source
+    offset = len(code) - len(code.lstrip())
+    brackets = matchBrackets(line)
+    pos, end = 0, len(line)
+    # Token lists of the enclosing brackets, with the positions to resume lexing them from
+    enclosing = []
+    while True:
+        pos = _whitespace.match(line, pos, end).end()
+        # Identify comments and the end of the current bracket
+        if pos >= end or line[pos] == '#':
+            if not enclosing:
+                break
+            tokens, pos, end = enclosing.pop()
+            continue
         # Check for errors
-        if unprocessed.startswith(")"):
+        if line[pos] == ")":
             raise ValueError("ERROR: Unmatched ending parenthesis.")
-        # Search through tokens to find one that matches
-        for TokenType in Token.__subclasses__():
-            if TokenType.isMatch(unprocessed, tokens):
-                unprocessed = TokenType.appendNew(tokens, unprocessed)
-                break
+        # Find the first token type that matches, excluding unary operators after a value
+        match = _masterPatterns[bool(tokens) and tokens[-1].isValue].match(line, pos, end)
+        if match is None:
+            raise ValueError("ERROR: Cannot tokenize code from: {}".format(line[pos:end].rstrip()))
+        TokenType = _tokenTypes[match.lastgroup]
+        if TokenType.bracket:
+            # Lex the bracket contents into the new token, then resume after the closing bracket
+            right = brackets.get(match.end()-1)
+            if right is None or right >= end:
+                raise ValueError("ERROR: More {} than {}".format(*TokenType.bracket))
+            enclosing.append((tokens, right+1, end))
+            contents = TokenType.openBracket(tokens, match)
+            tokens[-1].setSpan(lineNumber, offset+match.start(), offset+right+1)
+            tokens = contents
+            pos, end = match.end(), right
         else:
-            raise ValueError("ERROR: Cannot tokenize code from: {}".format(unprocessed))
+            pos, end = TokenType.appendNew(tokens, line, match, end)
+            tokens[-1].setSpan(lineNumber, offset+match.start(), offset+match.end())
     if debugLexer:
         sys.stderr.write("LEXER: "+code+" ===> "+str([t.name for t in tokens])+'\n')
     return tokens
 
 
 class Token(object):
+    __slots__ = ('name', 'data', 'line', 'start', 'end')
     precedence = 999
     regex = None
     isValue = False
@@ -33,20 +55,27 @@ class Token(object):
     followsValue = False
     endsWithColon = False
     unary = False
+    # The opening and closing characters of tokens that enclose others.  These token types
+    # define openBracket(tokens, match), which adds the token found by match to tokens and
+    # returns the list that will hold the tokens between the brackets
+    bracket = None
 
-    def __init__(self, name, data=None):
+    def __init__(self, name, data=None, line=None, start=None, end=None):
         self.name = name
         self.data = data
+        self.setSpan(line, start, end)
 
-    @classmethod
-    def isMatch(cls, text, tokens):
-        if cls.unary and tokens and tokens[-1].isValue:
-            return False
-        return re.match(cls.regex, text)
+    def setSpan(self, line, start, end):
+        '''Records the source line number and column range of the token.'''
+        self.line = line
+        self.start = start
+        self.end = end
 
     @classmethod
-    def appendNew(cls, tokens, sourceString):
-        tokenString = re.match(cls.regex, sourceString).group()
+    def appendNew(cls, tokens, code, match, end):
+        '''Adds the token found by match to tokens.  Returns the positions in
+           code at which to resume lexing and at which to stop.'''
+        tokenString = match.group()
         newToken = cls(tokenString)
         # Check for some syntax errors
         if cls.startsLine and len(tokens) != 0:
@@ -58,25 +87,27 @@ class Token(object):
             raise ValueError("ERROR: token '{}' expected a value token to its left but found '{}'."
                              .format(newToken.name, tokens[-1].name))
         if cls.endsWithColon:
-            if sourceString[-1] != ':':
+            end = len(code[:end].rstrip())
+            if code[end-1] != ':':
                 raise ValueError('ERROR: Lines using {} must end in ":".'.format(newToken.name))
-            sourceString = sourceString[:-1]
-        # Add the new token to the list and pop the corresponding part of the source string
+            end = len(code[:end-1].rstrip())
+        # Add the new token to the list and skip past it in the source string
         tokens.append(newToken)
-        sourceString = tokens[-1].extraInit(tokens, sourceString)
-        return sourceString[len(tokenString):].strip()
+        newToken.extraInit(tokens)
+        return match.end(), end
 
-    def extraInit(self, tokens, sourceString):
-        return sourceString
+    def extraInit(self, tokens):
+        return
 
 
 class AssignmentToken(Token):
+    __slots__ = ()
     regex = r'((\+|-|//?|\*\*?|%)?=(?!=))'
     precedence = 1
 
     @classmethod
-    def appendNew(cls, tokens, sourceString):
-        tokenString = re.match(cls.regex, sourceString).group()
+    def appendNew(cls, tokens, code, match, end):
+        tokenString = match.group()
         if len(tokens) == 1 and tokens[0].name == 'name':
             tokens.append(cls(tokenString, tokens.pop(0).data))
         elif len(tokens) > 1 and tokens[-1].name == "indexing":
@@ -84,176 +115,221 @@ class AssignmentToken(Token):
             del tokens[:-1]
         else:
             raise ValueError("ERROR: Assignment must be immeditely follow variable name in {}"
-                             .format(sourceString))
-        return sourceString[len(tokenString):].strip()
+                             .format(code[match.start():end].rstrip()))
+        return match.end(), end
 
 
 class BlockStarterToken(Token):
-    regex = r"(def|while|if|for)\b"
+    __slots__ = ()
+    regex = r"(def|while|if|(parallel\s+)?for)\b"
     startsLine = True
     endsWithColon = True
 
+    def extraInit(self, tokens):
+        # Any whitespace may separate parallel from for
+        self.name = ' '.join(self.name.split())
+        return
+
 
 class PrintToken(Token):
+    __slots__ = ()
     precedence = 0
     regex = r"Print\b"
     startsLine = True
 
 
 class BoolOperatorTokens(Token):
+    __slots__ = ()
     regex = r'(and|or|xor)'
     precedence = 2
     followsValue = True
 
 
 class StructuralToken(Token):
+    __slots__ = ()
     regex = r'(,|in)'
 
 
 class ExponentToken(Token):
+    __slots__ = ()
     regex = r'\*\*(?!=)'
     precedence = 6
     followsValue = True
 
 
 class MultiplyFamilyToken(Token):
+    __slots__ = ()
     regex = r'(\*|%|//?)(?!=)'
     precedence = 5
     followsValue = True
 
 
 class RelationalTokens(Token):
+    __slots__ = ()
     regex = r'(<=?|>=?|==)'
     precedence = 3
     followsValue = True
 
 
 class RealLiteralToken(Token):
+    __slots__ = ()
     regex = r"\d*\.\d*"
     precedence = 9
     isValue = True
 
-    def extraInit(self, tokens, sourceString):
-        self.data = [dtypes.Real, float(self.name)]
+    def extraInit(self, tokens):
+        self.data = (dtypes.Real, float(self.name))
         self.name = "literal"
-        return sourceString
+        return
 
 
 class IntLiteralToken(Token):
+    __slots__ = ()
     regex = r"\d+"
     precedence = 9
     isValue = True
 
-    def extraInit(self, tokens, sourceString):
-        self.data = [dtypes.Int, int(self.name)]
+    def extraInit(self, tokens):
+        self.data = (dtypes.Int, int(self.name))
         self.name = "literal"
-        return sourceString
+        return
 
 
 class BoolLiteralToken(Token):
+    __slots__ = ()
     regex = r"(True|False)"
     precedence = 9
     isValue = True
 
-    def extraInit(self, tokens, sourceString):
-        self.data = [dtypes.Bool, self.name.lower()]
+    def extraInit(self, tokens):
+        self.data = (dtypes.Bool, self.name.lower())
         self.name = "literal"
-        return sourceString
+        return
 
 
 class FunctionToken(Token):
+    __slots__ = ()
     regex = r"[a-zA-Z_]\w*\("
     precedence = 8
     isValue = True
+    bracket = '()'
 
     @classmethod
-    def appendNew(cls, tokens, sourceString):
-        tokenString = re.match(cls.regex, sourceString).group()
-        right = findMatching(sourceString, len(tokenString)-1)
-        caller = tokenString[:-1]
-        tokens.append(cls("function", [caller, lex(sourceString[len(tokenString):right])]))
-        sourceString = sourceString[right+1:].strip()
-        return sourceString
+    def openBracket(cls, tokens, match):
+        contents = []
+        tokens.append(cls("function", [match.group()[:-1], contents]))
+        return contents
 
 
 class ParensToken(Token):
+    __slots__ = ()
     regex = r"\("
     precedence = 8
     isValue = True
+    bracket = '()'
 
     @classmethod
-    def appendNew(cls, tokens, sourceString):
-        right = findMatching(sourceString)
-        tokens.append(cls('()', lex(sourceString[1:right])))
-        sourceString = sourceString[right+1:].strip()
-        return sourceString
+    def openBracket(cls, tokens, match):
+        contents = []
+        tokens.append(cls('()', contents))
+        return contents
 
 
 class NameToken(Token):
-    regex = r"[a-zA-Z_]\w*"
+    __slots__ = ()
+    # Includes array type names like Array:Real, as used in function signatures
+    regex = r"(Array:)*[a-zA-Z_]\w*"
     precedence = 9
     isValue = True
 
-    def extraInit(self, tokens, sourceString):
+    def extraInit(self, tokens):
         self.data = self.name
         self.name = "name"
-        return sourceString
+        return
 
 
 class ArrayToken(Token):
+    __slots__ = ()
     regex = r"\["
     precedence = 8
     isValue = True
+    bracket = '[]'
 
     @classmethod
-    def appendNew(cls, tokens, sourceString):
+    def openBracket(cls, tokens, match):
         # Identify array literals and indexing operations
-        right = findMatching(sourceString, left='[', right=']')
+        contents = []
         lastWasValue = tokens and tokens[-1].isValue
         if lastWasValue and tokens[-1].name == "name" and tokens[-1].data in dtypes.baseTypes:
             # This is an array creation operation
             dtype = tokens.pop(-1).data
-            tokens.append(cls("array", [dtype, lex(sourceString[1:right])]))
+            tokens.append(cls("array", [dtype, contents]))
         elif lastWasValue:
             # This is an indexing operation
-            tokens.append(cls("indexing", lex(sourceString[1:right])))
+            tokens.append(cls("indexing", contents))
         else:
-            tokens.append(cls("literalArray", lex(sourceString[1:right])))
-        return sourceString[right+1:].strip()
+            tokens.append(cls("literalArray", contents))
+        return contents
 
 
 class UnaryPlusToken(Token):
+    __slots__ = ()
     regex = r'\+'
     precedence = 7
     unary = True
 
-    def extraInit(self, tokens, sourceString):
+    def extraInit(self, tokens):
         # TODO: Remove once checking is no longer based on name
         self.name = 'unary +'
-        return sourceString
+        return
 
 
 class UnaryMinusToken(Token):
+    __slots__ = ()
     regex = r'-'
     precedence = 7
     unary = True
 
-    def extraInit(self, tokens, sourceString):
+    def extraInit(self, tokens):
         # TODO: Remove once checking is no longer based on name
         self.name = 'unary -'
-        return sourceString
+        return
 
 
 class BinaryPlusToken(Token):
+    __slots__ = ()
     regex = r'\+'
     precedence = 4
 
 
 class BinaryMinusToken(Token):
+    __slots__ = ()
     regex = r'-'
     precedence = 4
 
 
+def countTokens(tokens):
+    '''Counts tokens, including those nested inside brackets and calls.'''
+    total = 0
+    pending = [tokens]
+    while pending:
+        for t in pending.pop():
+            total += 1
+            if t.name in ['()', 'indexing', 'literalArray']:
+                pending.append(t.data)
+            elif t.name in ['function', 'array']:
+                pending.append(t.data[1])
+    return total
+
+
+def span(tokens):
+    '''Returns the source line and column range covered by a list of tokens.
+       These are None for tokens not created by the lexer.'''
+    if not tokens:
+        return None, None, None
+    return tokens[0].line, tokens[0].start, tokens[-1].end
+
+
 def findMatching(s, start=0, left='(', right=')'):
     level = 0
     for i, c in enumerate(s[start:]):
@@ -264,3 +340,36 @@ def findMatching(s, start=0, left='(', right=')'):
             if level == 0:
                 return i+start
     raise ValueError("ERROR: More {} than {}".format(left, right))
+
+
+def matchBrackets(s):
+    '''Finds the matching closing bracket for every "(" and "[" in s in a single
+       pass.  Returns a dict from the index of each opening bracket to that of
+       its match, which is the same index findMatching would give.  Unmatched
+       opening brackets are left out.'''
+    matches = {}
+    openings = {'(': [], '[': []}
+    closings = {')': openings['('], ']': openings['[']}
+    for m in _bracketChars.finditer(s):
+        c = m.group()
+        if c in openings:
+            openings[c].append(m.start())
+        elif closings[c]:
+            matches[closings[c].pop()] = m.start()
+    return matches
+
+
+def _buildMasterPattern(tokenTypes):
+    '''Combines the token regexes into a single compiled pattern, with one named
+       group per token type.  Alternatives are tried in order, so the first
+       matching token type wins as it would when testing each type in turn.'''
+    return re.compile("|".join("(?P<{}>{})".format(t.__name__, t.regex) for t in tokenTypes))
+
+
+_tokenTypes = {t.__name__: t for t in Token.__subclasses__()}
+_whitespace = re.compile(r"\s*")
+_bracketChars = re.compile(r"[()[\]]")
+# Indexed by whether the previous token was a value; unary operators can't follow one.
+_masterPatterns = [
+    _buildMasterPattern(Token.__subclasses__()),
+    _buildMasterPattern([t for t in Token.__subclasses__() if not t.unary])]
@@ -1,6 +1,8 @@
 import ctypes
 import sys
 import re
+import runtime
+import phases
 
 
 class TauModule():
@@ -8,17 +10,32 @@ class TauModule():
     # Global state information (valid for all modules)
     globalVars = {}
     userFunctions = {}
+    # The arrays each function writes (parameters and globals), the global arrays it uses,
+    # and whether it may keep its array arguments after returning
+    arrayEffects = {}
+    # The array variables each global array variable may share memory with
+    globalAliases = {}
     allocations = {}
     allocCounts = 0
+    # Arrays of at most this many bytes, with a size known when compiling, go on the stack
+    stackLimit = 1024
     anonNumber = 0
 
-    def __init__(self, replMode=False, debugAST=False, debugLexer=False, debugMemory=False):
+    def __init__(self, replMode=False, debugAST=False, debugLexer=False, debugMemory=False,
+                 checkBounds=False, trackMemory=False, profile=False):
         # Basic settings
         self.replMode = replMode
         self.debugAST = debugAST
         self.debugLexer = debugLexer
         self.debugMemory = debugMemory
+        self.checkBounds = checkBounds
+        self.trackMemory = trackMemory
+        self.profile = profile
         self.isGlobal = False
+        # The time spent compiling the module, by phase, and counts of what was compiled
+        self.stats = phases.PhaseStats()
+        # The function being compiled, which names its allocation sites when tracking memory
+        self.functionName = "<top level>"
         # Module name lists
         self.alreadyDeclared = []
         self.localVars = {}
@@ -27,11 +44,30 @@ class TauModule():
         self.body = []
         self.main = []
         self.out = self.body
+        # Functions outlined from parallel loop bodies, and the runtime modules the code needs
+        self.outlined = []
+        self.runtimes = set()
+        # The scopes (statements and loop iterations) whose temporaries are in the arena
+        self.arenaScopes = []
+        # Anonymous functions (for the JIT), as IR code and a list of (return value, name)
+        self.entryPoints = []
+        self.anonymousFunctions = []
         self.lastAnonymous = None
         self.lastOutput = None
         # Counters for naming schemes
         self.numRegisters = 0
         self.blockCounter = 0
+        # The variable each register was loaded from, and the loops over range(len(a)) being
+        # compiled, whose bounds checks on a[i] are removed if neither i nor a is assigned
+        self.loadedFrom = {}
+        self.lengthLoops = []
+        # The array variables that each register may point into, those that each local array
+        # variable may share memory with, and what the function being compiled does to arrays
+        self.pointsTo = {}
+        self.localAliases = {}
+        # The variables of an enclosing function that an outlined loop body reaches
+        self.sharedVars = set()
+        self.beginFunction()
 
     def ensureDeclared(self, name, code):
         '''Checks is name is listed as already declared.  If not, adds code
@@ -41,44 +77,325 @@ class TauModule():
             self.header += [code]
         return
 
-    def allocate(self, dtype, count=1, allocationStr="freeAfterStatement"):
+    def allocaAtEntry(self, irtype):
+        '''Allocates stack space for a value of the given IR type in the entry
+           block of the function being emitted, so that it is not repeated
+           when the current block is in a loop.  Returns the pointer.'''
+        result = self.newRegister()
+        for i in range(len(self.out)-1, -1, -1):
+            if self.out[i] == "entry:":
+                break
+        else:
+            # Top-level code is wrapped in a function later, so its start is the entry block
+            i = -1
+        self.out.insert(i+1, "{} = alloca {}".format(result, irtype))
+        return result
+
+    def allocate(self, dtype, count=1, allocationStr="freeAfterStatement", line=None):
         '''Allocates memory of the requested type and count and returns a
         pointer of the appropriate type.  This will be freed based on
-        based on the allocations string, which defaults to freeAfterStatement.'''
-        self.ensureDeclared("malloc", "declare i8* @malloc(i32)")
-        size = self.newRegister()
+        based on the allocations string, which defaults to freeAfterStatement.
+        Such temporaries are placed on the stack if they are small and their
+        count is a constant, and are otherwise taken from the arena within a
+        scope, unless they are later marked as userManaged, which moves them
+        to the heap.  line is the source line, which labels the allocation
+        site when tracking memory.'''
+        size, padded, rounded = self.newRegister(), self.newRegister(), self.newRegister()
+        size64 = self.newRegister()
         beforeCast = self.newRegister()
         result = self.newRegister()
         self.out += ["{} = mul i32 {}, {}".format(size, str(dtype.size), str(count))]
-        self.out += ["{} = call i8* @malloc(i32 {})".format(beforeCast, size)]
-        self.out += ["{} = bitcast i8* {} to {}*".format(result, beforeCast, dtype.irname)]
+        # Align to 64 bytes so that vectors can be loaded from any multiple of their width
+        # (aligned_alloc requires the size to be a multiple of the alignment)
+        self.out += ["{} = add i32 {}, 63".format(padded, size)]
+        self.out += ["{} = and i32 {}, -64".format(rounded, padded)]
+        self.out += ["{} = zext i32 {} to i64".format(size64, rounded)]
         allocID = 0+TauModule.allocCounts
         TauModule.allocCounts += 1
-        self.allocations[allocID] = [allocationStr, beforeCast]
+        heapLine = self.heapAllocation(beforeCast, size64, allocID, line)
+        if (allocationStr == "freeAfterStatement" and str(count).isdigit()
+                and dtype.size*int(count) <= TauModule.stackLimit):
+            # In the entry block, so that a loop reuses the same space in every iteration
+            slot = self.allocaAtEntry("[{} x i8], align 64".format(dtype.size*int(count)))
+            allocationStr = "stack"
+            self.out += ["{} = bitcast [{} x i8]* {} to i8*"
+                         .format(beforeCast, dtype.size*int(count), slot)]
+        elif allocationStr == "freeAfterStatement" and self.arenaScopes and self.trackMemory:
+            # Those too large for the arena are counted like other heap allocations
+            self.ensureDeclared("tau_tracked_arena_alloc",
+                                "declare i8* @tau_tracked_arena_alloc(i64, i8*, i8*)")
+            self.runtimes.update(['memory', 'trackedArena'])
+            self.arenaScopes[-1]['allocations'].append(allocID)
+            allocationStr = "arena"
+            self.out += ["{} = call i8* @tau_tracked_arena_alloc(i64 {}, {})"
+                         .format(beforeCast, size64, self.memorySite(allocID, line))]
+        elif allocationStr == "freeAfterStatement" and self.arenaScopes:
+            self.ensureDeclared("tau_arena_alloc", "declare i8* @tau_arena_alloc(i64)")
+            self.runtimes.add('arena')
+            self.arenaScopes[-1]['allocations'].append(allocID)
+            allocationStr = "arena"
+            self.out += ["{} = call i8* @tau_arena_alloc(i64 {})".format(beforeCast, size64)]
+        else:
+            self.out += [heapLine]
+        # The line is kept so that a temporary can be moved from the stack or arena to the heap
+        self.allocations[allocID] = [allocationStr, beforeCast, self.out, self.out[-1], heapLine]
+        self.out += ["{} = bitcast i8* {} to {}*".format(result, beforeCast, dtype.irname)]
         if self.debugMemory:
             sys.stderr.write("MEMORY: Will allocate {} {}(s), ID {}\n"
                              .format(count, dtype.name, allocID))
         return result, allocID
 
+    def heapAllocation(self, beforeCast, size64, allocID, line):
+        '''Returns the line allocating size64 bytes on the heap as beforeCast.
+           When tracking memory, it goes through the memory runtime, which
+           counts it for a new allocation site.'''
+        if not self.trackMemory:
+            self.ensureDeclared("aligned_alloc", "declare i8* @aligned_alloc(i64, i64)")
+            return "{} = call i8* @aligned_alloc(i64 64, i64 {})".format(beforeCast, size64)
+        self.runtimes.add('memory')
+        self.ensureDeclared("tau_memory_alloc", "declare i8* @tau_memory_alloc(i64, i8*, i8*)")
+        return "{} = call i8* @tau_memory_alloc(i64 {}, {})".format(
+            beforeCast, size64, self.memorySite(allocID, line))
+
+    def memorySite(self, allocID, line):
+        '''Defines the counters and label of an allocation site for the memory
+           runtime, and returns them as call arguments.'''
+        label = self.functionName if line is None else "{}:{}".format(self.functionName, line)
+        words = runtime.memorySiteWords
+        self.ensureDeclared("tau_site_{}".format(allocID), "@tau_site_{} = internal global "
+                            "[{} x i64] zeroinitializer".format(allocID, words))
+        self.ensureDeclared("tau_site_label_{}".format(allocID), '@tau_site_label_{} = private '
+                            'constant [{} x i8] c"{}\\00"'.format(allocID, len(label)+1, label))
+        return ("i8* bitcast ([{0} x i64]* @tau_site_{1} to i8*), i8* getelementptr "
+                "([{2} x i8], [{2} x i8]* @tau_site_label_{1}, i64 0, i64 0)"
+                .format(words, allocID, len(label)+1))
+
+    def beginProfile(self):
+        '''Emits the start of a profiled call to the function being compiled,
+           returning the registers its end needs.'''
+        self.runtimes.add('profile')
+        self.ensureDeclared("tau_profile_enter", "declare i64 @tau_profile_enter()")
+        self.ensureDeclared("llvm.readcyclecounter", "declare i64 @llvm.readcyclecounter()")
+        before, start = self.newRegister(), self.newRegister()
+        self.out += ["{} = call i64 @tau_profile_enter()".format(before)]
+        self.out += ["{} = call i64 @llvm.readcyclecounter()".format(start)]
+        return before, start
+
+    def endProfile(self, before, start):
+        '''Emits the end of a profiled call to the function being compiled,
+           which counts it and its cycles.'''
+        name = self.functionName
+        self.ensureDeclared("tau_profile_exit",
+                            "declare void @tau_profile_exit(i8*, i8*, i64, i64)")
+        self.ensureDeclared("tau_profile_" + name, "@tau_profile_{} = internal global "
+                            "[6 x i64] zeroinitializer".format(name))
+        self.ensureDeclared("tau_profile_name_" + name, '@tau_profile_name_{} = private '
+                            'constant [{} x i8] c"{}\\00"'.format(name, len(name)+1, name))
+        self.out += ["call void @tau_profile_exit(i8* bitcast ([6 x i64]* @tau_profile_{0} to "
+                     "i8*), i8* getelementptr ([{1} x i8], [{1} x i8]* @tau_profile_name_{0}, "
+                     "i64 0, i64 0), i64 {2}, i64 {3})".format(name, len(name)+1, start, before)]
+
+    def checkIndex(self, array, index):
+        '''Emits a check that index is within the bounds of array, which
+           stops the program with an error message if it is not.'''
+        n = self.blockCounter
+        self.blockCounter += 1
+        length, inBounds = self.newRegister(), self.newRegister()
+        message = "ERROR: Index %d is out of bounds for an array of length %d."
+        messageType = "[{} x i8]".format(len(message)+2)
+        self.ensureDeclared("dprintf", "declare i32 @dprintf(i32, i8*, ...)")
+        self.ensureDeclared("abort", "declare void @abort() noreturn")
+        self.ensureDeclared("tau_bounds_message", '@tau_bounds_message = private unnamed_addr '
+                            'constant {} c"{}\\0A\\00"'.format(messageType, message))
+        lines = ["{} = extractvalue {} {}, 1".format(length, array.irname, array.addr),
+                 "{} = icmp ult i32 {}, {}".format(inBounds, index.addr, length),
+                 "br i1 {}, label %bounds{}_ok, label %bounds{}_fail".format(inBounds, n, n),
+                 "bounds{}_fail:".format(n),
+                 "call i32 (i32, i8*, ...) @dprintf(i32 2, i8* getelementptr ({0}, {0}* "
+                 "@tau_bounds_message, i32 0, i32 0), i32 {1}, i32 {2})"
+                 .format(messageType, index.addr, length),
+                 "call void @abort()", "unreachable", "bounds{}_ok:".format(n)]
+        self.out += lines
+        # Within a loop over range(len(a)), checks of a[i] may be removed when it ends
+        names = (self.loadedFrom.get(index.addr), self.loadedFrom.get(array.addr))
+        for loop in reversed(self.lengthLoops):
+            if (loop['counter'], loop['array']) == names:
+                loop['checks'][lines[0]] = len(lines)
+                break
+        return
+
+    def beginLengthLoop(self, counter, arrayName):
+        '''Records the start of a loop whose counter runs over range(len(a)).
+           Only local variables qualify, since globals may be assigned by the
+           functions the loop calls.'''
+        isLocal = [name in self.localVars and name not in TauModule.globalVars
+                   for name in (counter, arrayName)]
+        self.lengthLoops.append({'counter': counter, 'array': arrayName, 'out': self.out,
+                                 'checks': {}, 'valid': all(isLocal)})
+        return
+
+    def endLengthLoop(self):
+        '''Removes the bounds checks of a[i] in the loop that just ended, if
+           neither i nor a were assigned in its body, since then i is always
+           less than the length of a.'''
+        loop = self.lengthLoops.pop()
+        if loop['valid'] and loop['checks']:
+            # Each check is a run of lines starting with a unique one
+            out, kept, i = loop['out'], [], 0
+            while i < len(out):
+                if out[i] in loop['checks']:
+                    i += loop['checks'][out[i]]
+                else:
+                    kept.append(out[i])
+                    i += 1
+            out[:] = kept
+        return
+
+    def assigned(self, name):
+        '''Records that a variable was assigned to, which invalidates the
+           removal of bounds checks in loops over it.'''
+        for loop in self.lengthLoops:
+            if name in (loop['counter'], loop['array']):
+                loop['valid'] = False
+        return
+
+    def beginFunction(self):
+        '''Clears the record of what the function being compiled does to arrays.'''
+        self.arrayWrites = set()
+        self.arrayGlobals = set()
+        self.capturesArrays = False
+        return
+
+    def aliasesOf(self, name):
+        '''Returns the (modifiable) set of array variables that the variable
+           name may share memory with.'''
+        if name in TauModule.globalVars:
+            return TauModule.globalAliases.setdefault(name, set())
+        return self.localAliases.setdefault(name, set())
+
+    def callArrays(self, funcName, args, inputs):
+        '''Checks the array arguments of a call to a user function, which
+           assumes that its array parameters do not alias, and records what
+           the call does to arrays.  Arguments which may share memory are
+           rejected if the function writes to either one, as are those which
+           may share memory with a global array it uses.  Returns the array
+           variables that the result may point into.'''
+        writes, used, captures = TauModule.arrayEffects[funcName]
+        targets = [(argName, self.pointsTo.get(value.addr, set()))
+                   for (dtype, argName), value in zip(args, inputs) if hasattr(dtype, 'subtype')]
+        for i, (name, first) in enumerate(targets):
+            for other, second in targets[i+1:]:
+                if first & second and (name in writes or other in writes):
+                    raise ValueError("ERROR: Array arguments {0} and {1} of {2} may be the "
+                                     "same array, and {2} writes to one of them."
+                                     .format(name, other, funcName))
+            for shared in first & used:
+                if name in writes or shared in writes:
+                    raise ValueError("ERROR: Array argument {0} of {1} may be the global "
+                                     "array {2}, which {1} also uses.".format(name, funcName,
+                                                                              shared))
+            if name in writes:
+                self.arrayWrites |= first
+        if captures:
+            self.capturesArrays = True
+            for value in inputs:
+                self.escapes(value)
+        self.arrayWrites |= writes & used
+        self.arrayGlobals |= used
+        result = set(used)
+        for name, pointsTo in targets:
+            result |= pointsTo
+        return result
+
     def markMemory(self, allocID, managementStr):
         '''Sets the memory management of a given block to the given string.'''
         try:
-            self.allocations[allocID][0] = managementStr
+            allocation = self.allocations[allocID]
         except (KeyError, IndexError):
             raise ValueError("INTERNAL ERROR: Tried to mark memory of unknown allocation!")
+        if allocation[0] in ("arena", "stack") and managementStr != allocation[0]:
+            # Outliving the scope, so allocate it from the heap instead
+            out, line, heapLine = allocation[2:]
+            for i in range(len(out)-1, -1, -1):
+                if out[i] == line:
+                    out[i] = heapLine
+                    break
+        allocation[0] = managementStr
+        return
+
+    def escapes(self, value, variable=None):
+        '''Marks the temporary arrays that a value may point into as
+           userManaged, as it is kept past the end of the current scope.  If
+           it is kept in the given local variable instead, arrays on the stack
+           stay there, unless the variable may share them with another one
+           (as a later iteration of a loop would then overwrite them).'''
+        # Variables holding an array also share memory with the arrays they were given
+        pointsTo = self.pointsTo.get(value.addr, set())
+        keep = (variable is not None
+                and all(name.startswith('#') for name in pointsTo | self.aliasesOf(variable)))
+        for name in pointsTo:
+            if name.startswith('#') and int(name[1:]) in self.allocations:
+                allocation = self.allocations[int(name[1:])]
+                if allocation[0] == "stack" and keep:
+                    continue
+                if allocation[0] in ("arena", "stack", "freeAfterStatement"):
+                    self.markMemory(int(name[1:]), "userManaged")
+        return
+
+    def beginArenaScope(self):
+        '''Starts a scope (a statement or loop iteration) which releases the
+           temporaries allocated in it from the arena when it ends.'''
+        marker = "; arena scope {}".format(len(self.arenaScopes))
+        self.arenaScopes.append({'marker': marker, 'out': self.out, 'allocations': []})
+        self.out.append(marker)
+        return
+
+    def endArenaScope(self):
+        '''Ends the innermost arena scope.  If any temporaries were taken
+           from the arena in it, the arena is marked where it began and
+           released to that mark here.'''
+        scope = self.arenaScopes.pop()
+        out = scope['out']
+        for i in range(len(out)-1, -1, -1):
+            if out[i] == scope['marker']:
+                break
+        # (Temporaries freed with free() were moved to the heap, and are already forgotten)
+        inArena = [k for k in scope['allocations']
+                   if k in self.allocations and self.allocations[k][0] == "arena"]
+        if not inArena:
+            del out[i]
+        else:
+            mark = self.newRegister()
+            out[i] = "{} = call i64 @tau_arena_mark()".format(mark)
+            self.ensureDeclared("tau_arena_mark", "declare i64 @tau_arena_mark()")
+            self.ensureDeclared("tau_arena_release", "declare void @tau_arena_release(i64)")
+            self.out += ["call void @tau_arena_release(i64 {})".format(mark)]
+        for k in inArena:
+            del TauModule.allocations[k]
+            if self.debugMemory:
+                sys.stderr.write("MEMORY: Will release allocation ID {} from the arena.\n"
+                                 .format(k))
         return
 
     def endScope(self):
         for k in list(self.allocations.keys()):
             if self.allocations[k][0] == "freeAfterStatement":
                 self.freeMemory(k, self.allocations[k][1])
+            elif self.allocations[k][0] == "stack":
+                del TauModule.allocations[k]
         self.localVars = {}
+        self.localAliases = {}
 
     def freeMemory(self, allocID, addr):
-        self.ensureDeclared("free", "declare void @free(i8*)")
         if allocID not in self.allocations.keys():
             raise ValueError("INTERNAL ERROR: Tried to free memory I don't remember allocating!")
-        self.out += ["call void @free(i8* {})".format(addr)]
+        if self.trackMemory:
+            self.runtimes.add('memory')
+            self.ensureDeclared("tau_memory_free", "declare void @tau_memory_free(i8*)")
+            self.out += ["call void @tau_memory_free(i8* {})".format(addr)]
+        else:
+            self.ensureDeclared("free", "declare void @free(i8*)")
+            self.out += ["call void @free(i8* {})".format(addr)]
         del TauModule.allocations[allocID]
         if self.debugMemory:
             sys.stderr.write("MEMORY: Will free allocation ID {}.\n".format(allocID))
@@ -147,36 +464,82 @@ class TauModule():
 
     def callIfNeeded(self, jit):
         '''If the last JIT compilation created an anonymous function, run it.'''
-        ret, name = self.lastAnonymous
+        return self.callAnonymous(jit, *self.lastAnonymous)
+
+    def callAnonymous(self, jit, ret, name):
+        '''Runs an anonymous function from this module and returns its result.'''
         if ret is not None and ret.ctype is not None:
             return (ctypes.CFUNCTYPE(ret.ctype)(jit.get_function_address(name)))()
         else:
             (ctypes.CFUNCTYPE(ctypes.c_int)(jit.get_function_address(name)))()
             return
 
+    def endEntryPoint(self):
+        '''Moves the top-level code so far into a new anonymous function, which
+           returns the last output.'''
+        name = self.newAnonymousFunction()
+        ret = self.lastOutput
+        if ret is not None:
+            self.entryPoints += ["define {} @{}()".format(ret.irname, name) + "{", "entry:"]
+            self.entryPoints += self.main
+            self.entryPoints += ["ret {} {}".format(ret.irname, ret.addr), "}"]
+        else:
+            self.entryPoints += ["define void @{}()".format(name) + "{", "entry:"]
+            self.entryPoints += self.main + ["ret void", "}"]
+        self.anonymousFunctions.append((ret, name))
+        self.lastAnonymous = ret, name
+        self.main = []
+        self.lastOutput = None
+        return
+
+    def defineMapKernel(self, funcName, isArray):
+        '''Defines a function which calls the scalar user function funcName
+           on each element of its array arguments, storing the results in an
+           output array.  isArray gives whether each argument is an array or
+           a scalar broadcast to every element.  The kernel takes the
+           arguments, then the output pointer and the number of elements.'''
+        dtype, args = TauModule.userFunctions[funcName]
+        argTypes = ', '.join(t.irname for t, argName in args)
+        self.ensureDeclared(funcName, 'declare {} @{}({})'.format(dtype.irname, funcName, argTypes))
+        name = "{}__map_{}".format(funcName, ''.join('a' if a else 's' for a in isArray))
+        params = ["{}{} %arg_{}".format(t.irname, '*' if a else '', i)
+                  for i, ((t, argName), a) in enumerate(zip(args, isArray))]
+        params += ["{}* %out".format(dtype.irname), "i32 %n"]
+        self.body += ["define void @{}({})".format(name, ', '.join(params)) + "{", "entry:"]
+        self.body += ["br label %loop_condition", "loop_condition:"]
+        self.body += ["%i = phi i32 [0, %entry], [%next, %loop_body]"]
+        self.body += ["%done = icmp sge i32 %i, %n"]
+        self.body += ["br i1 %done, label %loop_end, label %loop_body", "loop_body:"]
+        values = []
+        for i, ((t, argName), a) in enumerate(zip(args, isArray)):
+            if a:
+                pointer = self.newRegister()
+                value = self.newRegister()
+                self.body += ["{} = getelementptr {}, {}* %arg_{}, i32 %i"
+                              .format(pointer, t.irname, t.irname, i)]
+                self.body += ["{} = load {}, {}* {}".format(value, t.irname, t.irname, pointer)]
+                values.append("{} {}".format(t.irname, value))
+            else:
+                values.append("{} %arg_{}".format(t.irname, i))
+        result = self.newRegister()
+        pointer = self.newRegister()
+        self.body += ["{} = call {} @{}({})".format(result, dtype.irname, funcName,
+                                                    ', '.join(values))]
+        self.body += ["{} = getelementptr {}, {}* %out, i32 %i"
+                      .format(pointer, dtype.irname, dtype.irname)]
+        self.body += ["store {} {}, {}* {}".format(dtype.irname, result, dtype.irname, pointer)]
+        self.body += ["%next = add i32 %i, 1", "br label %loop_condition", "loop_end:"]
+        self.body += ["ret void", "}"]
+        return name
+
     def __str__(self):
         '''Print the module as IR code.'''
+        if self.replMode and (self.main or not self.anonymousFunctions):
+            self.endEntryPoint()
         out = list(self.header)
-        out += ["    "*bool(re.match(r'(:$|\s*^define|}$)', l))+l for l in self.body]
-        if self.main or self.replMode:
-            mainName = "main"
-            ret = None
-            if self.replMode:
-                mainName = self.newAnonymousFunction()
-                if self.lastOutput:
-                    ret = self.lastOutput
-                else:
-                    ret = None
-                self.lastAnonymous = ret, mainName
-            if ret is not None:
-                out += ["define {} @{}()".format(ret.irname, mainName) + "{"]
-                out += ["entry:"]
-                out += ["    "*(':' not in l)+l for l in self.main]
-                out += ["    ret {} {}".format(ret.irname, ret.addr)+'\n}']
-            else:
-                out += ["define void @{}()".format(mainName) + "{"]
-                out += ["entry:"]
-                out += ["    "*(':' not in l)+l for l in self.main]
-                out += ["    ret void\n}"]
+        out += self.body + self.outlined
+        if self.main:
+            out += ["define void @main(){", "entry:"] + self.main + ["ret void", "}"]
             self.lastOutput = None
+        out += self.entryPoints
         return '\n'.join(out) + '\n'
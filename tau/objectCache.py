@@ -0,0 +1,68 @@
+import hashlib
+import os
+import tempfile
+import llvmlite.binding as llvm
+
+
+class ObjectCache():
+    '''Stores compiled object code on disk, keyed by a hash of everything that
+       determines it.  The total size of the cache is kept under sizeLimit
+       bytes by deleting the least recently used objects.'''
+    def __init__(self, directory, sizeLimit=64*2**20):
+        self.directory = os.path.expanduser(directory)
+        self.sizeLimit = sizeLimit
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, irCode, targetMachine, optLevel):
+        '''Returns the key for the object compiled from the given IR code.'''
+        parts = [irCode, targetMachine.triple, llvm.get_host_cpu_name(),
+                 llvm.get_host_cpu_features().flatten(), str(optLevel),
+                 str(llvm.llvm_version_info)]
+        return hashlib.sha256('\0'.join(parts)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".o")
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def load(self, key):
+        '''Returns the object code stored under key, or None if there is none.'''
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+            # The modification time records when an object was last used
+            os.utime(self.path(key), None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def store(self, key, data):
+        '''Stores object code under key, then evicts objects as needed.'''
+        # Write to a temporary file first so that other processes never see a partial object
+        handle, tempPath = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.rename(tempPath, self.path(key))
+        self.evict()
+
+    def evict(self):
+        '''Deletes the least recently used objects until the cache fits in its size limit.'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".o"):
+                try:
+                    info = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.sizeLimit:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
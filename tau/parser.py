@@ -1,24 +1,42 @@
 import llvmlite.binding as llvm
+import ctypes
+import json
 import subprocess
 import os
+import re
 import sys
+import tempfile
+import time
 import lexer
 import ast
 import dtypes
 import builtins
 import module
+import runtime
+import phases
 from inputBuffer import InputBuffer
+from objectCache import ObjectCache
+from functionHandle import getCallable, ArrayKernel
 
 
 class TauJIT():
     def __init__(self, debugIR=False, debugAST=False, quiet=True,
-                 debugLexer=False, debugMemory=False):
+                 debugLexer=False, debugMemory=False, optLevel=0, cacheDir=None,
+                 cacheSize=64*2**20, checkBounds=False, trackMemory=False, profile=False):
+        checkOptLevel(optLevel)
         # Record settings
         self.debugIR = debugIR
         self.debugAST = debugAST
         self.debugLexer = debugLexer
         self.debugMemory = debugMemory
+        self.checkBounds = checkBounds
+        self.trackMemory = trackMemory
+        self.profile = profile
         self.quiet = quiet
+        self.optLevel = optLevel
+        # Total seconds spent in the optimization passes, and in each phase of compiling
+        self.optimizerTime = 0.
+        self.stats = phases.PhaseStats()
         # Setup the execution engine
         llvm.initialize()
         llvm.initialize_native_target()
@@ -27,35 +45,179 @@ class TauJIT():
         out += ['@printFloat = global [4 x i8] c"%f\\0A\\00\"']
         out += ['@printInt = global [4 x i8] c"%i\\0A\\00"']
         target = llvm.Target.from_default_triple()
-        target_machine = target.create_target_machine()
+        self.targetMachine = target.create_target_machine()
         owner = llvm.parse_assembly('\n'.join(out))
-        self.jit = llvm.create_mcjit_compiler(owner, target_machine)
+        self.jit = llvm.create_mcjit_compiler(owner, self.targetMachine)
+        # Python callables for compiled functions, by name
+        self.functions = {}
+        # The runtime modules (see runtime.modules) compiled into the session so far
+        self.runtimes = set()
+        # Setup the on-disk cache of compiled modules, if requested
+        self.objectCache = None
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        if cacheDir is not None:
+            self.objectCache = ObjectCache(cacheDir, cacheSize)
+            self.jit.set_object_cache(self._storeObject_, self._loadObject_)
         return
 
+    def _loadObject_(self, mod):
+        '''Called by the execution engine before compiling a module; returns
+           its object code from the cache if possible.'''
+        if not mod.name.startswith("cached_"):
+            return None
+        data = self.objectCache.load(mod.name[7:])
+        if data is None:
+            self.cacheMisses += 1
+        else:
+            self.cacheHits += 1
+        return data
+
+    def _storeObject_(self, mod, data):
+        '''Called by the execution engine after compiling a module.'''
+        if mod.name.startswith("cached_"):
+            self.objectCache.store(mod.name[7:], data)
+
     def _runFromSource_(self, source, loop=False):
         '''Reads commands from the given InputBuffer objects and runs them
            as a new module in the current JIT session.'''
         # Generate the IR code from the source
-        m = module.TauModule(True, self.debugAST, self.debugLexer, self.debugMemory)
+        m = module.TauModule(True, self.debugAST, self.debugLexer, self.debugMemory,
+                             self.checkBounds, self.trackMemory, self.profile)
         if loop:
             while not source.end():
                 parseTopLevel(m, source, True)
         else:
             parseTopLevel(m, source, True)
-        irCode = str(m)
+        if not self._addModule_(m):
+            return
+        # Call the newly added function
+        m.endScope()
+        return m.callIfNeeded(self.jit)
+
+    def _addModule_(self, m):
+        '''Compiles a module into the current JIT session, returning whether
+           it succeeded.'''
+        irCode = textOf(m, self.stats)
         if self.debugIR:
             sys.stderr.write("===== BEGIN IR =====\n")
-            sys.stderr.write(irCode)
+            sys.stderr.write(indentIR(irCode))
             sys.stderr.write("===== END IR =====\n")
-        # Compile the IR code into the current JIT session
+        for name in sorted(m.runtimes - self.runtimes):
+            if self._addIR_(runtime.modules[name][0]):
+                self.runtimes.add(name)
+        return self._addIR_(irCode)
+
+    def _addIR_(self, irCode):
+        '''Optimizes IR code (unless it is cached) and adds it to the session.'''
         try:
-            mod = llvm.parse_assembly(irCode)
-            self.jit.add_module(mod)
+            with self.stats.phase('llvmParse'):
+                mod = llvm.parse_assembly(irCode)
+            optimize = True
+            if self.objectCache is not None:
+                # Name the module by its cache key so that the cache hooks can find it
+                key = self.objectCache.key(irCode, self.targetMachine, self.optLevel)
+                mod.name = "cached_" + key
+                # A cached object needs no optimization (if another process evicts it before
+                # it is loaded, the unoptimized module is compiled instead, which is still correct)
+                optimize = not self.objectCache.contains(key)
+            if optimize:
+                with self.stats.phase('optimize'):
+                    self.optimizerTime += optimizeModule(mod, self.optLevel, self.targetMachine)
+            # MCJIT generates code for the module when finalized, or else when first used
+            with self.stats.phase('codegen'):
+                self.jit.add_module(mod)
+                self.jit.finalize_object()
         except RuntimeError:
+            return False
+        return True
+
+    def runBatch(self, commands):
+        '''Runs a list of commands in the JIT session as runCommand would, and
+           returns the list of their results.  The commands are compiled into
+           a single module with an anonymous function for each, so the cost of
+           creating and compiling a module is paid only once.'''
+        m = module.TauModule(True, self.debugAST, self.debugLexer, self.debugMemory,
+                             self.checkBounds, self.trackMemory, self.profile)
+        for command in commands:
+            source = InputBuffer(command, self.quiet)
+            while not source.end():
+                parseTopLevel(m, source, True)
+            m.endEntryPoint()
+        if not self._addModule_(m):
             return
-        # Call the newly added function
         m.endScope()
-        return m.callIfNeeded(self.jit)
+        return [m.callAnonymous(self.jit, ret, name) for ret, name in m.anonymousFunctions]
+
+    def getFunction(self, name):
+        '''Returns a Python callable for a function compiled in this session.
+           Array arguments take buffer objects (like array.array or NumPy
+           arrays) of the right type, without copying them.'''
+        if name not in self.functions:
+            if name not in module.TauModule.userFunctions:
+                raise ValueError("ERROR: Function {} is not defined.".format(name))
+            dtype, args = module.TauModule.userFunctions[name]
+            if any(hasattr(t, 'width') for t in [dtype] + [t for t, argName in args]):
+                raise ValueError("ERROR: Functions of vector types cannot be called from Python.")
+            if hasattr(dtype, 'subtype'):
+                # The array would be returned as a pointer and length, and Python could not free it
+                raise ValueError("ERROR: Functions returning arrays cannot be called from Python.")
+            address = self.jit.get_function_address(name)
+            if not address:
+                raise ValueError("ERROR: Function {} was not compiled in this session."
+                                 .format(name))
+            writes, used, captures = module.TauModule.arrayEffects[name]
+            self.functions[name] = getCallable(address, name, dtype, args,
+                                               [argName in writes for t, argName in args])
+        return self.functions[name]
+
+    def vectorize(self, name):
+        '''Returns a callable which maps a scalar function compiled in this
+           session over arrays in native code.  Each argument may be a buffer
+           object or a scalar, which is broadcast to every element; results go
+           to the buffer given as the out keyword, or to a new array.array.'''
+        function = self.getFunction(name)
+        dtype, args = module.TauModule.userFunctions[name]
+        for t in [dtype] + [t for t, argName in args]:
+            if t not in (dtypes.Real, dtypes.Int):
+                raise ValueError("ERROR: Only functions of Real and Int values can be "
+                                 "vectorized, but {} uses {}.".format(name, t.name))
+
+        def compileKernel(isArray):
+            m = module.TauModule(False, self.debugAST, self.debugLexer, self.debugMemory)
+            kernelName = m.defineMapKernel(name, isArray)
+            if not self._addModule_(m):
+                raise ValueError("INTERNAL ERROR: Could not compile {}.".format(kernelName))
+            argTypes = [ctypes.c_void_p if a else t.ctype for (t, argName), a in zip(args, isArray)]
+            argTypes += [ctypes.c_void_p, ctypes.c_int]
+            return ctypes.CFUNCTYPE(None, *argTypes)(self.jit.get_function_address(kernelName))
+        return ArrayKernel(function, name, dtype, args, compileKernel)
+
+    def memoryStats(self):
+        '''Returns the heap memory used by code run in this session, which must
+           have been created with trackMemory set: the total allocations and
+           frees, the bytes live now and at the peak, and the same counts for
+           each allocation site (named by function and line), along with the
+           number of allocations of up to each power of two bytes.'''
+        if not self.trackMemory:
+            raise ValueError("ERROR: Memory is only tracked in sessions created with "
+                             "trackMemory=True.")
+        if 'memory' not in self.runtimes:
+            return {'allocations': 0, 'frees': 0, 'liveBytes': 0, 'peakBytes': 0, 'sites': {}}
+        return runtime.readMemoryStats(self.jit.get_global_value_address("tau_memory_stats"),
+                                       self.jit.get_global_value_address("tau_memory_sites"))
+
+    def profileStats(self):
+        '''Returns the calls to each function defined in this session, which
+           must have been created with profile set, and the processor cycles
+           spent in them, including (inclusiveCycles) and excluding
+           (exclusiveCycles) those spent in the functions they call.'''
+        if not self.profile:
+            raise ValueError("ERROR: Functions are only profiled in sessions created with "
+                             "profile=True.")
+        if 'profile' not in self.runtimes:
+            return {}
+        return runtime.readProfile(self.jit.get_global_value_address("tau_profile_functions"))
 
     def runCommand(self, commandString):
         '''Runs a command (or series of commands) in the JIT session.'''
@@ -76,86 +238,390 @@ class TauJIT():
                 print str(e).strip()
             if output is not None and not self.quiet:
                 print output
+        if self.optLevel > 0 and not self.quiet:
+            print "Time spent optimizing: {:.3f} s".format(self.optimizerTime)
+        if 'memory' in self.runtimes:
+            ctypes.CFUNCTYPE(None)(self.jit.get_function_address("tau_memory_report"))()
+        if 'profile' in self.runtimes:
+            ctypes.CFUNCTYPE(None, ctypes.c_int)(
+                self.jit.get_function_address("tau_profile_write"))(2)
         return
 
 
+def checkOptLevel(optLevel):
+    '''Raises a ValueError unless optLevel is a valid optimization level.'''
+    if optLevel not in range(4):
+        raise ValueError("ERROR: Optimization level must be 0, 1, 2, or 3, not {}."
+                         .format(optLevel))
+
+
+def optimizeModule(mod, optLevel, targetMachine):
+    '''Runs the standard LLVM module pass pipeline for the given optimization
+       level (0-3, as in -O0..-O3) on a parsed module in place.  Returns the
+       time spent in seconds.'''
+    checkOptLevel(optLevel)
+    if optLevel == 0:
+        return 0.
+    start = time.time()
+    builder = llvm.create_pass_manager_builder()
+    builder.opt_level = optLevel
+    builder.loop_vectorize = optLevel >= 2
+    builder.slp_vectorize = optLevel >= 2
+    if optLevel >= 2:
+        # The inlining thresholds clang uses for -O2 and -O3
+        builder.inlining_threshold = [225, 275][optLevel-2]
+    passes = llvm.create_module_pass_manager()
+    targetMachine.add_analysis_passes(passes)
+    builder.populate(passes)
+    passes.run(mod)
+    return time.time() - start
+
+
+def indentIR(irCode):
+    '''Indents the instructions in IR code for display.  The module emits
+       them unindented, since that costs time and LLVM ignores it.'''
+    lines = irCode.split('\n')
+    for i, line in enumerate(lines):
+        if line and not (line.endswith(':') or line.endswith('{') or line[0] in '}@'
+                         or line.startswith('declare')):
+            lines[i] = "    " + line
+    return '\n'.join(lines)
+
+
 def compileFile(filename, outputFile="a.out", debugIR=False, debugAST=False,
-                debugLexer=False, debugMemory=False, quiet=False):
-    '''Reads Tau code from a given file and compiles it to an executable.'''
-    # Header information
-    m = module.TauModule(False, debugAST, debugLexer, debugMemory)
+                debugLexer=False, debugMemory=False, quiet=False, optLevel=3, cacheDir=None,
+                checkBounds=False, trackMemory=False, profile=False):
+    '''Reads Tau code from a given file and compiles it, optimizing at the
+       given level (0-3).  The output is an object file if outputFile ends in
+       .o, a shared library if it ends in .so, and otherwise an executable.
+       If cacheDir is given, each function is compiled separately and reused
+       from the cache until its source or the functions it uses change.  If
+       checkBounds is set, indexing outside of an array stops the program.
+       If trackMemory is set, heap allocations are counted, and executables
+       print the counts when they exit.  If profile is set, executables write
+       the calls and cycles of each function to a file when they exit.
+       Returns the time spent in each phase of compiling, as PhaseStats.'''
+    checkOptLevel(optLevel)
+    llvm.initialize()
+    llvm.initialize_native_target()
+    llvm.initialize_native_asmprinter()
+    targetMachine = llvm.Target.from_default_triple().create_target_machine(
+        opt=optLevel, reloc='pic')
+    settings = (debugIR, debugAST, debugLexer, debugMemory, quiet, optLevel, targetMachine,
+                checkBounds, trackMemory, profile)
+    stats = phases.PhaseStats()
+    # The functions of the file being compiled are kept apart from those of any JIT sessions
+    jitFunctions = module.TauModule.userFunctions, module.TauModule.arrayEffects
+    module.TauModule.userFunctions, module.TauModule.arrayEffects = {}, {}
+    try:
+        if cacheDir is None:
+            sourceFile = open(filename, 'r')
+            m = newFileModule(settings, True)
+            source = InputBuffer(sourceFile, quiet)
+            while not source.end():
+                parseTopLevel(m, source)
+            sourceFile.close()
+            objects = [emitObject(m, settings, stats)]
+        else:
+            objects = compileUnits(filename, settings, ObjectCache(cacheDir), stats)
+    finally:
+        module.TauModule.userFunctions, module.TauModule.arrayEffects = jitFunctions
+    # Objects needing a runtime module (including cached ones) name its entry point
+    needed = [name for name in sorted(runtime.modules)
+              if any(runtime.modules[name][1] in objectCode for objectCode in objects)]
+    if 'trackedArena' in needed and 'memory' not in needed:
+        # The tracked arena allocates its large temporaries through the memory runtime
+        needed.insert(0, 'memory')
+    irCodes = [runtime.modules[name][0] for name in needed]
+    if not outputFile.endswith((".o", ".so")):
+        irCodes += [runtime.memoryReportAtExit] if 'memory' in needed else []
+        irCodes += [runtime.profileReportAtExit] if 'profile' in needed else []
+    for irCode in irCodes:
+        objects.append(compileIR(irCode, optLevel, targetMachine, stats))
+    if optLevel > 0 and not quiet:
+        sys.stderr.write("Time spent optimizing: {:.3f} s\n".format(stats.times['optimize']))
+    with stats.phase('link'):
+        linkObjects(objects, outputFile)
+    return stats
+
+
+def compileUnits(filename, settings, cache, stats):
+    '''Compiles each function definition in a file to its own object, and
+       the top-level statements together to another, reusing objects from the
+       cache when possible.  Returns the objects, recording the time spent in
+       stats.'''
+    quiet, optLevel, targetMachine, checkBounds, trackMemory, profile = settings[4:]
+    # Bounds checks, memory tracking and profiling change the code, so such objects are
+    # cached apart
+    variant = (" with bounds checks" if checkBounds else "") + (
+        " with memory tracking" if trackMemory else "") + (" with profiling" if profile else "")
+    with open(filename, 'r') as sourceFile:
+        units = splitTopLevel(sourceFile.read())
+    # Signatures and array effects of the functions defined so far
+    signatures = {}
+    objects = []
+    statements = []
+    for firstLine, lines in units:
+        if not re.match(r"def\b", lines[0]):
+            statements.append((firstLine, lines))
+            continue
+        with stats.phase('lex'):
+            funcName, dtype, args = functionSignature(lexer.lex(lines[0], False, firstLine))
+        if funcName in module.TauModule.userFunctions:
+            raise ValueError("ERROR: Function {} is already defined.".format(funcName))
+        fingerprint = unitFingerprint(lines, signatures) + variant
+        key = cache.key(fingerprint, targetMachine, optLevel)
+        # What the function does to its array arguments is cached next to its object, since
+        # callers are compiled differently depending on it
+        effectsKey = cache.key(fingerprint + " array effects", targetMachine, optLevel)
+        objectCode, effects = cache.load(key), cache.load(effectsKey)
+        if objectCode is None or effects is None:
+            m = newFileModule(settings, False)
+            parseTopLevel(m, InputBuffer('\n'.join(lines), quiet, firstLine))
+            objectCode = emitObject(m, settings, stats)
+            cache.store(key, objectCode)
+            writes, used, captures = module.TauModule.arrayEffects[funcName]
+            cache.store(effectsKey, json.dumps([sorted(writes), sorted(used), captures]))
+        else:
+            # Record the function for its callers as parsing it would have
+            writes, used, captures = json.loads(effects)
+            writes, used = set(map(str, writes)), set(map(str, used))
+            module.TauModule.userFunctions[funcName] = (dtype, args)
+            module.TauModule.arrayEffects[funcName] = (writes, used, captures)
+        signatures[funcName] = repr((funcName, dtype.name, [(t.name, n) for t, n in args],
+                                     sorted(writes), sorted(used), captures))
+        objects.append(objectCode)
+    # The top-level statements go in main, along with the globals used to print
+    key = cache.key("\n".join(unitFingerprint(lines, signatures) for l, lines in statements)
+                    + variant, targetMachine, optLevel)
+    objectCode = cache.load(key)
+    if objectCode is None:
+        m = newFileModule(settings, True)
+        for firstLine, lines in statements:
+            source = InputBuffer('\n'.join(lines), quiet, firstLine)
+            while not source.end():
+                parseTopLevel(m, source)
+        objectCode = emitObject(m, settings, stats)
+        cache.store(key, objectCode)
+    objects.append(objectCode)
+    return objects
+
+
+def splitTopLevel(code):
+    '''Splits source code into blocks that each start with an unindented
+       line, returned as the number of their first line and their lines.
+       Whitespace-only lines are emptied, so that InputBuffer skips them as
+       it does when reading a file.'''
+    units = []
+    for i, line in enumerate(code.splitlines()):
+        if not units or (line.strip() and not line[0].isspace()):
+            units.append((i+1, []))
+        units[-1][1].append(line if line.strip() else "")
+    return [(firstLine, lines) for firstLine, lines in units if ''.join(lines).strip()]
+
+
+def unitFingerprint(lines, signatures):
+    '''Returns the source of a unit (less blank lines) along with the
+       signatures and array effects of the functions it may call, which
+       together determine its object code.'''
+    lines = [line for line in lines if line.strip()]
+    names = set(re.findall(r"[a-zA-Z_]\w*", '\n'.join(lines)))
+    return '\n'.join(lines + [signatures[n] for n in sorted(names) if n in signatures])
+
+
+def newFileModule(settings, defineGlobals):
+    '''Creates a module for compiling a file, which defines the globals
+       used by print if requested.'''
+    debugIR, debugAST, debugLexer, debugMemory = settings[:4]
+    m = module.TauModule(False, debugAST, debugLexer, debugMemory, *settings[7:])
     m.ensureDeclared("printf", 'declare i32 @printf(i8* nocapture readonly, ...)')
-    m.ensureDeclared("printFloat", '@printFloat = global [4 x i8] c"%f\\0A\\00\"')
-    m.ensureDeclared("printInt", '@printInt = global [4 x i8] c"%i\\0A\\00"')
-    # Read through the source code to be compiled
-    sourceFile = open(filename, 'r')
-    source = InputBuffer(sourceFile, quiet)
-    while not source.end():
-        parseTopLevel(m, source)
-    sourceFile.close()
-    # Convert the module to IR Code
-    irCode = str(m)
+    if defineGlobals:
+        m.ensureDeclared("printFloat", '@printFloat = global [4 x i8] c"%f\\0A\\00\"')
+        m.ensureDeclared("printInt", '@printInt = global [4 x i8] c"%i\\0A\\00"')
+    return m
+
+
+def emitObject(m, settings, stats):
+    '''Optimizes a module and generates its object code, recording the time
+       spent in stats.'''
+    debugIR, optLevel, targetMachine = settings[0], settings[5], settings[6]
+    irCode = textOf(m, stats)
     if debugIR:
         sys.stderr.write("===== BEGIN IR =====\n")
-        sys.stderr.write(irCode)
+        sys.stderr.write(indentIR(irCode))
         sys.stderr.write("===== END IR =====\n")
-    # Write the IR code to a temporary file and compile it to an executable
-    tempFile = "/tmp/" + os.path.splitext(os.path.basename(filename))[0]
-    f = open(tempFile+".ll", 'w')
-    f.write(irCode)
-    f.close()
-    subprocess.call(["llc", tempFile+".ll", "--filetype=obj", "-O3", "-o", tempFile+".o"])
-    subprocess.call(["gcc", tempFile+".o", '-lm', '-o', outputFile])
+    return compileIR(irCode, optLevel, targetMachine, stats)
+
+
+def textOf(m, stats):
+    '''Returns the IR code of a module, adding the statistics of compiling it
+       to stats.'''
+    with stats.phase('irText'):
+        irCode = str(m)
+    stats.add(m.stats)
+    stats.counts['irLines'] += irCode.count('\n') + 1
+    stats.counts['registers'] += m.numRegisters
+    return irCode
+
+
+def compileIR(irCode, optLevel, targetMachine, stats):
+    '''Parses, optimizes and generates the object code of IR code, recording
+       the time spent in stats.'''
+    with stats.phase('llvmParse'):
+        mod = llvm.parse_assembly(irCode)
+    with stats.phase('optimize'):
+        optimizeModule(mod, optLevel, targetMachine)
+    with stats.phase('codegen'):
+        return targetMachine.emit_object(mod)
+
+
+def linkObjects(objects, outputFile):
+    '''Links object code into an executable or shared library, or for an
+       output ending in .o, writes it directly (combining several objects
+       into one relocatable object).'''
+    if outputFile.endswith(".o") and len(objects) == 1:
+        with open(outputFile, 'wb') as f:
+            f.write(objects[0])
+        return
+    objectFiles = []
+    try:
+        for objectCode in objects:
+            handle, objectFile = tempfile.mkstemp(suffix=".o")
+            objectFiles.append(objectFile)
+            with os.fdopen(handle, 'wb') as f:
+                f.write(objectCode)
+        if outputFile.endswith(".o"):
+            subprocess.call(["ld", "-r"] + objectFiles + ["-o", outputFile])
+        else:
+            linkOptions = ['-shared'] if outputFile.endswith(".so") else []
+            subprocess.call(["gcc"] + objectFiles + ['-lm', '-lpthread', '-o', outputFile] +
+                            linkOptions)
+    finally:
+        for objectFile in objectFiles:
+            os.remove(objectFile)
     return
 
 
+def functionSignature(blockHead):
+    '''Returns the name, return type and arguments declared by the tokens
+       of a def line.'''
+    dtype = dtypes.getType(blockHead[1].data)
+    funcName = blockHead[2].data[0]
+    args = [[dtypes.getType(i.data), j.data]
+            for i, j in ast.splitArguments(blockHead[2].data[1])]
+    return funcName, dtype, args
+
+
+def functionDefinition(funcName, dtype, args, noCapture):
+    '''Returns the define line of a function.  Array parameters are passed as
+       a pointer and a length, and are promised not to alias each other (as
+       callers check), and if noCapture is set, not to be kept after the call.'''
+    params = []
+    for argType, argName in args:
+        if hasattr(argType, 'subtype'):
+            params.append("{}* noalias {}%arg_{}".format(argType.subtype.irname,
+                                                         "nocapture " if noCapture else "",
+                                                         argName))
+            params.append("i32 %len_" + argName)
+        else:
+            params.append(argType.irname + " %arg_" + argName)
+    return "define {} @{}({})".format(dtype.irname, funcName, ", ".join(params)) + "{"
+
+
+def lexLine(mod, line, lineNumber=None):
+    '''Lexes a line of source, recording the time and tokens in the module's
+       statistics.'''
+    with mod.stats.phase('lex'):
+        tokens = lexer.lex(line, mod.debugLexer, lineNumber)
+        mod.stats.counts['tokens'] += lexer.countTokens(tokens)
+    return tokens
+
+
+def evaluateTokens(mod, tokens, dtype=None):
+    '''Builds the AST of an expression, converted to dtype if given, and emits
+       its IR, recording the time of each in the module's statistics.  Returns
+       the result.'''
+    with mod.stats.phase('parse'):
+        node = ast.ASTNode(tokens, mod)
+        if dtype is not None:
+            node = node.castTo(dtype)
+        node = node.simplify()
+    with mod.stats.phase('emit'):
+        return node.evaluate()
+
+
 def parseTopLevel(mod, source, forJIT=False):
     # Classify the block
     try:
-        blockHead = lexer.lex(source.peek(), False)
+        with mod.stats.phase('lex'):
+            blockHead = lexer.lex(source.peek(), False)
     except Exception:
         # Clear the bad line from the buffer
         source.getLine()
         raise
     if blockHead[0].name == 'def':
         # Determine function name and return type
-        blockHead = lexer.lex(source.getLine(), mod.debugLexer)
-        dtype = dtypes.getType(blockHead[1].data)
-        funcName = blockHead[2].data[0]
-        args = [[dtypes.getType(i.data), j.data]
-                for i, j in ast.splitArguments(blockHead[2].data[1])]
+        line = source.getLine()
+        blockHead = lexLine(mod, line, source.lineNumber)
+        funcName, dtype, args = functionSignature(blockHead)
         if funcName in mod.userFunctions.keys():
             raise ValueError("ERROR: Function {} is already defined.".format(funcName))
         # Handle function arguments
-        mod.body += ["define {} @{}({})".format(dtype.irname, funcName,
-                     ",".join([i.irname+" %arg_"+j for i, j in args])) + "{"]
-        mod.body += ["entry:"]
+        defineLine = len(mod.body)
+        mod.body += [functionDefinition(funcName, dtype, args, False), "entry:"]
+        mod.beginFunction()
+        mod.functionName = funcName
         for argType, argName in args:
             mem = mod.newVariable(argName, argType)
+            value = "%arg_"+argName
+            if hasattr(argType, 'subtype'):
+                # Arrays are passed as their data pointer and length
+                value, partial = mod.newRegister(), mod.newRegister()
+                mod.body += ["{} = insertvalue {} undef, {}* %arg_{}, 0"
+                             .format(partial, argType.irname, argType.subtype.irname, argName)]
+                mod.body += ["{} = insertvalue {} {}, i32 %len_{}, 1"
+                             .format(value, argType.irname, partial, argName)]
             mod.body += ["store {} {}, {}* {}"
-                         .format(argType.irname, "%arg_"+argName, mem.irname, mem.addr)]
+                         .format(argType.irname, value, mem.irname, mem.addr)]
+        if mod.profile:
+            profileRegisters = mod.beginProfile()
         # Read in the function body
         output = None
         if source.end(1):
             raise ValueError("ERROR: Expected a block (maybe you forgot to indent?)")
+        mod.beginArenaScope()
         while not source.end(1):
             result = parseBlock(mod, source, 1)
             if result is not None:
                 output = result
+        if output is not None:
+            mod.escapes(output)
+        mod.endArenaScope()
         # Check that the return type is correct and end the function definition
         if output is None or (dtype.name != output.name):
             raise ValueError("ERROR: Return type {} does not match declaration {}."
                              .format(output.name, dtype.name))
         mod.userFunctions[funcName] = (dtype, args)
+        captures = mod.capturesArrays or hasattr(dtype, 'subtype')
+        mod.arrayEffects[funcName] = (mod.arrayWrites & set([a for t, a in args] +
+                                                            list(mod.arrayGlobals)),
+                                      mod.arrayGlobals, captures)
+        if not captures:
+            mod.body[defineLine] = functionDefinition(funcName, dtype, args, True)
         mod.alreadyDeclared.append(funcName)
         mod.endScope()
+        if mod.profile:
+            mod.endProfile(*profileRegisters)
         mod.body += ["ret {} {}".format(output.irname, output.addr)]
         mod.body += ["}"]
+        mod.functionName = "<top level>"
     else:
         # Top-level statement
         mod.isGlobal = forJIT
         mod.out = mod.main
+        mod.beginArenaScope()
         mod.lastOutput = parseBlock(mod, source, 0, forJIT)
+        mod.endArenaScope()
         mod.out = mod.body
         mod.isGlobal = False
     return
@@ -163,10 +629,11 @@ def parseTopLevel(mod, source, forJIT=False):
 
 def parseBlock(mod, source, level=0, forJIT=False):
     tail = []
-    blockHead = lexer.lex(source.getLine(level), mod.debugLexer)
+    line = source.getLine(level)
+    blockHead = lexLine(mod, line, source.lineNumber)
     if blockHead[0].name == 'if':
         n = mod.blockCounter
-        astOutput = ast.ASTNode(blockHead[1:], mod).castTo(dtypes.Bool).evaluate()
+        astOutput = evaluateTokens(mod, blockHead[1:], dtypes.Bool)
         mod.out += ["br i1 {}, label %if{}_then, label %if{}_resume".format(astOutput.addr, n, n)]
         mod.out += ["if{}_then:".format(n)]
         tail += ["br label %if{}_resume".format(n)]
@@ -176,7 +643,7 @@ def parseBlock(mod, source, level=0, forJIT=False):
         n = mod.blockCounter
         mod.out += ["br label %while{}_condition".format(n)]
         mod.out += ["while{}_condition:".format(n)]
-        astOutput = ast.ASTNode(blockHead[1:], mod).castTo(dtypes.Bool).evaluate()
+        astOutput = evaluateTokens(mod, blockHead[1:], dtypes.Bool)
         mod.out += ["br i1 {}, label %while{}_then, label %while{}_resume"
                     .format(astOutput.addr, n, n)]
         mod.out += ["while{}_then:".format(n)]
@@ -193,7 +660,8 @@ def parseBlock(mod, source, level=0, forJIT=False):
         # Identify the blockID, counter variable and desired limit
         n = mod.blockCounter
         counter = blockHead[1]
-        limit = ast.ASTNode(blockHead[3].data[1], mod).evaluate()
+        arrayName = lengthOf(blockHead[3].data[1])
+        limit = evaluateTokens(mod, blockHead[3].data[1])
         # Construct the IR code
         builtins.assignment([dtypes.Int('0')], counter, mod)
         mod.out += ["br label %for{}_condition".format(n)]
@@ -209,13 +677,210 @@ def parseBlock(mod, source, level=0, forJIT=False):
         tail += ["br label %for{}_condition".format(n)]
         tail += ["for{}_resume:".format(n, n)]
         mod.blockCounter += 1
+        if arrayName is not None:
+            mod.beginLengthLoop(counter.data, arrayName)
+    elif blockHead[0].name == 'parallel for':
+        parseParallelFor(mod, source, blockHead, level)
+        return None
     else:
         # Not a block start, so treat as a standard statement
-        return ast.ASTNode(blockHead, mod).evaluate()
+        return evaluateTokens(mod, blockHead)
     # Process the block body
     if source.end(level+1):
         raise ValueError("ERROR: Expected a block (maybe you forgot to indent?)")
+    # The temporaries of each iteration of a loop are released at its end
+    isLoop = blockHead[0].name in ('while', 'for')
+    if isLoop:
+        mod.beginArenaScope()
     while not source.end(level+1):
         parseBlock(mod, source, level+1, forJIT)
+    if isLoop:
+        mod.endArenaScope()
     mod.out += tail
+    if blockHead[0].name == 'for' and arrayName is not None:
+        mod.endLengthLoop()
     return None
+
+
+def lengthOf(tokens):
+    '''Returns the name of the array a if the tokens are len(a), else None.'''
+    if (len(tokens) == 1 and tokens[0].name == "function" and tokens[0].data[0] == "len"
+            and len(tokens[0].data[1]) == 1 and tokens[0].data[1][0].name == "name"):
+        return tokens[0].data[1][0].data
+    return None
+
+
+def parseParallelFor(mod, source, blockHead, level):
+    '''Compiles a parallel for loop.  The body is outlined into a function
+       run by the thread pool of the runtime on ranges of iterations, which
+       reaches the variables of the enclosing function through pointers
+       passed in a context array.  The loop counter, variables first
+       assigned in the body, and the private partial sums of any sum()
+       clause are local to each thread.  The optional clauses after range()
+       are static (the default) and chunk(size), which hands out iterations
+       in chunks of the given size as threads become free.'''
+    if (len(blockHead) < 4
+            or blockHead[2].name != "in"
+            or blockHead[3].name != "function"
+            or blockHead[3].data[0] != 'range'):
+        raise ValueError("ERROR: Parallel loops must be of the form "
+                         "parallel for _ in range(_) [static|chunk(_)] [sum(_)]:")
+    n = mod.blockCounter
+    mod.blockCounter += 1
+    counter = blockHead[1].data
+    arrayName = lengthOf(blockHead[3].data[1])
+    limit = evaluateTokens(mod, blockHead[3].data[1], dtypes.Int)
+    chunk = dtypes.Int('0')
+    reductions = []
+    for clause in blockHead[4:]:
+        if clause.name == "name" and clause.data == "static":
+            chunk = dtypes.Int('0')
+        elif clause.name == "function" and clause.data[0] == "chunk":
+            chunk = evaluateTokens(mod, clause.data[1], dtypes.Int)
+        elif clause.name == "function" and clause.data[0] == "sum":
+            for arg in ast.splitArguments(clause.data[1]):
+                if len(arg) != 1 or arg[0].name != "name":
+                    raise ValueError("ERROR: sum() takes the names of variables to add to.")
+                var = mod.getVariable(arg[0].data, True)
+                if type(var) not in (dtypes.Real, dtypes.Int):
+                    raise ValueError("ERROR: Cannot sum variable {} of type {} in parallel."
+                                     .format(arg[0].data, var.name))
+                reductions.append((arg[0].data, type(var)))
+        else:
+            raise ValueError("ERROR: Unknown parallel loop clause {}."
+                             .format(clause.data[0] if clause.name == "function" else clause.data))
+    privateNames = [counter] + [name for name, dtype in reductions]
+    captured = [(name, dtype) for name, (dtype, allocID) in sorted(mod.localVars.items())
+                if name not in privateNames]
+    bodyName = "tau_parallel_body_{}".format(n)
+    mod.runtimes.add('parallel')
+    mod.ensureDeclared("tau_parallel_for", "declare void @tau_parallel_for("
+                       "void (i8*, i32, i32, i32)*, i8*, i32, i32)")
+    # Pass pointers to the enclosing function's variables and the partial sums
+    context = "null"
+    partials = []
+    numSlots = len(captured) + len(reductions)
+    if numSlots:
+        slots = mod.allocaAtEntry("[{} x i8*]".format(numSlots))
+        pointers = ["{}* %usr_{}".format(dtype.irname, name) for name, dtype in captured]
+        for name, dtype in reductions:
+            partial = mod.allocaAtEntry("[{} x {}]".format(runtime.maxThreads, dtype.irname))
+            mod.out += ["store [{0} x {1}] zeroinitializer, [{0} x {1}]* {2}"
+                        .format(runtime.maxThreads, dtype.irname, partial)]
+            pointers.append("[{} x {}]* {}".format(runtime.maxThreads, dtype.irname, partial))
+            partials.append(partial)
+        for i, pointer in enumerate(pointers):
+            slot = mod.newRegister()
+            value = mod.newRegister()
+            mod.out += ["{} = getelementptr [{} x i8*], [{} x i8*]* {}, i32 0, i32 {}"
+                        .format(slot, numSlots, numSlots, slots, i)]
+            mod.out += ["{} = bitcast {} to i8*".format(value, pointer)]
+            mod.out += ["store i8* {}, i8** {}".format(value, slot)]
+        context = mod.newRegister()
+        mod.out += ["{} = bitcast [{} x i8*]* {} to i8*".format(context, numSlots, slots)]
+    mod.out += ["call void @tau_parallel_for(void (i8*, i32, i32, i32)* @{}, i8* {}, i32 {}, "
+                "i32 {})".format(bodyName, context, limit.addr, chunk.addr)]
+    # Add the partial sums to the reduction variables
+    for (name, dtype), partial in zip(reductions, partials):
+        first = mod.newRegister()
+        total = mod.newRegister()
+        mod.out += ["{} = getelementptr [{} x {}], [{} x {}]* {}, i32 0, i32 0"
+                    .format(first, runtime.maxThreads, dtype.irname, runtime.maxThreads,
+                            dtype.irname, partial)]
+        mod.ensureDeclared("tau_parallel_sum_" + dtype.name, "declare {0} @tau_parallel_sum_{1}"
+                           "({0}*)".format(dtype.irname, dtype.name))
+        mod.out += ["{} = call {} @tau_parallel_sum_{}({}* {})"
+                    .format(total, dtype.irname, dtype.name, dtype.irname, first)]
+        old = builtins.name([], lexer.Token("name", name), mod)
+        new = mod.newRegister()
+        mod.out += ["{} = {} {} {}, {}".format(new, "fadd" if dtype is dtypes.Real else "add",
+                                              dtype.irname, old.addr, total)]
+        mod.out += ["store {} {}, {}* {}".format(dtype.irname, new, dtype.irname,
+                                                mod.getVariable(name).addr)]
+    # Emit the outlined body, with the private variables hiding any globals of the same name
+    outerState = mod.out, mod.localVars, mod.isGlobal, mod.sharedVars
+    hiddenGlobals = {name: mod.globalVars.pop(name) for name in privateNames
+                     if name in mod.globalVars}
+    try:
+        mod.out = ["define internal void @{}(i8* %context, i32 %start, i32 %end, i32 %thread)"
+                   .format(bodyName) + "{", "entry:"]
+        mod.isGlobal = False
+        mod.localVars = {name: (dtype, None) for name, dtype in captured}
+        mod.sharedVars = set(mod.localVars)
+        if numSlots:
+            mod.out += ["%slots = bitcast i8* %context to i8**"]
+        for i, (name, dtype) in enumerate(captured):
+            slot = mod.newRegister()
+            value = mod.newRegister()
+            mod.out += ["{} = getelementptr i8*, i8** %slots, i32 {}".format(slot, i)]
+            mod.out += ["{} = load i8*, i8** {}".format(value, slot)]
+            mod.out += ["%usr_{} = bitcast i8* {} to {}*".format(name, value, dtype.irname)]
+        mod.localVars[counter] = (dtypes.Int, None)
+        mod.out += ["%usr_{} = alloca i32".format(counter)]
+        mod.out += ["store i32 %start, i32* %usr_{}".format(counter)]
+        for name, dtype in reductions:
+            mod.localVars[name] = (dtype, None)
+            mod.out += ["%usr_{} = alloca {}".format(name, dtype.irname)]
+            mod.out += ["store {} {}, {}* %usr_{}".format(dtype.irname, dtype.initStr,
+                                                          dtype.irname, name)]
+        mod.out += ["br label %parallel{}_condition".format(n)]
+        mod.out += ["parallel{}_condition:".format(n)]
+        currentCounterValue = builtins.name([], lexer.Token("name", counter), mod)
+        comp = mod.newRegister()
+        mod.out += ["{} = icmp slt i32 {}, %end".format(comp, currentCounterValue.addr)]
+        mod.out += ["br i1 {}, label %parallel{}_body, label %parallel{}_resume"
+                    .format(comp, n, n)]
+        mod.out += ["parallel{}_body:".format(n)]
+        outerAllocations = set(mod.allocations.keys())
+        bodyStart = len(mod.out)
+        if source.end(level+1):
+            raise ValueError("ERROR: Expected a block (maybe you forgot to indent?)")
+        if arrayName is not None:
+            mod.beginLengthLoop(counter, arrayName)
+        mod.beginArenaScope()
+        while not source.end(level+1):
+            parseBlock(mod, source, level+1)
+        mod.endArenaScope()
+        if arrayName is not None:
+            mod.endLengthLoop()
+        # Move the variables first assigned in the body to the entry block, so that worker
+        # threads do not use more stack space with every iteration
+        variables = [line for line in mod.out[bodyStart:]
+                     if line.startswith("%usr_") and " = alloca " in line]
+        hoisted = set(variables)
+        mod.out[bodyStart:] = [line for line in mod.out[bodyStart:] if line not in hoisted]
+        mod.out[2:2] = variables
+        # Temporaries of the body are made by the outlined function, so it must free them
+        for k in set(mod.allocations.keys()) - outerAllocations:
+            if mod.allocations[k][0] == "freeAfterStatement":
+                mod.freeMemory(k, mod.allocations[k][1])
+        counterUpdate = mod.newRegister()
+        mod.out += ["{} = add i32 {}, 1".format(counterUpdate, currentCounterValue.addr)]
+        mod.out += ["store i32 {}, i32* %usr_{}".format(counterUpdate, counter)]
+        mod.out += ["br label %parallel{}_condition".format(n)]
+        mod.out += ["parallel{}_resume:".format(n)]
+        # Add this thread's sums to its partial sums
+        for i, (name, dtype) in enumerate(reductions):
+            slot, value, partials, pointer, partial, private = [mod.newRegister()
+                                                                for j in range(6)]
+            mod.out += ["{} = getelementptr i8*, i8** %slots, i32 {}"
+                        .format(slot, len(captured) + i)]
+            mod.out += ["{} = load i8*, i8** {}".format(value, slot)]
+            mod.out += ["{} = bitcast i8* {} to {}*".format(partials, value, dtype.irname)]
+            mod.out += ["{} = getelementptr {}, {}* {}, i32 %thread"
+                        .format(pointer, dtype.irname, dtype.irname, partials)]
+            mod.out += ["{} = load {}, {}* {}".format(partial, dtype.irname, dtype.irname,
+                                                      pointer)]
+            mod.out += ["{} = load {}, {}* %usr_{}".format(private, dtype.irname, dtype.irname,
+                                                           name)]
+            total = mod.newRegister()
+            mod.out += ["{} = {} {} {}, {}".format(total, "fadd" if dtype is dtypes.Real
+                                                  else "add", dtype.irname, partial, private)]
+            mod.out += ["store {} {}, {}* {}".format(dtype.irname, total, dtype.irname,
+                                                    pointer)]
+        mod.out += ["ret void", "}"]
+        mod.outlined += mod.out
+    finally:
+        mod.out, mod.localVars, mod.isGlobal, mod.sharedVars = outerState
+        mod.globalVars.update(hiddenGlobals)
+    return
@@ -0,0 +1,76 @@
+import time
+
+
+class PhaseStats(object):
+    '''Records the wall time spent in each phase of compiling, and counts of
+       the tokens, AST nodes, IR lines and registers compiled.  Phases may
+       nest, in which case the time is only counted for the innermost one.'''
+    # The phases in the order they run, with their descriptions
+    phases = [('lex', "lexing (lexer.lex)"),
+              ('parse', "building ASTs"),
+              ('emit', "emitting IR (evaluate)"),
+              ('irText', "joining IR text (TauModule.__str__)"),
+              ('llvmParse', "parsing IR (llvm.parse_assembly)"),
+              ('optimize', "optimizing"),
+              ('codegen', "generating machine code"),
+              ('link', "linking (ld or gcc)")]
+    counters = ['tokens', 'astNodes', 'irLines', 'registers']
+
+    def __init__(self):
+        self.times = dict((name, 0.) for name, description in self.phases)
+        self.counts = dict((name, 0) for name in self.counters)
+        # The phases running, innermost last, and when the innermost (re)started
+        self.running = []
+        self.started = 0.
+
+    def start(self, phase):
+        '''Starts timing a phase, pausing the one running (if any).'''
+        now = time.time()
+        if self.running:
+            self.times[self.running[-1]] += now - self.started
+        self.running.append(phase)
+        self.started = now
+
+    def stop(self):
+        '''Stops timing the innermost phase, resuming the one it interrupted.'''
+        now = time.time()
+        self.times[self.running.pop()] += now - self.started
+        self.started = now
+
+    def phase(self, phase):
+        '''Returns a context manager timing the given phase.'''
+        return _PhaseTimer_(self, phase)
+
+    def add(self, other):
+        '''Adds the times and counts of another PhaseStats to these.'''
+        for name in self.times:
+            self.times[name] += other.times[name]
+        for name in self.counts:
+            self.counts[name] += other.counts[name]
+
+    def total(self):
+        '''Returns the total time of all phases in seconds.'''
+        return sum(self.times.values())
+
+    def table(self):
+        '''Returns the times and counts as a table for printing.'''
+        total = self.total()
+        lines = ["{:<40} {:>10} {:>7}".format("Phase", "ms", "%")]
+        for name, description in self.phases:
+            lines += ["{:<40} {:>10.2f} {:>7.1f}".format(
+                description, 1e3*self.times[name], 100*self.times[name]/total if total else 0.)]
+        lines += ["{:<40} {:>10.2f}".format("total", 1e3*total)]
+        lines += ["{:<40} {:>10}".format(name, self.counts[name]) for name in self.counters]
+        return '\n'.join(lines)
+
+
+class _PhaseTimer_(object):
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phaseName = phase
+
+    def __enter__(self):
+        self.stats.start(self.phaseName)
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stats.stop()
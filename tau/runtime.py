@@ -0,0 +1,850 @@
+# IR code for the runtime support that generated code may call into.  It is compiled
+# once per JIT session or executable, and only when it is needed.
+import ctypes
+
+# The largest number of threads a parallel loop may use (TAU_NUM_THREADS is clamped to this)
+maxThreads = 64
+
+# Runs parallel for loops on a fixed pool of worker threads, started on first use.  The
+# calling thread works as thread 0, so a pool of T threads starts T-1 workers.  Loop bodies
+# are outlined into functions taking a context pointer, a range of iterations [start, end)
+# and the thread number.  A chunk size of zero or less splits the range evenly between the
+# threads (static scheduling); otherwise threads repeatedly take the next chunk of
+# iterations from a shared counter.  A loop started while another is running (e.g. a
+# nested parallel loop) runs serially on its calling thread instead.
+parallel = r'''
+declare i32 @pthread_create(i64*, i8*, i8* (i8*)*, i8*)
+declare i32 @pthread_mutex_lock(i8*)
+declare i32 @pthread_mutex_unlock(i8*)
+declare i32 @pthread_cond_wait(i8*, i8*)
+declare i32 @pthread_cond_broadcast(i8*)
+declare i8* @getenv(i8*)
+declare i32 @atoi(i8*)
+declare i64 @sysconf(i32)
+declare i32 @getpid()
+
+; Opaque pthread_mutex_t and pthread_cond_t storage.  This assumes glibc, where they take
+; 40 and 48 bytes on 64-bit targets (64 leaves room), and where PTHREAD_MUTEX_INITIALIZER
+; and PTHREAD_COND_INITIALIZER are all zero bytes, so zeroinitializer initializes them
+@tau_pool_mutex = internal global [64 x i8] zeroinitializer, align 16
+@tau_pool_start = internal global [64 x i8] zeroinitializer, align 16
+@tau_pool_done = internal global [64 x i8] zeroinitializer, align 16
+@tau_pool_handles = internal global [MAX x i64] zeroinitializer
+@tau_pool_threads = internal global i32 0
+@tau_pool_pid = internal global i32 0
+@tau_pool_busy = internal global i32 0
+@tau_pool_generation = internal global i32 0
+@tau_pool_pending = internal global i32 0
+@tau_job_body = internal global void (i8*, i32, i32, i32)* null
+@tau_job_context = internal global i8* null
+@tau_job_n = internal global i32 0
+@tau_job_chunk = internal global i32 0
+@tau_job_next = internal global i64 0
+@tau_threads_variable = internal constant [16 x i8] c"TAU_NUM_THREADS\00"
+
+define internal void @tau_run_share(i32 %id){
+entry:
+%body = load void (i8*, i32, i32, i32)*, void (i8*, i32, i32, i32)** @tau_job_body
+%context = load i8*, i8** @tau_job_context
+%n = load i32, i32* @tau_job_n
+%chunk = load i32, i32* @tau_job_chunk
+%static = icmp sle i32 %chunk, 0
+br i1 %static, label %static_share, label %chunk_next
+static_share:
+%threads = load i32, i32* @tau_pool_threads
+%n64 = sext i32 %n to i64
+%id64 = sext i32 %id to i64
+%threads64 = sext i32 %threads to i64
+%startScaled = mul i64 %n64, %id64
+%start64 = sdiv i64 %startScaled, %threads64
+%nextId = add i64 %id64, 1
+%endScaled = mul i64 %n64, %nextId
+%end64 = sdiv i64 %endScaled, %threads64
+%start = trunc i64 %start64 to i32
+%end = trunc i64 %end64 to i32
+%nonempty = icmp slt i32 %start, %end
+br i1 %nonempty, label %static_run, label %done
+static_run:
+call void %body(i8* %context, i32 %start, i32 %end, i32 %id)
+br label %done
+chunk_next:
+%chunk64 = sext i32 %chunk to i64
+%chunkStart64 = atomicrmw add i64* @tau_job_next, i64 %chunk64 seq_cst
+%limit64 = sext i32 %n to i64
+%more = icmp slt i64 %chunkStart64, %limit64
+br i1 %more, label %chunk_run, label %done
+chunk_run:
+%chunkStart = trunc i64 %chunkStart64 to i32
+%remaining = sub i32 %n, %chunkStart
+%full = icmp slt i32 %chunk, %remaining
+%chunkEndFull = add i32 %chunkStart, %chunk
+%chunkEnd = select i1 %full, i32 %chunkEndFull, i32 %n
+call void %body(i8* %context, i32 %chunkStart, i32 %chunkEnd, i32 %id)
+br label %chunk_next
+done:
+ret void
+}
+
+define internal i8* @tau_worker(i8* %arg){
+entry:
+%id64 = ptrtoint i8* %arg to i64
+%id = trunc i64 %id64 to i32
+%mutex = bitcast [64 x i8]* @tau_pool_mutex to i8*
+%startSignal = bitcast [64 x i8]* @tau_pool_start to i8*
+%doneSignal = bitcast [64 x i8]* @tau_pool_done to i8*
+%seen = alloca i32
+store i32 0, i32* %seen
+br label %wait
+wait:
+call i32 @pthread_mutex_lock(i8* %mutex)
+br label %check
+check:
+%generation = load i32, i32* @tau_pool_generation
+%lastSeen = load i32, i32* %seen
+%idle = icmp eq i32 %generation, %lastSeen
+br i1 %idle, label %sleep, label %work
+sleep:
+call i32 @pthread_cond_wait(i8* %startSignal, i8* %mutex)
+br label %check
+work:
+store i32 %generation, i32* %seen
+call i32 @pthread_mutex_unlock(i8* %mutex)
+call void @tau_run_share(i32 %id)
+call i32 @pthread_mutex_lock(i8* %mutex)
+%pending = load i32, i32* @tau_pool_pending
+%stillPending = sub i32 %pending, 1
+store i32 %stillPending, i32* @tau_pool_pending
+%last = icmp eq i32 %stillPending, 0
+br i1 %last, label %signal, label %release
+signal:
+call i32 @pthread_cond_broadcast(i8* %doneSignal)
+br label %release
+release:
+call i32 @pthread_mutex_unlock(i8* %mutex)
+br label %wait
+}
+
+define internal void @tau_pool_init(){
+entry:
+%name = bitcast [16 x i8]* @tau_threads_variable to i8*
+%variable = call i8* @getenv(i8* %name)
+%hasVariable = icmp ne i8* %variable, null
+br i1 %hasVariable, label %from_variable, label %from_system
+from_variable:
+%requested = call i32 @atoi(i8* %variable)
+br label %clamp
+from_system:
+; 84 is _SC_NPROCESSORS_ONLN on Linux with glibc
+%online = call i64 @sysconf(i32 84)
+%online32 = trunc i64 %online to i32
+br label %clamp
+clamp:
+%wanted = phi i32 [%requested, %from_variable], [%online32, %from_system]
+%tooFew = icmp slt i32 %wanted, 1
+%atLeastOne = select i1 %tooFew, i32 1, i32 %wanted
+%tooMany = icmp sgt i32 %atLeastOne, MAX
+%threads = select i1 %tooMany, i32 MAX, i32 %atLeastOne
+; Reset the synchronization state, which a forked process inherits without the workers
+; (zero bytes are the static initializers, as for the globals above)
+store [64 x i8] zeroinitializer, [64 x i8]* @tau_pool_mutex
+store [64 x i8] zeroinitializer, [64 x i8]* @tau_pool_start
+store [64 x i8] zeroinitializer, [64 x i8]* @tau_pool_done
+store i32 0, i32* @tau_pool_generation
+store i32 0, i32* @tau_pool_pending
+%pid = call i32 @getpid()
+store i32 %pid, i32* @tau_pool_pid
+br label %spawn_condition
+spawn_condition:
+%id = phi i32 [1, %clamp], [%nextId, %spawn_next]
+%spawnMore = icmp slt i32 %id, %threads
+br i1 %spawnMore, label %spawn, label %spawned
+spawn:
+%handle = getelementptr [MAX x i64], [MAX x i64]* @tau_pool_handles, i32 0, i32 %id
+%id64 = zext i32 %id to i64
+%arg = inttoptr i64 %id64 to i8*
+%failed = call i32 @pthread_create(i64* %handle, i8* null, i8* (i8*)* @tau_worker, i8* %arg)
+%created = icmp eq i32 %failed, 0
+%nextId = add i32 %id, 1
+br i1 %created, label %spawn_next, label %spawned
+spawn_next:
+br label %spawn_condition
+spawned:
+; If a worker could not be started, use only those that were
+store i32 %id, i32* @tau_pool_threads
+ret void
+}
+
+define void @tau_parallel_for(void (i8*, i32, i32, i32)* %body, i8* %context, i32 %n,
+                              i32 %chunk){
+entry:
+%mutex = bitcast [64 x i8]* @tau_pool_mutex to i8*
+%startSignal = bitcast [64 x i8]* @tau_pool_start to i8*
+%doneSignal = bitcast [64 x i8]* @tau_pool_done to i8*
+%any = icmp sgt i32 %n, 0
+br i1 %any, label %acquire, label %finish
+acquire:
+%exchange = cmpxchg i32* @tau_pool_busy, i32 0, i32 1 seq_cst seq_cst
+%acquired = extractvalue { i32, i1 } %exchange, 1
+br i1 %acquired, label %check_pool, label %serial
+serial:
+call void %body(i8* %context, i32 0, i32 %n, i32 0)
+br label %finish
+check_pool:
+%oldThreads = load i32, i32* @tau_pool_threads
+%started = icmp sgt i32 %oldThreads, 0
+%pid = call i32 @getpid()
+%poolPid = load i32, i32* @tau_pool_pid
+%samePid = icmp eq i32 %pid, %poolPid
+%ready = and i1 %started, %samePid
+br i1 %ready, label %dispatch_check, label %init
+init:
+call void @tau_pool_init()
+br label %dispatch_check
+dispatch_check:
+%threads = load i32, i32* @tau_pool_threads
+%alone = icmp eq i32 %threads, 1
+br i1 %alone, label %alone_run, label %dispatch
+alone_run:
+call void %body(i8* %context, i32 0, i32 %n, i32 0)
+br label %release
+dispatch:
+call i32 @pthread_mutex_lock(i8* %mutex)
+store void (i8*, i32, i32, i32)* %body, void (i8*, i32, i32, i32)** @tau_job_body
+store i8* %context, i8** @tau_job_context
+store i32 %n, i32* @tau_job_n
+store i32 %chunk, i32* @tau_job_chunk
+store i64 0, i64* @tau_job_next
+%generation = load i32, i32* @tau_pool_generation
+%nextGeneration = add i32 %generation, 1
+store i32 %nextGeneration, i32* @tau_pool_generation
+%workers = sub i32 %threads, 1
+store i32 %workers, i32* @tau_pool_pending
+call i32 @pthread_cond_broadcast(i8* %startSignal)
+call i32 @pthread_mutex_unlock(i8* %mutex)
+call void @tau_run_share(i32 0)
+call i32 @pthread_mutex_lock(i8* %mutex)
+br label %wait_check
+wait_check:
+%pending = load i32, i32* @tau_pool_pending
+%finished = icmp eq i32 %pending, 0
+br i1 %finished, label %waited, label %wait_sleep
+wait_sleep:
+call i32 @pthread_cond_wait(i8* %doneSignal, i8* %mutex)
+br label %wait_check
+waited:
+call i32 @pthread_mutex_unlock(i8* %mutex)
+br label %release
+release:
+store atomic i32 0, i32* @tau_pool_busy seq_cst, align 4
+br label %finish
+finish:
+ret void
+}
+
+; Add up the per-thread partial sums of a reduction, in thread order
+define double @tau_parallel_sum_Real(double* %partials){
+entry:
+br label %loop
+loop:
+%i = phi i32 [0, %entry], [%next, %loop]
+%total = phi double [0.0, %entry], [%newTotal, %loop]
+%pointer = getelementptr double, double* %partials, i32 %i
+%value = load double, double* %pointer
+%newTotal = fadd double %total, %value
+%next = add i32 %i, 1
+%more = icmp slt i32 %next, MAX
+br i1 %more, label %loop, label %done
+done:
+ret double %newTotal
+}
+
+define i32 @tau_parallel_sum_Int(i32* %partials){
+entry:
+br label %loop
+loop:
+%i = phi i32 [0, %entry], [%next, %loop]
+%total = phi i32 [0, %entry], [%newTotal, %loop]
+%pointer = getelementptr i32, i32* %partials, i32 %i
+%value = load i32, i32* %pointer
+%newTotal = add i32 %total, %value
+%next = add i32 %i, 1
+%more = icmp slt i32 %next, MAX
+br i1 %more, label %loop, label %done
+done:
+ret i32 %newTotal
+}
+'''.replace('MAX', str(maxThreads))
+
+# Requests larger than this many bytes go to the heap rather than the arena
+arenaLimit = 2**20
+# The address space reserved for each thread's arena (memory is only used once touched)
+arenaCapacity = 2**28
+
+# A bump allocator for the temporary arrays of a statement or loop iteration.  Each thread
+# has its own arena (found through a pthread key, and released when the thread exits) made
+# of one reserved region, so that an allocation only rounds up its size and moves the top.
+# tau_arena_mark returns the top, and tau_arena_release resets it, freeing everything
+# allocated since at once.  Requests over the limit, or which do not fit, are allocated on
+# the heap with a header linking them into a list and recording the top when they were
+# made; they move the top as well, so that those made since a mark are those at the head
+# of the list with at least that top.  All allocations are aligned to 64 bytes.
+arena = r'''
+%tau_arena = type {i8*, i64, i8*}
+
+declare i32 @pthread_once(i32*, void ()*)
+declare i32 @pthread_key_create(i32*, void (i8*)*)
+declare i8* @pthread_getspecific(i32)
+declare i32 @pthread_setspecific(i32, i8*)
+declare i8* @mmap(i8*, i64, i32, i32, i32, i64)
+declare i32 @munmap(i8*, i64)
+declare i8* @calloc(i64, i64)
+declare i8* @aligned_alloc(i64, i64)
+declare void @free(i8*)
+
+@tau_arena_once = internal global i32 0
+@tau_arena_key = internal global i32 0
+
+; Frees the heap blocks at the head of a thread's list made with at least the given top
+define internal void @tau_arena_free_blocks(%tau_arena* %arena, i64 %mark){
+entry:
+%headPointer = getelementptr %tau_arena, %tau_arena* %arena, i32 0, i32 2
+br label %check
+check:
+%head = load i8*, i8** %headPointer
+%empty = icmp eq i8* %head, null
+br i1 %empty, label %done, label %check_top
+check_top:
+%header = bitcast i8* %head to i64*
+%topPointer = getelementptr i64, i64* %header, i32 1
+%top = load i64, i64* %topPointer
+%newer = icmp sge i64 %top, %mark
+br i1 %newer, label %release, label %done
+release:
+%nextPointer = bitcast i8* %head to i8**
+%next = load i8*, i8** %nextPointer
+store i8* %next, i8** %headPointer
+call void @free(i8* %head)
+br label %check
+done:
+ret void
+}
+
+define internal void @tau_arena_destroy(i8* %state){
+entry:
+%arena = bitcast i8* %state to %tau_arena*
+call void @tau_arena_free_blocks(%tau_arena* %arena, i64 0)
+%basePointer = getelementptr %tau_arena, %tau_arena* %arena, i32 0, i32 0
+%base = load i8*, i8** %basePointer
+%reserved = icmp ne i8* %base, null
+br i1 %reserved, label %unmap, label %done
+unmap:
+call i32 @munmap(i8* %base, i64 CAPACITY)
+br label %done
+done:
+call void @free(i8* %state)
+ret void
+}
+
+define internal void @tau_arena_make_key(){
+entry:
+call i32 @pthread_key_create(i32* @tau_arena_key, void (i8*)* @tau_arena_destroy)
+ret void
+}
+
+; Returns the arena of the calling thread, creating it on first use
+define internal %tau_arena* @tau_arena_get(){
+entry:
+call i32 @pthread_once(i32* @tau_arena_once, void ()* @tau_arena_make_key)
+%key = load i32, i32* @tau_arena_key
+%state = call i8* @pthread_getspecific(i32 %key)
+%missing = icmp eq i8* %state, null
+br i1 %missing, label %create, label %found
+found:
+%arena = bitcast i8* %state to %tau_arena*
+ret %tau_arena* %arena
+create:
+%newState = call i8* @calloc(i64 1, i64 24)
+%newArena = bitcast i8* %newState to %tau_arena*
+; PROT_READ|PROT_WRITE, MAP_PRIVATE|MAP_ANONYMOUS|MAP_NORESERVE
+%region = call i8* @mmap(i8* null, i64 CAPACITY, i32 3, i32 16418, i32 -1, i64 0)
+%failed = icmp eq i8* %region, inttoptr (i64 -1 to i8*)
+%base = select i1 %failed, i8* null, i8* %region
+%basePointer = getelementptr %tau_arena, %tau_arena* %newArena, i32 0, i32 0
+store i8* %base, i8** %basePointer
+call i32 @pthread_setspecific(i32 %key, i8* %newState)
+ret %tau_arena* %newArena
+}
+
+define i8* @tau_arena_alloc(i64 %size){
+entry:
+%arena = call %tau_arena* @tau_arena_get()
+%basePointer = getelementptr %tau_arena, %tau_arena* %arena, i32 0, i32 0
+%topPointer = getelementptr %tau_arena, %tau_arena* %arena, i32 0, i32 1
+%base = load i8*, i8** %basePointer
+%top = load i64, i64* %topPointer
+%padded = add i64 %size, 63
+%rounded = and i64 %padded, -64
+%newTop = add i64 %top, %rounded
+%small = icmp ule i64 %rounded, LIMIT
+%room = icmp ule i64 %newTop, CAPACITY
+%reserved = icmp ne i8* %base, null
+%fitsSize = and i1 %small, %room
+%fits = and i1 %fitsSize, %reserved
+br i1 %fits, label %bump, label %heap
+bump:
+store i64 %newTop, i64* %topPointer
+%result = getelementptr i8, i8* %base, i64 %top
+ret i8* %result
+heap:
+%blockSize = add i64 %rounded, 64
+%block = call i8* @aligned_alloc(i64 64, i64 %blockSize)
+%headPointer = getelementptr %tau_arena, %tau_arena* %arena, i32 0, i32 2
+%head = load i8*, i8** %headPointer
+%nextPointer = bitcast i8* %block to i8**
+store i8* %head, i8** %nextPointer
+%header = bitcast i8* %block to i64*
+%blockTopPointer = getelementptr i64, i64* %header, i32 1
+store i64 %top, i64* %blockTopPointer
+store i8* %block, i8** %headPointer
+%movedTop = add i64 %top, 64
+store i64 %movedTop, i64* %topPointer
+%data = getelementptr i8, i8* %block, i64 64
+ret i8* %data
+}
+
+define i64 @tau_arena_mark(){
+entry:
+%arena = call %tau_arena* @tau_arena_get()
+%topPointer = getelementptr %tau_arena, %tau_arena* %arena, i32 0, i32 1
+%top = load i64, i64* %topPointer
+ret i64 %top
+}
+
+define void @tau_arena_release(i64 %mark){
+entry:
+%arena = call %tau_arena* @tau_arena_get()
+call void @tau_arena_free_blocks(%tau_arena* %arena, i64 %mark)
+%topPointer = getelementptr %tau_arena, %tau_arena* %arena, i32 0, i32 1
+store i64 %mark, i64* %topPointer
+ret void
+}
+'''.replace('LIMIT', str(arenaLimit)).replace('CAPACITY', str(arenaCapacity))
+
+# The number of power-of-two size classes in the histogram of each allocation site
+memoryBuckets = 64
+# The size of the counters for an allocation site, as 64-bit words: the next site, its
+# label, whether it is registered, its allocations, frees, bytes and live bytes, and the
+# number of allocations in each size class (up to 2**i bytes)
+memorySiteWords = 7 + memoryBuckets
+
+# Heap allocations and frees made by generated code when memory tracking is on.  Each
+# block has a 64-byte header (keeping the data aligned) holding its size and the counters
+# of the site that allocated it, which each module defines and passes in; a site adds
+# itself to a list on its first allocation.  The totals in tau_memory_stats are the
+# allocations, frees, live bytes and peak live bytes.  Sizes are those requested from
+# allocate, which rounds up to a multiple of 64 bytes.  The counters are updated
+# atomically, so parallel loops may allocate.
+memory = r'''
+%tau_site = type {%tau_site*, i8*, i64, i64, i64, i64, i64, [BUCKETS x i64]}
+
+declare i8* @aligned_alloc(i64, i64)
+declare void @free(i8*)
+declare i32 @dprintf(i32, i8*, ...)
+declare i64 @llvm.ctlz.i64(i64, i1)
+
+@tau_memory_stats = global [4 x i64] zeroinitializer
+@tau_memory_sites = global %tau_site* null
+@tau_memory_totals = private constant [79 x i8]
+    c"Memory: %ld allocations, %ld frees, %ld bytes live at exit, %ld bytes at peak\0A\00"
+@tau_memory_site = private constant [55 x i8]
+    c"  %s: %ld allocations, %ld frees, %ld bytes, %ld live\0A\00"
+@tau_memory_bucket = private constant [26 x i8] c"    up to %ld bytes: %ld\0A\00"
+
+define i8* @tau_memory_alloc(i64 %size, i8* %siteAddress, i8* %label){
+entry:
+%site = bitcast i8* %siteAddress to %tau_site*
+%registeredPointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 2
+%claim = cmpxchg i64* %registeredPointer, i64 0, i64 1 monotonic monotonic
+%first = extractvalue {i64, i1} %claim, 1
+br i1 %first, label %register, label %count
+register:
+%labelPointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 1
+store i8* %label, i8** %labelPointer
+%nextPointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 0
+br label %push
+push:
+%head = load atomic %tau_site*, %tau_site** @tau_memory_sites monotonic, align 8
+store %tau_site* %head, %tau_site** %nextPointer
+%swap = cmpxchg %tau_site** @tau_memory_sites, %tau_site* %head, %tau_site* %site acq_rel monotonic
+%pushed = extractvalue {%tau_site*, i1} %swap, 1
+br i1 %pushed, label %count, label %push
+count:
+%blockSize = add i64 %size, 64
+%block = call i8* @aligned_alloc(i64 64, i64 %blockSize)
+%sizePointer = bitcast i8* %block to i64*
+store i64 %size, i64* %sizePointer
+%siteSlot = getelementptr i8, i8* %block, i64 8
+%sitePointer = bitcast i8* %siteSlot to %tau_site**
+store %tau_site* %site, %tau_site** %sitePointer
+%allocations = getelementptr [4 x i64], [4 x i64]* @tau_memory_stats, i64 0, i64 0
+atomicrmw add i64* %allocations, i64 1 monotonic
+%live = getelementptr [4 x i64], [4 x i64]* @tau_memory_stats, i64 0, i64 2
+%oldLive = atomicrmw add i64* %live, i64 %size monotonic
+%newLive = add i64 %oldLive, %size
+%peak = getelementptr [4 x i64], [4 x i64]* @tau_memory_stats, i64 0, i64 3
+atomicrmw max i64* %peak, i64 %newLive monotonic
+%siteAllocations = getelementptr %tau_site, %tau_site* %site, i32 0, i32 3
+atomicrmw add i64* %siteAllocations, i64 1 monotonic
+%siteBytes = getelementptr %tau_site, %tau_site* %site, i32 0, i32 5
+atomicrmw add i64* %siteBytes, i64 %size monotonic
+%siteLive = getelementptr %tau_site, %tau_site* %site, i32 0, i32 6
+atomicrmw add i64* %siteLive, i64 %size monotonic
+; The smallest i with size <= 2**i
+%below = sub i64 %size, 1
+%zeros = call i64 @llvm.ctlz.i64(i64 %below, i1 false)
+%class = sub i64 64, %zeros
+%empty = icmp eq i64 %size, 0
+%bucket = select i1 %empty, i64 0, i64 %class
+%bucketPointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 7, i64 %bucket
+atomicrmw add i64* %bucketPointer, i64 1 monotonic
+%data = getelementptr i8, i8* %block, i64 64
+ret i8* %data
+}
+
+define void @tau_memory_free(i8* %data){
+entry:
+%null = icmp eq i8* %data, null
+br i1 %null, label %done, label %release
+release:
+%block = getelementptr i8, i8* %data, i64 -64
+%sizePointer = bitcast i8* %block to i64*
+%size = load i64, i64* %sizePointer
+%siteSlot = getelementptr i8, i8* %block, i64 8
+%sitePointer = bitcast i8* %siteSlot to %tau_site**
+%site = load %tau_site*, %tau_site** %sitePointer
+%frees = getelementptr [4 x i64], [4 x i64]* @tau_memory_stats, i64 0, i64 1
+atomicrmw add i64* %frees, i64 1 monotonic
+%live = getelementptr [4 x i64], [4 x i64]* @tau_memory_stats, i64 0, i64 2
+atomicrmw sub i64* %live, i64 %size monotonic
+%siteFrees = getelementptr %tau_site, %tau_site* %site, i32 0, i32 4
+atomicrmw add i64* %siteFrees, i64 1 monotonic
+%siteLive = getelementptr %tau_site, %tau_site* %site, i32 0, i32 6
+atomicrmw sub i64* %siteLive, i64 %size monotonic
+call void @free(i8* %block)
+br label %done
+done:
+ret void
+}
+
+; Prints the totals and the counters of each site to stderr
+define void @tau_memory_report(){
+entry:
+%statsPointer = getelementptr [4 x i64], [4 x i64]* @tau_memory_stats, i64 0, i64 0
+%allocations = load i64, i64* %statsPointer
+%freesPointer = getelementptr i64, i64* %statsPointer, i64 1
+%frees = load i64, i64* %freesPointer
+%livePointer = getelementptr i64, i64* %statsPointer, i64 2
+%live = load i64, i64* %livePointer
+%peakPointer = getelementptr i64, i64* %statsPointer, i64 3
+%peak = load i64, i64* %peakPointer
+%totals = getelementptr [79 x i8], [79 x i8]* @tau_memory_totals, i64 0, i64 0
+call i32 (i32, i8*, ...) @dprintf(i32 2, i8* %totals, i64 %allocations,
+    i64 %frees, i64 %live, i64 %peak)
+%first = load %tau_site*, %tau_site** @tau_memory_sites
+br label %sites
+sites:
+%site = phi %tau_site* [%first, %entry], [%next, %next_site]
+%end = icmp eq %tau_site* %site, null
+br i1 %end, label %done, label %print_site
+print_site:
+%labelPointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 1
+%label = load i8*, i8** %labelPointer
+%siteAllocationsPointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 3
+%siteAllocations = load i64, i64* %siteAllocationsPointer
+%siteFreesPointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 4
+%siteFrees = load i64, i64* %siteFreesPointer
+%siteBytesPointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 5
+%siteBytes = load i64, i64* %siteBytesPointer
+%siteLivePointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 6
+%siteLive = load i64, i64* %siteLivePointer
+%siteFormat = getelementptr [55 x i8], [55 x i8]* @tau_memory_site, i64 0, i64 0
+call i32 (i32, i8*, ...) @dprintf(i32 2, i8* %siteFormat, i8* %label, i64 %siteAllocations,
+    i64 %siteFrees, i64 %siteBytes, i64 %siteLive)
+br label %buckets
+buckets:
+%i = phi i64 [0, %print_site], [%nextBucket, %next_bucket]
+%bucketPointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 7, i64 %i
+%count = load i64, i64* %bucketPointer
+%used = icmp ne i64 %count, 0
+br i1 %used, label %print_bucket, label %next_bucket
+print_bucket:
+%bound = shl i64 1, %i
+%bucketFormat = getelementptr [26 x i8], [26 x i8]* @tau_memory_bucket, i64 0, i64 0
+call i32 (i32, i8*, ...) @dprintf(i32 2, i8* %bucketFormat, i64 %bound, i64 %count)
+br label %next_bucket
+next_bucket:
+%nextBucket = add i64 %i, 1
+%more = icmp ult i64 %nextBucket, BUCKETS
+br i1 %more, label %buckets, label %next_site
+next_site:
+%nextPointer = getelementptr %tau_site, %tau_site* %site, i32 0, i32 0
+%next = load %tau_site*, %tau_site** %nextPointer
+br label %sites
+done:
+ret void
+}
+'''.replace('BUCKETS', str(memoryBuckets))
+
+# Makes an executable print the memory report when it exits
+memoryReportAtExit = r'''
+declare void @tau_memory_report()
+declare i32 @atexit(void ()*)
+
+define internal void @tau_memory_report_at_exit(){
+entry:
+call i32 @atexit(void ()* @tau_memory_report)
+ret void
+}
+
+@llvm.global_ctors = appending global [1 x {i32, void ()*, i8*}]
+    [{i32, void ()*, i8*} {i32 65535, void ()* @tau_memory_report_at_exit, i8* null}]
+'''
+
+# The arena when tracking memory, whose temporaries that are too large for it (or do not fit)
+# go through the memory runtime, counted for the site of the temporary
+trackedArena = arena.replace(
+    "define i8* @tau_arena_alloc(i64 %size){",
+    "define i8* @tau_tracked_arena_alloc(i64 %size, i8* %site, i8* %label){").replace(
+    "call i8* @aligned_alloc(i64 64, i64 %blockSize)",
+    "call i8* @tau_memory_alloc(i64 %blockSize, i8* %site, i8* %label)").replace(
+    "call void @free(i8* %head)", "call void @tau_memory_free(i8* %head)") + '''
+declare i8* @tau_memory_alloc(i64, i8*, i8*)
+declare void @tau_memory_free(i8*)
+'''
+
+
+class MemorySite(ctypes.Structure):
+    '''The counters of an allocation site, as laid out by the memory runtime.'''
+    pass
+
+
+MemorySite._fields_ = [('next', ctypes.POINTER(MemorySite)),
+                       ('label', ctypes.c_char_p),
+                       ('registered', ctypes.c_int64),
+                       ('allocations', ctypes.c_int64),
+                       ('frees', ctypes.c_int64),
+                       ('bytes', ctypes.c_int64),
+                       ('liveBytes', ctypes.c_int64),
+                       ('sizes', ctypes.c_int64*memoryBuckets)]
+
+
+def readMemoryStats(statsAddress, sitesAddress):
+    '''Returns the counters of the memory runtime, given the addresses of
+       tau_memory_stats and tau_memory_sites, as a dict.  Sites with the
+       same label (like those of redefined functions) are added together;
+       their sizes map the upper bound of each size class to the number of
+       allocations in it.'''
+    totals = (ctypes.c_int64*4).from_address(statsAddress)
+    stats = dict(zip(['allocations', 'frees', 'liveBytes', 'peakBytes'], totals))
+    stats['sites'] = {}
+    site = ctypes.POINTER(MemorySite).from_address(sitesAddress)
+    while site:
+        counts = stats['sites'].setdefault(site.contents.label, {
+            'allocations': 0, 'frees': 0, 'bytes': 0, 'liveBytes': 0, 'sizes': {}})
+        for field in ['allocations', 'frees', 'bytes', 'liveBytes']:
+            counts[field] += getattr(site.contents, field)
+        for i, count in enumerate(site.contents.sizes):
+            if count:
+                counts['sizes'][2**i] = counts['sizes'].get(2**i, 0) + count
+        site = site.contents.next
+    return stats
+
+
+# Call counts and cycle counts of functions when profiling is on.  Each function has
+# counters (its next function, name, whether it is registered, calls, inclusive and
+# exclusive cycles), which a function adds to a list the first time it returns.  Each
+# thread keeps a running total of the exclusive cycles of the calls it has finished in its
+# pthread key, so that a call's callees took the growth of the total while it ran.  The
+# counters of a recursive function include the cycles of nested calls in its own inclusive
+# cycles more than once, as gprof does.
+profile = r'''
+%tau_profile = type {%tau_profile*, i8*, i64, i64, i64, i64}
+
+declare i32 @pthread_once(i32*, void ()*)
+declare i32 @pthread_key_create(i32*, void (i8*)*)
+declare i8* @pthread_getspecific(i32)
+declare i32 @pthread_setspecific(i32, i8*)
+declare i64 @llvm.readcyclecounter()
+declare i32 @dprintf(i32, i8*, ...)
+
+@tau_profile_once = internal global i32 0
+@tau_profile_key = internal global i32 0
+@tau_profile_functions = global %tau_profile* null
+@tau_profile_header = private constant [50 x i8]
+    c"function calls inclusive_cycles exclusive_cycles\0A\00"
+@tau_profile_line = private constant [16 x i8] c"%s %ld %ld %ld\0A\00"
+
+define internal void @tau_profile_make_key(){
+entry:
+call i32 @pthread_key_create(i32* @tau_profile_key, void (i8*)* null)
+ret void
+}
+
+; Returns the exclusive cycles of the calls the calling thread has finished
+define i64 @tau_profile_enter(){
+entry:
+call i32 @pthread_once(i32* @tau_profile_once, void ()* @tau_profile_make_key)
+%key = load i32, i32* @tau_profile_key
+%total = call i8* @pthread_getspecific(i32 %key)
+%cycles = ptrtoint i8* %total to i64
+ret i64 %cycles
+}
+
+; Counts a call that started at the given cycle, when its thread's total was given
+define void @tau_profile_exit(i8* %functionAddress, i8* %name, i64 %start, i64 %before){
+entry:
+%end = call i64 @llvm.readcyclecounter()
+%function = bitcast i8* %functionAddress to %tau_profile*
+%registeredPointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 2
+%registered = load atomic i64, i64* %registeredPointer monotonic, align 8
+%known = icmp ne i64 %registered, 0
+br i1 %known, label %count, label %claim
+claim:
+%claimed = cmpxchg i64* %registeredPointer, i64 0, i64 1 monotonic monotonic
+%first = extractvalue {i64, i1} %claimed, 1
+br i1 %first, label %register, label %count
+register:
+%namePointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 1
+store i8* %name, i8** %namePointer
+%nextPointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 0
+br label %push
+push:
+%head = load atomic %tau_profile*, %tau_profile** @tau_profile_functions monotonic, align 8
+store %tau_profile* %head, %tau_profile** %nextPointer
+%swap = cmpxchg %tau_profile** @tau_profile_functions, %tau_profile* %head,
+    %tau_profile* %function acq_rel monotonic
+%pushed = extractvalue {%tau_profile*, i1} %swap, 1
+br i1 %pushed, label %count, label %push
+count:
+%inclusive = sub i64 %end, %start
+%key = load i32, i32* @tau_profile_key
+%after = call i8* @pthread_getspecific(i32 %key)
+%afterCycles = ptrtoint i8* %after to i64
+%callees = sub i64 %afterCycles, %before
+%exclusive = sub i64 %inclusive, %callees
+%total = add i64 %afterCycles, %exclusive
+%newTotal = inttoptr i64 %total to i8*
+call i32 @pthread_setspecific(i32 %key, i8* %newTotal)
+%callsPointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 3
+atomicrmw add i64* %callsPointer, i64 1 monotonic
+%inclusivePointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 4
+atomicrmw add i64* %inclusivePointer, i64 %inclusive monotonic
+%exclusivePointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 5
+atomicrmw add i64* %exclusivePointer, i64 %exclusive monotonic
+ret void
+}
+
+; Writes a line with the counters of each function that was called to a file descriptor
+define void @tau_profile_write(i32 %fd){
+entry:
+%header = getelementptr [50 x i8], [50 x i8]* @tau_profile_header, i64 0, i64 0
+call i32 (i32, i8*, ...) @dprintf(i32 %fd, i8* %header)
+%format = getelementptr [16 x i8], [16 x i8]* @tau_profile_line, i64 0, i64 0
+%first = load %tau_profile*, %tau_profile** @tau_profile_functions
+br label %functions
+functions:
+%function = phi %tau_profile* [%first, %entry], [%next, %print]
+%end = icmp eq %tau_profile* %function, null
+br i1 %end, label %done, label %print
+print:
+%namePointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 1
+%name = load i8*, i8** %namePointer
+%callsPointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 3
+%calls = load i64, i64* %callsPointer
+%inclusivePointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 4
+%inclusive = load i64, i64* %inclusivePointer
+%exclusivePointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 5
+%exclusive = load i64, i64* %exclusivePointer
+call i32 (i32, i8*, ...) @dprintf(i32 %fd, i8* %format, i8* %name, i64 %calls,
+    i64 %inclusive, i64 %exclusive)
+%nextPointer = getelementptr %tau_profile, %tau_profile* %function, i32 0, i32 0
+%next = load %tau_profile*, %tau_profile** %nextPointer
+br label %functions
+done:
+ret void
+}
+'''
+
+# Makes an executable write the profile when it exits, to the file named by the
+# TAU_PROFILE_FILE environment variable or else tau-profile.txt
+profileReportAtExit = r'''
+declare void @tau_profile_write(i32)
+declare i32 @atexit(void ()*)
+declare i8* @getenv(i8*)
+declare i32 @open(i8*, i32, ...)
+declare i32 @close(i32)
+
+@tau_profile_variable = private constant [17 x i8] c"TAU_PROFILE_FILE\00"
+@tau_profile_default = private constant [16 x i8] c"tau-profile.txt\00"
+
+define internal void @tau_profile_report(){
+entry:
+%variable = getelementptr [17 x i8], [17 x i8]* @tau_profile_variable, i64 0, i64 0
+%value = call i8* @getenv(i8* %variable)
+%unset = icmp eq i8* %value, null
+%default = getelementptr [16 x i8], [16 x i8]* @tau_profile_default, i64 0, i64 0
+%path = select i1 %unset, i8* %default, i8* %value
+; O_WRONLY|O_CREAT|O_TRUNC, with permissions 0644
+%fd = call i32 (i8*, i32, ...) @open(i8* %path, i32 577, i32 420)
+%failed = icmp slt i32 %fd, 0
+br i1 %failed, label %done, label %write
+write:
+call void @tau_profile_write(i32 %fd)
+call i32 @close(i32 %fd)
+br label %done
+done:
+ret void
+}
+
+define internal void @tau_profile_report_at_exit(){
+entry:
+call i32 @atexit(void ()* @tau_profile_report)
+ret void
+}
+
+@llvm.global_ctors = appending global [1 x {i32, void ()*, i8*}]
+    [{i32, void ()*, i8*} {i32 65535, void ()* @tau_profile_report_at_exit, i8* null}]
+'''
+
+
+class ProfiledFunction(ctypes.Structure):
+    '''The counters of a function, as laid out by the profile runtime.'''
+    pass
+
+
+ProfiledFunction._fields_ = [('next', ctypes.POINTER(ProfiledFunction)),
+                             ('name', ctypes.c_char_p),
+                             ('registered', ctypes.c_int64),
+                             ('calls', ctypes.c_int64),
+                             ('inclusiveCycles', ctypes.c_int64),
+                             ('exclusiveCycles', ctypes.c_int64)]
+
+
+def readProfile(functionsAddress):
+    '''Returns the counters of the profile runtime, given the address of
+       tau_profile_functions, as a dict from the name of each function which
+       has been called to its calls, inclusive and exclusive cycles.'''
+    functions = {}
+    function = ctypes.POINTER(ProfiledFunction).from_address(functionsAddress)
+    while function:
+        functions[function.contents.name] = dict(
+            (field, getattr(function.contents, field))
+            for field in ['calls', 'inclusiveCycles', 'exclusiveCycles'])
+        function = function.contents.next
+    return functions
+
+
+# The runtime modules, with a symbol by which code using each one can be recognized
+modules = {'parallel': (parallel, 'tau_parallel_for'), 'arena': (arena, 'tau_arena_alloc'),
+           'memory': (memory, 'tau_memory_alloc'), 'profile': (profile, 'tau_profile_exit'),
+           'trackedArena': (trackedArena, 'tau_tracked_arena_alloc')}
@@ -1,4 +1,12 @@
 from __future__ import division
+import array
+import ctypes
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
 import unittest
 import tau
 from math import sin, cos, tan, atan, pi
@@ -7,6 +15,38 @@ from math import sin, cos, tan, atan, pi
 jit = tau.TauJIT(True, False, False, True)
 
 
+def buildLibrary(directory):
+    '''Compiles the file scale.tau in the given directory to a shared library.'''
+    tau.compileFile(os.path.join(directory, "scale.tau"),
+                    os.path.join(directory, "scale.so"), quiet=True)
+
+
+def moduleIR(source, **options):
+    '''Returns the IR of the given source compiled in a new module (not the JIT).'''
+    m = tau.module.TauModule(**options)
+    buffer = tau.inputBuffer.InputBuffer(source, True)
+    while not buffer.end():
+        tau.parser.parseTopLevel(m, buffer)
+    return str(m)
+
+
+def runExecutable(source, environment=None, **options):
+    '''Compiles the given source to an executable with compileFile and the given options,
+       runs it with the given environment variables, and returns its exit code and output.'''
+    buildDir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(buildDir, "main.tau"), 'w') as f:
+            f.write(source)
+        executable = os.path.join(buildDir, "main")
+        tau.compileFile(os.path.join(buildDir, "main.tau"), executable, quiet=True, **options)
+        process = subprocess.Popen([executable], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   env=dict(os.environ, **(environment or {})))
+        out, err = process.communicate()
+        return process.returncode, out, err
+    finally:
+        shutil.rmtree(buildDir)
+
+
 class TauTester(unittest.TestCase):
     def testParenHandling(self):
         self.assertEqual(tau.lexer.findMatching("(45jf)(hgfd)", 0), 5)
@@ -21,6 +61,117 @@ class TauTester(unittest.TestCase):
         with self.assertRaises(ValueError):
             tau.lexer.findMatching("(23/34*2.3%4.(-3/(3.42-12.)*(True < 3.2)", 0)
 
+    def testLexer(self):
+        tokens = tau.lexer.lex("x = -3 - sin(2.)**+y  # comment")
+        self.assertEqual([t.name for t in tokens],
+                         ['=', 'unary -', 'literal', '-', 'function', '**', 'unary +', 'name'])
+        self.assertEqual(tokens[0].data, 'x')
+        self.assertEqual([t.name for t in tau.lexer.lex("while a[2] < 5 :")],
+                         ['while', 'name', 'indexing', '<', 'literal'])
+        with self.assertRaisesRegexp(ValueError, "Cannot tokenize code from: \$ 3"):
+            tau.lexer.lex("x + $ 3")
+        with self.assertRaisesRegexp(ValueError, "must end in"):
+            tau.lexer.lex("if x < 3")
+        with self.assertRaisesRegexp(ValueError, "must start the line"):
+            tau.lexer.lex("x if y:")
+        with self.assertRaisesRegexp(ValueError, "Unmatched ending"):
+            tau.lexer.lex("x + )")
+
+    def testBracketMatching(self):
+        s = "1+(23/(34*2)%4.)-a[(True)]+[[1],(2)]"
+        spans = tau.lexer.matchBrackets(s)
+        for i, c in enumerate(s):
+            if c in "([":
+                self.assertEqual(spans[i], tau.lexer.findMatching(s, i, c, {'(': ')', '[': ']'}[c]))
+        self.assertEqual(tau.lexer.matchBrackets("(1 + [2)"), {0: 7})
+        with self.assertRaisesRegexp(ValueError, "More \[ than \]"):
+            tau.lexer.lex("(1 + [2)")
+        # Nesting well past the recursion limit
+        tokens = tau.lexer.lex("x = " + "("*5000 + "1" + ")"*5000)
+        self.assertEqual([t.name for t in tokens], ['=', '()'])
+        for i in range(5000):
+            tokens = tokens[-1].data
+        self.assertEqual([t.name for t in tokens], ['literal'])
+
+    def testSourceSpans(self):
+        tokens = tau.lexer.lex("    y = sin(2.) + 3", False, 7)
+        self.assertEqual([(t.line, t.start, t.end) for t in tokens],
+                         [(7, 6, 7), (7, 8, 15), (7, 16, 17), (7, 18, 19)])
+        self.assertEqual([(t.start, t.end) for t in tokens[1].data[1]], [(12, 14)])
+        node = tau.ast.ASTNode(tokens[1:], tau.module.TauModule())
+        self.assertEqual((node.line, node.start, node.end), (7, 8, 19))
+        source = tau.inputBuffer.InputBuffer("a = 1\n\nb = 2\n", True)
+        source.getLine()
+        source.getLine()
+        self.assertEqual(source.lineNumber, 3)
+
+    def testParser(self):
+        def shape(node):
+            if node.token.name == "literal":
+                return str(node.token.data[1])
+            return "{}({})".format(node.token.name, ", ".join(shape(c) for c in node.children))
+        mod = tau.module.TauModule()
+        self.assertEqual(shape(tau.ast.ASTNode(tau.lexer.lex("1 - 2 - 3*4 < 5"), mod)),
+                         "<(-(-(1, 2), *(3, 4)), 5)")
+        self.assertEqual(shape(tau.ast.ASTNode(tau.lexer.lex("2.**3.**-2. < 1."), mod)),
+                         "<(**(**(2.0, 3.0), unary -(2.0)), 1.0)")
+        self.assertEqual(shape(tau.ast.ASTNode(tau.lexer.lex("-2.**2. + [1., 2.][1]"), mod)),
+                         "+(**(unary -(2.0), 2.0), indexing(literalArray(1.0, 2.0), 1))")
+        with self.assertRaises(ValueError):
+            tau.ast.ASTNode(tau.lexer.lex("- -3"), mod)
+        with self.assertRaises(ValueError):
+            tau.ast.ASTNode(tau.lexer.lex("3 4"), mod)
+        # Long expressions are no longer limited by the recursion depth
+        node = tau.ast.ASTNode(tau.lexer.lex(" + ".join(["2"]*5000)), mod)
+        self.assertEqual(node.token.name, "+")
+
+    def testOverloadResolution(self):
+        Int, Real = tau.dtypes.Int, tau.dtypes.Real
+        catalog = {'op': {"Real Int": [None, Real], "Int Real": [None, Int], "Real": [None, Real]}}
+        node = tau.ast.ASTNode(tau.lexer.lex("2 + 3"), tau.module.TauModule())
+        with self.assertRaisesRegexp(ValueError, "Tie for overload resolution of token '\+'"):
+            node.resolveTyping('op', catalog)
+        node.children = node.children[:1]
+        node.resolveTyping('op', catalog)
+        self.assertEqual(node.dtype, Real)
+        self.assertEqual(node.children[0].token.name, "Convert")
+        with self.assertRaisesRegexp(ValueError, "No valid candidates for token 'op'"):
+            node.children = node.children*3
+            node.resolveTyping('op', catalog)
+        resolution = tau.ast.resolveOverload(tau.builtins.catalog, '+', (Int, Real))
+        self.assertEqual(resolution[1:], (Real, (Real, Real)))
+        self.assertIs(tau.ast.resolveOverload(tau.builtins.catalog, '+', (Int, Real)), resolution)
+        # Other catalogs are not cached, so one never gets the results of a freed one
+        for retType in [Real, Int, Real]:
+            catalog = {'op': {"Real": [None, retType]}}
+            self.assertIs(tau.ast.resolveOverload(catalog, 'op', (Real,))[1], retType)
+            del catalog
+
+    def testConstantFolding(self):
+        mod = tau.module.TauModule()
+        mod.localVars['y'] = (tau.dtypes.Real, None)
+        mod.localVars['n'] = (tau.dtypes.Int, None)
+
+        def simplify(line):
+            return tau.ast.ASTNode(tau.lexer.lex(line), mod).simplify()
+        folded = [("2 + 3*4", 14), ("-5 // 2", -2), ("-5 % 3", -2), ("7. % -2.", 1.),
+                  ("Int(3.7)", 3), ("2147483647 + 1", -2147483648), ("(2. < 3) and True", 'true'),
+                  ("-(2.**-1)", -.5)]
+        for line, value in folded:
+            node = simplify(line)
+            self.assertEqual(node.token.name, "literal")
+            self.assertEqual(node.token.data[1], value)
+        for line in ["1./0.", "1 // 0", "10.**400", "y + 2.*3", "n - 0. + 1"]:
+            self.assertNotEqual(simplify(line).token.name, "literal")
+        for line in ["(y*1.)", "1*n*1", "(n + 0) // 1", "y**1."]:
+            self.assertEqual(simplify(line).token.name, "name")
+        self.assertEqual(simplify("y + 2.*3").children[1].token.data[1], 6.)
+        self.assertEqual(jit.runCommand("2. + 10.**400"), float('inf'))
+        # Folded values of any magnitude are written as valid double constants
+        for line, value in [("10.**20", 1e20), ("1./10000000.", 1e-07), ("2.**-30", 2.**-30)]:
+            self.assertEqual(jit.runCommand(line), value)
+        self.assertEqual(jit.runCommand("foldedLarge = 10.**20\nfoldedLarge"), 1e20)
+
     def testSameAsPython(self):
         # Commands which should yield identical results as python
         expressions = [
@@ -52,6 +203,16 @@ class TauTester(unittest.TestCase):
             tauResults = jit.runCommand(e)
             self.assertEqual(pythonResults, tauResults)
 
+    def testBatch(self):
+        commands = ["3 + 435. # Test", "batchX = 4", "batchX*2", "True and False",
+                    "def Int batchSquare(Int n):\n    n*n",
+                    "batchY = 0\nwhile batchY < batchX:\n    batchY += 3\nbatchY",
+                    "batchSquare(batchX) - 1"]
+        self.assertEqual(jit.runBatch(commands), [438., None, 8, False, None, 6, 15])
+        self.assertEqual(jit.runCommand("batchSquare(batchY)"), 36)
+        with self.assertRaises(ValueError):
+            jit.runBatch(["1 + 2", "batchZ = unknownName"])
+
     def testAssignment(self):
         jit.runCommand("i = 23.")
         tauResults = jit.runCommand("i")
@@ -131,6 +292,490 @@ class TauTester(unittest.TestCase):
             "    piApprox")
         self.assertAlmostEqual(jit.runCommand("computePi(1000)"), pi, 2)
 
+    def testOptimization(self):
+        optJIT = tau.TauJIT(optLevel=3)
+        optJIT.runCommand(
+            "def Real optPi(Int n):\n"
+            "    optApprox = 0.\n"
+            "    for optIndex in range(n):\n"
+            "        optApprox += 4*(-1)**optIndex / (2*optIndex+1)\n"
+            "    optApprox")
+        self.assertAlmostEqual(optJIT.runCommand("optPi(1000)"), pi, 2)
+        self.assertEqual(optJIT.runCommand("optPi(1000)"), jit.runCommand("computePi(1000)"))
+        self.assertGreater(optJIT.optimizerTime, 0.)
+        with self.assertRaisesRegexp(ValueError, "Optimization level must be"):
+            tau.TauJIT(optLevel=4)
+        with self.assertRaisesRegexp(ValueError, "Optimization level must be 0, 1, 2, or 3, not 5"):
+            tau.compileFile("optMissing.tau", optLevel=5)
+
+    def testObjectCache(self):
+        cacheDir = tempfile.mkdtemp()
+        try:
+            # A second session compiling the same code loads it from the cache
+            anonNumber = tau.module.TauModule.anonNumber
+            cold = tau.TauJIT(optLevel=2, cacheDir=cacheDir)
+            self.assertEqual(cold.runCommand("2.*sin(1.5)"), 2*sin(1.5))
+            self.assertEqual((cold.cacheHits, cold.cacheMisses), (0, 1))
+            tau.module.TauModule.anonNumber = anonNumber
+            warm = tau.TauJIT(optLevel=2, cacheDir=cacheDir)
+            self.assertEqual(warm.runCommand("2.*sin(1.5)"), 2*sin(1.5))
+            self.assertEqual((warm.cacheHits, warm.cacheMisses), (1, 0))
+            # Least recently used objects are evicted first
+            cache = tau.objectCache.ObjectCache(os.path.join(cacheDir, "lru"), 300)
+            for key in "abc":
+                cache.store(key, key*100)
+                os.utime(cache.path(key), (time.time(), time.time() - ord('z') + ord(key)))
+            self.assertEqual(cache.load("a"), "a"*100)
+            cache.store("d", "d"*100)
+            self.assertEqual([cache.contains(k) for k in "abcd"], [True, False, True, True])
+        finally:
+            shutil.rmtree(cacheDir)
+
+    def testParallelBuilds(self):
+        # Files with the same name in different directories must not share temporary files
+        buildDir = tempfile.mkdtemp()
+        try:
+            directories = [os.path.join(buildDir, str(i)) for i in range(8)]
+            for i, directory in enumerate(directories):
+                os.mkdir(directory)
+                with open(os.path.join(directory, "scale.tau"), 'w') as f:
+                    f.write("def Real scale(Real x):\n    x*{}.\n".format(i))
+            pool = multiprocessing.Pool(4, maxtasksperchild=1)
+            pool.map(buildLibrary, directories)
+            pool.close()
+            for i, directory in enumerate(directories):
+                scale = ctypes.CDLL(os.path.join(directory, "scale.so")).scale
+                scale.restype, scale.argtypes = ctypes.c_double, [ctypes.c_double]
+                self.assertEqual(scale(1.5), 1.5*i)
+                self.assertEqual(sorted(os.listdir(directory)), ["scale.so", "scale.tau"])
+        finally:
+            shutil.rmtree(buildDir)
+
+    def testIncrementalBuilds(self):
+        buildDir = tempfile.mkdtemp()
+        cacheDir = os.path.join(buildDir, "cache")
+        sourceFile = os.path.join(buildDir, "kernels.tau")
+
+        def build(source, n):
+            with open(sourceFile, 'w') as f:
+                f.write(source)
+            tau.compileFile(sourceFile, os.path.join(buildDir, "k{}.so".format(n)),
+                            quiet=True, cacheDir=cacheDir)
+            quad = ctypes.CDLL(os.path.join(buildDir, "k{}.so".format(n))).quad
+            quad.restype, quad.argtypes = ctypes.c_double, [ctypes.c_double]
+            return quad(1.5), len(os.listdir(cacheDir))
+        try:
+            twice = "def Real twice(Real x):\n    x*{}\n"
+            quad = "def Real quad(Real y):\n    twice(twice(y))*1.\n"
+            # Each function is cached as its object and its array effects
+            self.assertEqual(build(twice.format("2.") + quad, 0), (6., 5))
+            # Only the function that changed is recompiled
+            self.assertEqual(build(twice.format("3.") + quad, 1), (13.5, 7))
+            self.assertEqual(build(twice.format("2.") + "\n" + quad, 2), (6., 7))
+            # Units found in the cache are not parsed again
+            stats = tau.compileFile(sourceFile, os.path.join(buildDir, "k.so"), quiet=True,
+                                    cacheDir=cacheDir)
+            self.assertEqual(stats.counts['tokens'], 0)
+            # Changing a signature also recompiles the functions which call it
+            twice = "def Int twice(Real x):\n    Int(x*2.)\n"
+            self.assertEqual(build(twice + quad, 3), (6., 11))
+            # Lines of only whitespace do not end a block, as when building without a cache
+            spaced = "def Real quad(Real y):\n    z = twice(twice(y))*1.\n  \n    z\n"
+            self.assertEqual(build(twice + spaced, 4)[0], 6.)
+            # So does a callee starting to keep an array argument, which the caller must then
+            # allocate on the heap rather than its stack
+            keep = "def Array:Real keep(Array:Real a):\n    a\n"
+            first = "def Real first(Array:Real a):\n    {}[0]\n"
+            quad = "def Real quad(Real y):\n    b = [y, 2.]\n    first(b)\n"
+            cached = len(os.listdir(cacheDir))
+            self.assertEqual(build(keep + first.format("a") + quad, 5), (1.5, cached + 6))
+            self.assertEqual(build(keep + first.format("keep(a)") + quad, 6), (1.5, cached + 10))
+            with open(os.path.join(buildDir, "k6.so"), 'rb') as f:
+                self.assertIn("aligned_alloc", f.read())
+        finally:
+            shutil.rmtree(buildDir)
+
+    def testGetFunction(self):
+        jit.runCommand(
+            "def Real scaleSum(Array:Real a, Int n, Real k):\n"
+            "    total = 0.\n"
+            "    for scaleIndex in range(n):\n"
+            "        a[scaleIndex] = a[scaleIndex]*k\n"
+            "        total += a[scaleIndex]\n"
+            "    total")
+        scaleSum = jit.getFunction("scaleSum")
+        self.assertIs(jit.getFunction("scaleSum"), scaleSum)
+        # Arrays are modified in place, whatever kind of buffer they are
+        values = array.array('d', [1., 2., 3.])
+        self.assertEqual(scaleSum(values, 3, 2.), 12.)
+        self.assertEqual(list(values), [2., 4., 6.])
+        values = (ctypes.c_double*3)(1., 2., 3.)
+        self.assertEqual(scaleSum(memoryview(values), 2, -1.), -3.)
+        self.assertEqual(list(values), [-1., -2., 3.])
+        with self.assertRaisesRegexp(TypeError, "format 'i'"):
+            scaleSum(array.array('i', [1, 2]), 2, 1.)
+        with self.assertRaisesRegexp(TypeError, "must be writable"):
+            scaleSum("abc", 2, 1.)
+        with self.assertRaisesRegexp(TypeError, "takes 3 arguments"):
+            scaleSum(values, 2)
+        self.assertEqual(jit.getFunction("fibb")(1000), 1597)
+        with self.assertRaisesRegexp(ValueError, "not defined"):
+            jit.getFunction("notAFunction")
+        jit.runCommand("def Array:Real getMade(Int n):\n    Real[n]")
+        with self.assertRaisesRegexp(ValueError, "returning arrays"):
+            jit.getFunction("getMade")
+
+    def testVectorize(self):
+        jit.runCommand("def Real vecFma(Real vecX, Real vecY, Int vecK):\n    vecX*vecY + vecK")
+        fma = jit.vectorize("vecFma")
+        xs = array.array('d', [1., 2., 3.])
+        ys = array.array('d', [4., 5., 6.])
+        self.assertEqual(list(fma(xs, ys, 1)), [5., 11., 19.])
+        # Scalars are broadcast, and results can go to an existing buffer
+        self.assertEqual(list(fma(xs, 2., array.array('i', [0, 1, 2]))), [2., 5., 8.])
+        out = (ctypes.c_double*3)()
+        fma(2., ys, -1, out=memoryview(out))
+        self.assertEqual(list(out), [7., 9., 11.])
+        self.assertEqual(fma(2., 3., 1), 7.)
+        with self.assertRaisesRegexp(ValueError, "different lengths"):
+            fma(xs, array.array('d', [1.]), 0)
+        with self.assertRaisesRegexp(TypeError, "format 'i'"):
+            fma(xs, ys, 0, out=array.array('i', [0, 0, 0]))
+        with self.assertRaisesRegexp(ValueError, "Only functions of Real and Int"):
+            jit.vectorize("scaleSum")
+
+    def testParallelFor(self):
+        jit.runCommand(
+            "def Real parallelPi(Int n):\n"
+            "    piApprox = 0.\n"
+            "    parallel for i in range(n) sum(piApprox):\n"
+            "        piApprox += 4*(-1)**i / (2*i+1)\n"
+            "    piApprox")
+        self.assertAlmostEqual(jit.runCommand("parallelPi(100000)"),
+                               sum(4*(-1)**k / (2*k+1) for k in range(100000)))
+        self.assertEqual(jit.runCommand("parallelPi(0)"), 0.)
+        # Chunked scheduling, with the enclosing function's variables shared
+        jit.runCommand(
+            "def Int parallelFill(Array:Int a, Int n, Int offset):\n"
+            "    count = 0\n"
+            "    parallel for i in range(n) chunk(3) sum(count):\n"
+            "        square = i*i\n"
+            "        a[i] = square + offset\n"
+            "        count += 1\n"
+            "    count")
+        values = array.array('i', [0]*100)
+        self.assertEqual(jit.getFunction("parallelFill")(values, 100, 5), 100)
+        self.assertEqual(list(values), [k*k + 5 for k in range(100)])
+        # Nested loops run the inner loop serially on each thread
+        self.assertEqual(jit.runCommand(
+            "parallelTotal = 1\n"
+            "parallel for parallelA in range(20) sum(parallelTotal):\n"
+            "    partial = 0\n"
+            "    parallel for parallelB in range(30) sum(partial):\n"
+            "        partial += parallelB\n"
+            "    parallelTotal += partial\n"
+            "parallelTotal"), 1 + 20*435)
+        # The JIT runs with one thread on a single CPU, so an executable is given several
+        out = runExecutable("def Real exitParallelPi(Int n):\n"
+                            "    piApprox = 0.\n"
+                            "    parallel for i in range(n) sum(piApprox):\n"
+                            "        piApprox += 4*(-1)**i / (2*i+1)\n"
+                            "    piApprox\n"
+                            "def Int exitParallelFill(Array:Int a, Int n):\n"
+                            "    count = 0\n"
+                            "    parallel for i in range(n) chunk(3) sum(count):\n"
+                            "        a[i] = i*i\n"
+                            "        count += 1\n"
+                            "    count\n"
+                            "exitValues = Int[100]\n"
+                            "print(exitParallelFill(exitValues, 100))\n"
+                            "exitTotal = 0\n"
+                            "for exitI in range(100):\n"
+                            "    exitTotal += exitValues[exitI]\n"
+                            "print(exitTotal)\n"
+                            "print(exitParallelPi(100000))\n", {'TAU_NUM_THREADS': "4"})[1]
+        count, total, piApprox = out.split()
+        self.assertEqual((int(count), int(total)), (100, sum(k*k for k in range(100))))
+        self.assertAlmostEqual(float(piApprox), sum(4*(-1)**k / (2*k+1) for k in range(100000)),
+                               places=5)
+        with self.assertRaisesRegexp(ValueError, "Unknown parallel loop clause"):
+            jit.runCommand("parallel for parallelC in range(3) guided:\n    parallelC")
+        with self.assertRaisesRegexp(ValueError, "Cannot sum variable"):
+            jit.runCommand("parallelFlag = True\n"
+                           "parallel for parallelC in range(3) sum(parallelFlag):\n"
+                           "    parallelC")
+
+    def testVectorTypes(self):
+        self.assertEqual(tau.dtypes.getType("Real4").irname, "<4 x double>")
+        jit.runCommand(
+            "def Real vectorDot(Array:Real a, Array:Real b, Int n):\n"
+            "    acc = Real4(0.)\n"
+            "    for vecIndex in range(n//4):\n"
+            "        acc += load4(a, 4*vecIndex) * load4(b, 4*vecIndex)\n"
+            "    sum(acc)")
+        self.assertEqual(jit.runCommand(
+            "vecA = Real[8]\n"
+            "vecB = Real[8]\n"
+            "vecIndex = 0\n"
+            "while vecIndex < 8:\n"
+            "    vecA[vecIndex] = vecIndex*1.\n"
+            "    vecB[vecIndex] = 2.\n"
+            "    vecIndex += 1\n"
+            "vectorDot(vecA, vecB, 8)"), 56.)
+        # Scalars are copied to every lane, and lanes can be read by index
+        self.assertEqual(jit.runCommand("vecC = load4(vecA, 4)*2 - 1\nvecC[1]"), 9.)
+        self.assertEqual(jit.runCommand("max(vecC) - min(-vecC)"), 26.)
+        self.assertEqual(jit.runCommand("vecD = Int8(3)\nsum(vecD*vecD % 5 // Int8(2))"), 16)
+        self.assertEqual(jit.runCommand("store(vecA, 0, vecC)\nvecA[3]"), 13.)
+        self.assertEqual(jit.runCommand("storeUnaligned(vecA, 1, Real2(7))\nvecA[2]"), 7.)
+        self.assertEqual(jit.runCommand("max(loadUnaligned8(vecA, 0)) + sum(3.)"), 16.)
+        with self.assertRaisesRegexp(ValueError, "Cannot assign to elements"):
+            jit.runCommand("vecC[0] = 1.")
+        with self.assertRaisesRegexp(ValueError, "No valid candidates"):
+            jit.runCommand("vecC + vecD")
+        jit.runCommand("def Real4 vectorTwice(Real4 vecV):\n    vecV*2.")
+        self.assertEqual(jit.runCommand("sum(vectorTwice(Real4(1.5)))"), 12.)
+        with self.assertRaisesRegexp(ValueError, "vector types cannot be called"):
+            jit.getFunction("vectorTwice")
+
+    def testBoundsChecks(self):
+        self.assertEqual(jit.runCommand("lenArr = Real[7]\nlen(lenArr) + len([1, 2])"), 9)
+        jit.runCommand("def Int countItems(Array:Int a):\n    len(a)")
+        self.assertEqual(jit.getFunction("countItems")(array.array('i', [0]*5)), 5)
+        # Loops over range(len(a)) need no checks of a[i] unless the body assigns to i or a
+        source = ("def Real checkedSum(Array:Real bcArr, Int bcLast):\n"
+                  "    bcTotal = 0.\n"
+                  "    for bcIndex in range(len(bcArr)):\n"
+                  "        bcTotal += bcArr[bcIndex]\n"
+                  "    for bcOther in range(len(bcArr)):\n"
+                  "        bcOther += 1\n"
+                  "        bcTotal += bcArr[bcOther]\n"
+                  "    bcTotal + bcArr[bcLast]\n")
+        self.assertEqual(moduleIR(source, checkBounds=True).count("icmp ult"), 2)
+        status, out, err = runExecutable("bcValues = [1., 2., 3.]\nbcValues[2]\nbcValues[5]\n",
+                                         checkBounds=True)
+        self.assertNotEqual(status, 0)
+        self.assertIn("Index 5 is out of bounds for an array of length 3", err)
+
+    def testArrayAliasing(self):
+        source = ("def Real aliasScale(Array:Real aliasOut, Array:Real aliasIn, Int n):\n"
+                  "    for aliasIndex in range(n):\n"
+                  "        aliasOut[aliasIndex] = aliasIn[aliasIndex]*2.\n"
+                  "    aliasIn[0]\n"
+                  "def Array:Real aliasSame(Array:Real aliasArg):\n"
+                  "    aliasArg\n")
+        ir = moduleIR(source)
+        self.assertIn("define double @aliasScale(double* noalias nocapture %arg_aliasOut, "
+                      "i32 %len_aliasOut, double* noalias nocapture %arg_aliasIn", ir)
+        # Returning an array keeps it past the call
+        self.assertIn("@aliasSame(double* noalias %arg_aliasArg", ir)
+        jit.runCommand(
+            "def Real aliasAdd(Array:Real a, Array:Real b, Array:Real c):\n"
+            "    c[0] = a[0] + b[0]\n"
+            "    c[0]")
+        jit.runCommand("aliasX = [1., 2.]\naliasY = aliasX\naliasZ = [3.]")
+        # Arrays which are only read may be the same
+        self.assertEqual(jit.runCommand("aliasAdd(aliasX, aliasY, aliasZ)"), 2.)
+        with self.assertRaisesRegexp(ValueError, "b and c of aliasAdd may be the same"):
+            jit.runCommand("aliasAdd(aliasZ, aliasY, aliasX)")
+        jit.runCommand("def Real aliasGlobal(Array:Real a):\n    aliasZ[0] = a[0]\n    0.")
+        with self.assertRaisesRegexp(ValueError, "may be the global array aliasZ"):
+            jit.runCommand("aliasGlobal(aliasZ)")
+        add = jit.getFunction("aliasAdd")
+        values = array.array('d', [1., 2., 3.])
+        self.assertEqual(add(values, values, array.array('d', [0.])), 2.)
+        with self.assertRaisesRegexp(ValueError, "b and c of aliasAdd overlap"):
+            buffer = (ctypes.c_double*3)(1., 2., 3.)
+            add(array.array('d', [0.]), memoryview(buffer), memoryview(buffer)[2:])
+
+    def testArena(self):
+        source = ("def Real arenaLast(Array:Real a):\n"
+                  "    a[len(a)-1] = 1.\n"
+                  "    a[len(a)-1]\n"
+                  "def Real arenaSum(Int n, Int size):\n"
+                  "    arenaTotal = 0.\n"
+                  "    for arenaIndex in range(n):\n"
+                  "        arenaTotal += arenaLast(Real[size]) + arenaLast(Real[size+1])\n"
+                  "    arenaTotal\n"
+                  "def Array:Real arenaKept(Int n):\n"
+                  "    arenaResult = Real[n]\n"
+                  "    arenaResult[n-1] = 3.\n"
+                  "    arenaResult\n")
+        # Functions are shared between modules, so the inspected copy has other names
+        ir = moduleIR(source.replace("arena", "arenaIR"))
+        # The loop's temporaries are released each iteration; the returned array is on the heap
+        self.assertEqual(ir.count("call i8* @tau_arena_alloc"), 2)
+        self.assertEqual(ir.count("call void @tau_arena_release"), 1)
+        self.assertEqual(ir.count("call i8* @aligned_alloc"), 1)
+        jit.runCommand(source)
+        self.assertEqual(jit.runCommand("arenaSum(10000, 100)"), 20000.)
+        # Requests too large for the arena are taken from the heap
+        jit.runCommand("def Real arenaLarge(Int n):\n"
+                       "    arenaBig = 0.\n"
+                       "    parallel for arenaP in range(4) sum(arenaBig):\n"
+                       "        arenaBig += arenaLast(Real[n]) + arenaP\n"
+                       "    arenaBig")
+        self.assertEqual(jit.runCommand("arenaLarge(1000000)"), 10.)
+        self.assertEqual(jit.runCommand("arenaLarge(10)"), 10.)
+        # Arrays freed in a loop are forgotten before the scope of the iteration ends
+        jit.runCommand("def Real arenaFreed(Int n):\n"
+                       "    arenaAcc = 0.\n"
+                       "    for arenaI in range(n):\n"
+                       "        arenaV = Real[n]\n"
+                       "        arenaV[0] = 1.\n"
+                       "        arenaAcc += arenaV[0]\n"
+                       "        free(arenaV)\n"
+                       "    arenaAcc")
+        self.assertEqual(jit.runCommand("arenaFreed(10)"), 10.)
+        # Compiled executables link the arena too, including its fallback to the heap
+        out = runExecutable(source + "print(arenaSum(100, 3))\nprint(arenaSum(2, 1000000))\n"
+                            "print(arenaKept(5)[4])\n")[1]
+        self.assertEqual(out.split(), ["200.000000", "4.000000", "3.000000"])
+
+    def testStackArrays(self):
+        source = ("def Real stackLoop(Int n):\n"
+                  "    stackAcc = 0.\n"
+                  "    for stackI in range(n):\n"
+                  "        stackV = [stackI*1., 2., 3.]\n"
+                  "        stackV[1] = stackV[0] + 1.\n"
+                  "        stackAcc += stackV[0]*stackV[1] + stackV[2]\n"
+                  "    stackAcc\n"
+                  "def Array:Real stackKept():\n"
+                  "    stackR = [1., 2.]\n"
+                  "    stackR\n"
+                  "def Real stackShared(Int n):\n"
+                  "    stackAcc = 0.\n"
+                  "    stackW = [0.]\n"
+                  "    stackU = [5.]\n"
+                  "    for stackI in range(n):\n"
+                  "        stackW = stackU\n"
+                  "        stackU = [stackI*1.]\n"
+                  "        stackAcc += stackW[0]\n"
+                  "    stackAcc\n")
+        ir = moduleIR(source.replace("stack", "stackIR"))
+        # Only stackW = [0.] and the loop's array stay on the stack; the rest become heap calls
+        self.assertEqual(ir.count("alloca [24 x i8], align 64"), 1)
+        self.assertEqual(ir.count("bitcast [24 x i8]*"), 1)
+        self.assertEqual(ir.count("bitcast [8 x i8]*"), 1)
+        self.assertEqual(ir.count("call i8* @aligned_alloc"), 3)
+        jit.runCommand(source)
+        self.assertEqual(jit.runCommand("stackLoop(10)"), sum(k*(k + 1.) + 3 for k in range(10)))
+        self.assertEqual(jit.runCommand("stackShared(4)"), 5. + 0 + 1 + 2)
+        self.assertEqual(jit.runCommand("stackTotal = stackKept()\nstackTotal[1]"), 2.)
+
+    def testMemoryTracking(self):
+        tracked = tau.TauJIT(trackMemory=True)
+        self.assertEqual(tracked.memoryStats()['allocations'], 0)
+        with self.assertRaisesRegexp(ValueError, "trackMemory=True"):
+            jit.memoryStats()
+        source = ("def Real memoryLoop(Int n):\n"
+                  "    memoryTotal = 0.\n"
+                  "    for memoryI in range(n):\n"
+                  "        memoryV = Real[n]\n"
+                  "        memoryV[0] = 2.\n"
+                  "        memoryTotal += memoryV[0]\n"
+                  "    memoryTotal\n")
+        tracked.runCommand(source)
+        self.assertEqual(tracked.runCommand("memoryLoop(10)"), 20.)
+        tracked.runCommand("memoryFreed = Real[100]\nfree(memoryFreed)")
+        stats = tracked.memoryStats()
+        self.assertEqual((stats['allocations'], stats['frees']), (11, 1))
+        self.assertEqual(stats['liveBytes'], 10*128)
+        self.assertEqual(stats['peakBytes'], 10*128 + 832)
+        # Arrays kept in variables but never freed show up as live bytes of their site
+        self.assertEqual(stats['sites']['memoryLoop:4'],
+                         {'allocations': 10, 'frees': 0, 'bytes': 1280, 'liveBytes': 1280,
+                          'sizes': {128: 10}})
+        self.assertEqual(stats['sites']['<top level>:1']['liveBytes'], 0)
+        # Temporaries too large for the arena are counted too, and freed along with it
+        tracked.runCommand("def Real memoryLast(Array:Real a):\n"
+                           "    a[len(a)-1] = 1.\n"
+                           "    a[len(a)-1]")
+        tracked.runCommand("def Real memoryLarge(Int n):\n"
+                           "    memoryBig = 0.\n"
+                           "    for memoryJ in range(3):\n"
+                           "        memoryBig += memoryLast(Real[n])\n"
+                           "    memoryBig")
+        self.assertEqual(tracked.runCommand("memoryLarge(300000)"), 3.)
+        self.assertEqual(tracked.runCommand("memoryLarge(10)"), 3.)
+        stats = tracked.memoryStats()
+        # Each is given a header by the arena
+        self.assertEqual(stats['sites']['memoryLarge:4'],
+                         {'allocations': 3, 'frees': 3, 'bytes': 3*(2400000 + 64),
+                          'liveBytes': 0, 'sizes': {2**22: 3}})
+        self.assertEqual(stats['peakBytes'], 10*128 + 2400000 + 64)
+        err = runExecutable(source.replace("memory", "exitMemory") + "exitMemoryLoop(3)\n",
+                            trackMemory=True)[2]
+        self.assertIn("Memory: 3 allocations, 0 frees, 192 bytes live at exit", err)
+        self.assertIn("exitMemoryLoop:4: 3 allocations", err)
+        self.assertIn("up to 64 bytes: 3", err)
+
+    def testProfiling(self):
+        profiled = tau.TauJIT(profile=True)
+        self.assertEqual(profiled.profileStats(), {})
+        with self.assertRaisesRegexp(ValueError, "profile=True"):
+            jit.profileStats()
+        source = ("def Real profileInner(Real x):\n"
+                  "    x*2.\n"
+                  "def Real profileOuter(Int n):\n"
+                  "    profileTotal = 0.\n"
+                  "    for profileI in range(n):\n"
+                  "        profileTotal += profileInner(profileI*1.)\n"
+                  "    profileTotal\n")
+        profiled.runCommand(source)
+        self.assertEqual(profiled.runCommand("profileOuter(10)"), 90.)
+        self.assertEqual(profiled.runCommand("profileInner(1.)"), 2.)
+        stats = profiled.profileStats()
+        self.assertEqual((stats['profileOuter']['calls'], stats['profileInner']['calls']), (1, 11))
+        inner, outer = stats['profileInner'], stats['profileOuter']
+        self.assertEqual(inner['inclusiveCycles'], inner['exclusiveCycles'])
+        self.assertGreater(outer['exclusiveCycles'], 0)
+        self.assertLess(outer['exclusiveCycles'], outer['inclusiveCycles'])
+        # Without profiling, the generated code is unchanged
+        self.assertNotIn("tau_profile", moduleIR(source.replace("profile", "unprofiled")))
+        reportFile, report = tempfile.mkstemp(suffix=".txt")
+        os.close(reportFile)
+        try:
+            runExecutable(source.replace("profile", "exitProfile") + "exitProfileOuter(3)\n",
+                          {'TAU_PROFILE_FILE': report}, profile=True)
+            with open(report) as f:
+                lines = [line.split() for line in f]
+            self.assertEqual(lines[0], ["function", "calls", "inclusive_cycles",
+                                        "exclusive_cycles"])
+            calls = dict((line[0], int(line[1])) for line in lines[1:])
+            self.assertEqual(calls, {'exitProfileOuter': 1, 'exitProfileInner': 3})
+        finally:
+            os.remove(report)
+
+    def testPhaseStats(self):
+        timed = tau.TauJIT()
+        timed.runCommand("phaseX = 1 + 2*3.")
+        self.assertEqual(timed.stats.counts['tokens'], 6)
+        self.assertGreaterEqual(timed.stats.counts['astNodes'], 6)
+        self.assertGreater(timed.stats.counts['irLines'], 0)
+        for phase in ['lex', 'parse', 'emit', 'irText', 'llvmParse', 'codegen']:
+            self.assertGreater(timed.stats.times[phase], 0.)
+        self.assertEqual(timed.stats.times['link'], 0.)
+        self.assertAlmostEqual(timed.stats.total(), sum(timed.stats.times.values()))
+        # Nested phases are only counted in the innermost
+        stats = tau.phases.PhaseStats()
+        with stats.phase('emit'):
+            with stats.phase('lex'):
+                time.sleep(0.01)
+        self.assertGreaterEqual(stats.times['lex'], 0.01)
+        self.assertLess(stats.times['emit'], 0.01)
+        buildDir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(buildDir, "phases.tau"), 'w') as f:
+                f.write("def Real phaseF(Real x):\n    x*2.\nprint(phaseF(1.))\n")
+            stats = tau.compileFile(os.path.join(buildDir, "phases.tau"),
+                                    os.path.join(buildDir, "phases"), quiet=True)
+            self.assertGreater(stats.times['link'], 0.)
+            self.assertGreater(stats.counts['registers'], 0)
+            self.assertIn("linking", stats.table())
+        finally:
+            shutil.rmtree(buildDir)
+
     def testErrorChecking(self):
         with self.assertRaises(ValueError):
             jit.runCommand("x1 = stuff")
@@ -156,6 +801,10 @@ class TauTester(unittest.TestCase):
             "tot")
         self.assertEqual(result, 9915.)
 
+    def testLongExpressions(self):
+        self.assertEqual(jit.runCommand(" + ".join(str(i) for i in range(3000))), 2999*3000//2)
+        self.assertEqual(jit.runCommand("-(" + "1.*"*2000 + "2.) + 3"), 1.)
+
     def testArrays(self):
         jit.runCommand("arr = [1, 2, 3, 4, 5]")
         self.assertEqual(jit.runCommand("5-arr[3]"), 1)